@@ -3,7 +3,8 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
-import time # for measuring time of processing steps
+from RegistrationWorkflowLib.volumes import arrayFromVolume, arrayFromVolumeModified, allocateVolumeLike, sameVolumeGeometry, registrationLabelArray
+from RegistrationWorkflowLib.tracer import traced, traceSpan, tracing
 
 #
 # CreateRegisterLabel
@@ -18,7 +19,7 @@ class CreateRegisterLabel(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "CreateRegisterLabel" # TODO make this more human readable by adding spaces
     self.parent.categories = ["Prostate"]
-    self.parent.dependencies = []
+    self.parent.dependencies = ['PreProcess'] # PreProcess ships RegistrationWorkflowLib
     self.parent.contributors = ["John Doe (AnyWare Corp.)"] # replace with "Firstname Lastname (Organization)"
     self.parent.helpText = """
     This is an example of scripted loadable module bundled in an extension.
@@ -155,6 +156,10 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None, useCLI=False):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.useCLI = useCLI # True builds the label with the thresholdscalarvolume/imagelabelcombine CLIs
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -182,64 +187,63 @@ class CreateRegisterLabelLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
+  @traced('Changing Label Value')
   def ThresholdAbove(self, inputVolume, thresholdVal, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
-    # Print to Slicer CLI
-    print('Changing Label Value...'),
-    start_time = time.time()
-
     # Run the slicer module in CLI
     cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': thresholdVal, 'OutsideValue': newLabelVal} 
     cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
 
+  @traced('Combining Labels')
   def ImageLabelCombine(self, inputLabelA, inputLabelB, outputLabel):
     """ Combines labelmaps with label A overwriting label B if any overlapping area
     """
-    # Print to Slicer CLI
-    print('Combining Labels...'),
-    start_time = time.time()
-
     # Run the slicer module in CLI
     cliParams = {'InputLabelMap_A': inputLabelA.GetID(),'InputLabelMap_B': inputLabelB.GetID(), 'OutputLabelMap': outputLabel.GetID()} 
     cliNode = slicer.cli.run(slicer.modules.imagelabelcombine, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
 
-  def run(self, inputCapsule, inputCG, inputVM, outputLabel):
+  def run(self, inputCapsule, inputCG, inputVM, outputLabel, tracePath=None):
     """
-    Run the actual algorithm
+    Run the actual algorithm. With a tracePath, the timing of the steps is written there as a Chrome trace
     """
 
     # Print to Slicer CLI
     logging.info('\n\nProcessing started')
-    start_time_overall = time.time() # start timer
-
-    # Combine CG and Capsule Labelmaps
-    self.ImageLabelCombine(inputCG, inputCapsule, outputLabel) 
-
-    # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
-    self.ThresholdAbove(outputLabel, 1.5, 0) # PZ has value of 1
-
-    # # Threshold VM to 1 before adding
-    self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
-
-    # # Add VM to output Label
-    self.ImageLabelCombine(outputLabel, inputVM, outputLabel) # first label overwrites 2nd label
+    with tracing(tracePath):
+      with traceSpan('CreateRegisterLabelLogic.run', inputCapsule=inputCapsule.GetID(), inputCG=inputCG.GetID(),
+                     inputVM=inputVM.GetID(), outputLabel=outputLabel.GetID()) as runSpan:
+        self.createRegistrationLabel(inputCapsule, inputCG, inputVM, outputLabel)
 
     # Print to Slicer CLI
-    end_time_overall = time.time()
     logging.info('Processing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time_overall-start_time_overall)
+    print('Overall Algorithm Time: % 0.1f seconds') % float(runSpan.elapsed)
 
     return True
 
+  def createRegistrationLabel(self, inputCapsule, inputCG, inputVM, outputLabel):
+    """ Registration label (PZ and VM with label value 1) of run()
+    """
+    if self.useCLI or not (sameVolumeGeometry(inputCG, inputCapsule) and sameVolumeGeometry(inputCG, inputVM)):
+      # Combine CG and Capsule Labelmaps
+      self.ImageLabelCombine(inputCG, inputCapsule, outputLabel) 
+
+      # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
+      self.ThresholdAbove(outputLabel, 1.5, 0) # PZ has value of 1
+
+      # # Threshold VM to 1 before adding
+      self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
+
+      # # Add VM to output Label
+      self.ImageLabelCombine(outputLabel, inputVM, outputLabel) # first label overwrites 2nd label
+    else:
+      # Fused single pass (PZ + VM with label value 1) that leaves the input segmentations untouched
+      registerVoxels = registrationLabelArray(arrayFromVolume(inputCapsule), arrayFromVolume(inputCG), arrayFromVolume(inputVM))
+      if outputLabel.GetID() not in (inputCapsule.GetID(), inputCG.GetID(), inputVM.GetID()):
+        allocateVolumeLike(inputCG, outputLabel)
+      arrayFromVolume(outputLabel)[:] = registerVoxels
+      arrayFromVolumeModified(outputLabel)
+
 
 class CreateRegisterLabelTest(ScriptedLoadableModuleTest):
   """
@@ -3,10 +3,18 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import math
 import time
+import multiprocessing
+import numpy
 
 import SimpleITK as sitk
-import sitkUtils
+from RegistrationWorkflowLib.volumes import smoothLabelArray, arrayFromVolume, arrayFromVolumeModified, allocateVolumeLike
+from RegistrationWorkflowLib.volumes import sameVolumeGeometry, labelAgreements, resliceArray, gaussianSmoothArray, labelBoundingBox
+from RegistrationWorkflowLib.tracer import traced, traceSpan, tracing
+from RegistrationWorkflowLib.pipeline import PipelineStage, PipelineScheduler, runCLI
+from RegistrationWorkflowLib.cache import StageCache
+from RegistrationWorkflowLib.images import imageFromVolume, updateVolumeFromImage
 
 #
 # CustomRegister
@@ -21,7 +29,7 @@ class CustomRegister(ScriptedLoadableModule):
     ScriptedLoadableModule.__init__(self, parent)
     self.parent.title = "CustomRegister"
     self.parent.categories = ["Prostate"]
-    self.parent.dependencies = ['SegmentationSmoothing','QuadEdgeSurfaceMesher']
+    self.parent.dependencies = ['SegmentationSmoothing','QuadEdgeSurfaceMesher','PreProcess'] # PreProcess ships RegistrationWorkflowLib
     self.parent.contributors = ["Andrey Fedorov (BWH), Andras Lasso (Queen's University), Tyler Glass (Nightingale Lab)"]
     self.parent.helpText = """
     This module performs distance-based image registration using segmentations 
@@ -290,6 +298,29 @@ class CustomRegisterWidget(ScriptedLoadableModuleWidget):
 
     # self.registrationModeGroup.connect('buttonClicked(int)',self.onVisualizationModeClicked)
 
+    self.UseCacheCheckBox = qt.QCheckBox("Reuse Preprocessed Labels")
+    self.UseCacheCheckBox.toolTip = "Load the smoothed labels and distance maps of labels that were preprocessed before from the cache"
+    self.UseCacheCheckBox.checked = True
+    parametersFormLayout.addWidget(self.UseCacheCheckBox)
+
+    #
+    # Threads of the registrations
+    #
+    self.threadsPerJobSpinBox = qt.QSpinBox()
+    self.threadsPerJobSpinBox.minimum = 1
+    self.threadsPerJobSpinBox.maximum = multiprocessing.cpu_count()
+    self.threadsPerJobSpinBox.value = multiprocessing.cpu_count()
+    self.threadsPerJobSpinBox.setToolTip( "ITK threads of every BSpline registration" )
+    parametersFormLayout.addRow("Threads per registration: ", self.threadsPerJobSpinBox)
+
+    self.maxConcurrentJobsSpinBox = qt.QSpinBox()
+    self.maxConcurrentJobsSpinBox.minimum = 1
+    self.maxConcurrentJobsSpinBox.maximum = multiprocessing.cpu_count()
+    self.maxConcurrentJobsSpinBox.value = 1
+    self.maxConcurrentJobsSpinBox.setToolTip( "Registrations run at the same time. With more than one, the registration times "
+                                              "include the contention for the cores" )
+    parametersFormLayout.addRow("Concurrent registrations: ", self.maxConcurrentJobsSpinBox)
+
     #
     # Apply Button
     #
@@ -325,6 +356,10 @@ class CustomRegisterWidget(ScriptedLoadableModuleWidget):
 
   def onApplyButton(self):
     logic = CustomRegisterLogic()
+    if self.UseCacheCheckBox.checked:
+      logic.cacheDirectory = os.path.join(slicer.app.temporaryPath, 'CustomRegisterCache')
+    logic.threadsPerJob = self.threadsPerJobSpinBox.value
+    logic.maxConcurrentJobs = self.maxConcurrentJobsSpinBox.value
 
     # self.parameterNode.SetAttribute('FixedImageNodeID',             self.fixedImageSelector.currentNode().GetID())
     self.parameterNode.SetAttribute('FixedLabelNodeID',             self.fixedImageLabelSelector.currentNode().GetID())
@@ -345,7 +380,8 @@ class CustomRegisterWidget(ScriptedLoadableModuleWidget):
     self.parameterNode.SetAttribute('AffineTransformNodeID',       self.affineTransformSelector.currentNode().GetID())
     # self.parameterNode.SetAttribute('BSplineTransformNodeID',      self.bsplineTransformSelector.currentNode().GetID())
 
-    logic.run(self.parameterNode)
+    tracePath = os.path.join(slicer.app.temporaryPath, 'CustomRegisterTraces', 'CustomRegister-%s.json' % time.strftime('%Y%m%d-%H%M%S'))
+    logic.run(self.parameterNode, tracePath)
     
 
     # configure the GUI
@@ -402,6 +438,15 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None, useCLI=False):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.useCLI = useCLI # True smooths labels with the labelmapsmoothing CLI
+    self.threadsPerJob = None # ITK threads of every BSpline registration of the experiment (None uses all cores)
+    self.maxConcurrentJobs = 1 # registrations run at the same time (more than 1 makes the registration times contended)
+    self.cacheDirectory = None # directory of the StageCache for the preprocessed labels (None disables caching)
+    self.cacheSizeLimit = 5*1024**3 # bytes
+    self.smoothingParameters = {} # settings of the segmentationsmoothing CLI that differ from its defaults
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -429,64 +474,76 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def run(self, parameterNode):
+  def run(self, parameterNode, tracePath=None):
     """
-    Run the actual algorithm
+    Run the actual algorithm. With a tracePath, the timing of the steps is written there as a Chrome trace
     """
-    
-    fixedLabelNodeID      = parameterNode.GetAttribute('FixedLabelNodeID')
-    movingLabelNodeID     = parameterNode.GetAttribute('MovingLabelNodeID')
+    # Print to Slicer CLI
+    logging.info('Processing started')
+    with tracing(tracePath):
+      with traceSpan('CustomRegisterLogic.run', parameterNode=parameterNode.GetID()) as runSpan:
+        self.runRegistration(parameterNode)
 
-    fixedSimilarityLabel1NodeID      = parameterNode.GetAttribute('FixedSimilarityLabel1NodeID')
-    fixedSimilarityLabel2NodeID      = parameterNode.GetAttribute('FixedSimilarityLabel2NodeID')
-    fixedSimilarityLabel3NodeID      = parameterNode.GetAttribute('FixedSimilarityLabel3NodeID')
-    fixedSimilarityLabel4NodeID      = parameterNode.GetAttribute('FixedSimilarityLabel4NodeID')
+    # Print results to Slicer CLI
+    logging.info('Processing completed')
+    print('Overall Algorithm Time: % 0.1f seconds') % float(runSpan.elapsed)
 
-    movingSimilarityLabel1NodeID     = parameterNode.GetAttribute('MovingSimilarityLabel1NodeID')
-    movingSimilarityLabel2NodeID     = parameterNode.GetAttribute('MovingSimilarityLabel2NodeID')
-    movingSimilarityLabel3NodeID     = parameterNode.GetAttribute('MovingSimilarityLabel3NodeID')
-    movingSimilarityLabel4NodeID     = parameterNode.GetAttribute('MovingSimilarityLabel4NodeID')
+    return True
 
+  def similarityLabelPairs(self, parameterNode):
+    """ (fixed, moving) similarity label pairs: FixedSimilarityLabel<n>NodeID and MovingSimilarityLabel<n>NodeID for n = 1, 2, ...
+    """
+    similarityLabelPairs = []
+    while (parameterNode.GetAttribute('FixedSimilarityLabel%dNodeID' % (len(similarityLabelPairs)+1))
+           or parameterNode.GetAttribute('MovingSimilarityLabel%dNodeID' % (len(similarityLabelPairs)+1))):
+      labelNumber = len(similarityLabelPairs)+1
+      pair = []
+      for side in ('Fixed', 'Moving'):
+        attributeName = '%sSimilarityLabel%dNodeID' % (side, labelNumber)
+        nodeID = parameterNode.GetAttribute(attributeName)
+        if not nodeID:
+          raise ValueError('%s is not set, similarity labels must be given in fixed and moving pairs' % attributeName)
+        node = slicer.mrmlScene.GetNodeByID(nodeID)
+        if node is None:
+          raise ValueError('%s refers to %s, which is not in the scene' % (attributeName, nodeID))
+        pair.append(node)
+      similarityLabelPairs.append(tuple(pair))
+    return similarityLabelPairs
+
+  def runRegistration(self, parameterNode):
+    """ Registration and similarity experiment of run()
+    """
+    
+    fixedLabelNodeID      = parameterNode.GetAttribute('FixedLabelNodeID')
+    movingLabelNodeID     = parameterNode.GetAttribute('MovingLabelNodeID')
 
-    fixedSimilarityLabel1Node        = slicer.util.getNode( fixedSimilarityLabel1NodeID)
-    fixedSimilarityLabel2Node        = slicer.util.getNode( fixedSimilarityLabel2NodeID)
-    fixedSimilarityLabel3Node        = slicer.util.getNode( fixedSimilarityLabel3NodeID)
-    fixedSimilarityLabel4Node        = slicer.util.getNode( fixedSimilarityLabel4NodeID)
+    similarityLabelPairs = self.similarityLabelPairs(parameterNode)
 
-    movingSimilarityLabel1Node       = slicer.util.getNode(movingSimilarityLabel1NodeID)
-    movingSimilarityLabel2Node       = slicer.util.getNode(movingSimilarityLabel2NodeID)
-    movingSimilarityLabel3Node       = slicer.util.getNode(movingSimilarityLabel3NodeID)
-    movingSimilarityLabel4Node       = slicer.util.getNode(movingSimilarityLabel4NodeID)
-    
     affineTransformNode   = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('AffineTransformNodeID'))
     # bsplineTransformNode  = slicer.mrmlScene.GetNodeByID(parameterNode.GetAttribute('BSplineTransformNodeID'))
 
-    # Print to Slicer CLI
-    logging.info('Processing started')
-    start_time_overall = time.time() # start timer
-
     # crop the labels
     (bbMin,bbMax) = self.getBoundingBox(fixedLabelNodeID, movingLabelNodeID)
 
-    print("Before preprocessing")
+    # The preprocessed labels are cached by their content, the crop and the settings the smoothing actually runs with
+    cache = StageCache(self.cacheDirectory, self.cacheSizeLimit) if self.cacheDirectory else None
+    smoothingSettings = self.segmentationSmoothingSettings() if cache else None
 
-    fixedLabelDistanceMap = self.preProcessLabel(fixedLabelNodeID, bbMin, bbMax)
+    fixedLabelDistanceMap = self.preProcessLabel(fixedLabelNodeID, bbMin, bbMax, cache, smoothingSettings)
     parameterNode.SetAttribute('FixedLabelDistanceMapID',fixedLabelDistanceMap.GetID())
     fixedLabelSmoothed = slicer.util.getNode(slicer.mrmlScene.GetNodeByID(fixedLabelNodeID).GetName()+'-Smoothed')
     parameterNode.SetAttribute('FixedLabelSmoothedID',fixedLabelSmoothed.GetID())
-    print('Fixed label processing done')
 
-    movingLabelDistanceMap = self.preProcessLabel(movingLabelNodeID, bbMin, bbMax)
+    movingLabelDistanceMap = self.preProcessLabel(movingLabelNodeID, bbMin, bbMax, cache, smoothingSettings)
     parameterNode.SetAttribute('MovingLabelDistanceMapID',movingLabelDistanceMap.GetID())
     movingLabelSmoothed = slicer.util.getNode(slicer.mrmlScene.GetNodeByID(movingLabelNodeID).GetName()+'-Smoothed')
     parameterNode.SetAttribute('MovingLabelSmoothedID',movingLabelSmoothed.GetID())
-    print('Moving label processing done')
 
     # run affine registration
     registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useRigid':True,'useAffine':True,'numberOfSamples':'10000','costMetric':'MSE','outputTransform':affineTransformNode.GetID()}
-    slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
+    with traceSpan('AffineRegistration', 'Running Affine Registration', numberOfSamples=10000, costMetric='MSE'):
+      slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
     parameterNode.SetAttribute('AffineTransformNodeID',affineTransformNode.GetID())
-    print('affineRegistrationCompleted!')
 
     # run bspline registration (comment out for experiment)
     # registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':'3,3,3','numberOfSamples':'10000','costMetric':'MSE','bsplineTransform':bsplineTransformNode.GetID(),'initialTransform':affineTransformNode.GetID()}
@@ -495,79 +552,62 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     # print('bsplineRegistrationCompleted!')
 
     # Smooth fixed labels prior to looping over registration
-    self.LabelMapSmoothing(fixedSimilarityLabel1Node, fixedSimilarityLabel1Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel2Node, fixedSimilarityLabel2Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel3Node, fixedSimilarityLabel3Node, 0.4)
-    self.LabelMapSmoothing(fixedSimilarityLabel4Node, fixedSimilarityLabel4Node, 0.4)
+    for fixedSimilarityLabelNode, movingSimilarityLabelNode in similarityLabelPairs:
+      self.LabelMapSmoothing(fixedSimilarityLabelNode, fixedSimilarityLabelNode, 0.4)
 
     # Initialize Inputs to Experiment
     #=================================================#
     """ EDIT HERE TO CHANGE EXPERIMENTAL PARAMETERS """
     numSamplestoTry = [10000] # sample numbers to try
     numTrials = 1 # number of trials to run for each sample number
-    # names for the 4 similarity labels inputted to module:
+    # names for the similarity labels inputted to module (further labels are named after their moving label node):
     LabelTypes = ['registration-label','cg-label','vm-label','indexlesion-label'] 
+    LabelTypes = [LabelTypes[index] if index < len(LabelTypes) else moving.GetName() for index, (fixed, moving) in enumerate(similarityLabelPairs)]
     CSV_filename = 'numsamp_200_400_experiment_2trials.csv' # filename for CSV output similarity data (in directory Slicer is running)
     #=================================================#
 
     # Initialize Variables
     NumberofSamples  = ['Number of Samples']
     RegisterTimes    = ['Registration Time']
-    SimilarityLabel1 = ['Similarity of '+LabelTypes[0]]
-    SimilarityLabel2 = ['Similarity of '+LabelTypes[1]]
-    SimilarityLabel3 = ['Similarity of '+LabelTypes[2]]
-    SimilarityLabel4 = ['Similarity of '+LabelTypes[3]]
+    TimingMethods    = ['Registration Time Measured']
+    SimilarityLabels = [['Similarity of '+labelType] for labelType in LabelTypes]
+    JaccardLabels    = [['Jaccard of '+labelType] for labelType in LabelTypes]
+    VolumeDifferenceLabels = [['Volume difference (mm3) of '+labelType] for labelType in LabelTypes]
     Trial_Number     = ['Trial Number']
     
+    # The moving labels are blurred once, every registration only warps them
+    blurredSimilarityLabels = self.blurSimilarityLabels(similarityLabelPairs)
+
+    # Run the BSpline registrations of all trials
+    registrations, timing = self.runSampleSweep(fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode,
+                                                numSamplestoTry, numTrials, '3,3,3')
+
     # Loop for experiment
     for numSamp in numSamplestoTry:
-        for trial in range(0,numTrials):
-            trial_num = trial+1 # trial number
-
-            # Run first BSpline stage for registration
-            newTransformNode = self.CreateNewTransform(trial_num,numSamp)
-            register_time, DeformableTransformNode = self.bsplineRegisterNumSamp(fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSamp,'3,3,3')
-
-            # Apply transform to moving volume similarity nodes and compute similarity metric
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[0]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel1Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue1 = self.ComputeSimilarityMetric(fixedSimilarityLabel1Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[1]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel2Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue2 = self.ComputeSimilarityMetric(fixedSimilarityLabel2Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[2]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel3Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue3 = self.ComputeSimilarityMetric(fixedSimilarityLabel3Node, newVolumeNode)
-
-            newVolumeNode = self.CreateNewVolume(trial_num,numSamp,LabelTypes[3]) # create a new node to transform and compute similarity metric
-            self.LabelMapSmoothing(movingSimilarityLabel4Node, newVolumeNode, 0.4)
-            self.transformNodewithBspline(newVolumeNode, DeformableTransformNode)
-            self.processTransformedNode(newVolumeNode)
-            similarityValue4 = self.ComputeSimilarityMetric(fixedSimilarityLabel4Node, newVolumeNode)
-
-            # Append values to results variables
-            Trial_Number.append(trial_num)
-            NumberofSamples.append(numSamp)
-            SimilarityLabel1.append(similarityValue1)
-            SimilarityLabel2.append(similarityValue2)
-            SimilarityLabel3.append(similarityValue3)
-            SimilarityLabel4.append(similarityValue4)
-            RegisterTimes.append(register_time)
-
-            # Print status to CLI
-            print "\n\n===================="
-            print "Last event Completed..."
-            print "Trial Number: %i"  % trial_num
-            print "Sample Number: %i" % numSamp
-            print "====================\n\n"
+      for trial in range(0,numTrials):
+        trial_num = trial+1 # trial number
+        register_time, DeformableTransformNode = registrations[(numSamp, trial_num)]
+
+        # Apply transform to moving volume similarity labels and compare them with the fixed labels
+        similarityTable = self.evaluateSimilarity(similarityLabelPairs, DeformableTransformNode, blurredGroups=blurredSimilarityLabels)
+
+        # Append values to results variables
+        Trial_Number.append(trial_num)
+        NumberofSamples.append(numSamp)
+        for row, SimilarityLabel, JaccardLabel, VolumeDifferenceLabel in zip(similarityTable, SimilarityLabels,
+                                                                             JaccardLabels, VolumeDifferenceLabels):
+          SimilarityLabel.append(row['dice'])
+          JaccardLabel.append(row['jaccard'])
+          VolumeDifferenceLabel.append(row['volumeDifference'])
+        RegisterTimes.append(register_time)
+        TimingMethods.append(timing)
+
+        # Print status to CLI
+        print "\n\n===================="
+        print "Last event Completed..."
+        print "Trial Number: %i"  % trial_num
+        print "Sample Number: %i" % numSamp
+        print "====================\n\n"
             
 
     # Print variables to Slicer CLI after all trials done
@@ -578,27 +618,19 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     print "Reg. Times",
     print RegisterTimes
     print "Similarity Values",
-    print SimilarityLabel1
-    print SimilarityLabel2
-    print SimilarityLabel3
-    print SimilarityLabel4
-
-    # Write results to CSV file
-    self.WriteCSVResults(CSV_filename,Trial_Number,NumberofSamples,RegisterTimes,SimilarityLabel1,SimilarityLabel2,SimilarityLabel3,SimilarityLabel4)
+    for SimilarityLabel in SimilarityLabels + JaccardLabels + VolumeDifferenceLabels:
+      print SimilarityLabel
 
-    # Print results to Slicer CLI
-    end_time_overall = time.time()
-    logging.info('Processing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time_overall-start_time_overall)
+    # Write results to CSV file: the Jaccard, volume difference and timing rows follow the original rows, which keep their positions
+    self.WriteCSVResults(CSV_filename,Trial_Number,NumberofSamples,RegisterTimes,
+                         *(SimilarityLabels+JaccardLabels+VolumeDifferenceLabels+[TimingMethods]))
 
-    return True
-
-  def WriteCSVResults(self, CSVFilename, Trial_Number, independentVariable,RegisterTimes,SimilarityLabel1,SimilarityLabel2,SimilarityLabel3,SimilarityLabel4):
-    # Writes registration experiment results to CSV
+  def WriteCSVResults(self, CSVFilename, Trial_Number, independentVariable,RegisterTimes,*SimilarityLabels):
+    # Writes registration experiment results to CSV, one row per variable (the first value of each being its name)
     import csv
     results = []
-    for trial_number, indVar, registerTime, sim1, sim2, sim3, sim4 in zip(Trial_Number, independentVariable, RegisterTimes, SimilarityLabel1,SimilarityLabel2,SimilarityLabel3,SimilarityLabel4):
-        results.append([trial_number, indVar, registerTime, sim1, sim2, sim3, sim4]) # create results variable
+    for values in zip(Trial_Number, independentVariable, RegisterTimes, *SimilarityLabels):
+        results.append(list(values)) # create results variable
 
     # Write CSV file from results variable
     with open(CSVFilename, 'wb') as test_file:
@@ -617,90 +649,153 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return transformNode
 
-  def CreateNewVolume(self, trial_num, numSamp, labelType):
-    imageSize=[64, 64, 64]
-    imageSpacing=[1.0, 1.0, 1.0]
-    voxelType=vtk.VTK_UNSIGNED_CHAR
-    # Create an empty image volume
-    imageData=vtk.vtkImageData()
-    imageData.SetDimensions(imageSize)
-    imageData.AllocateScalars(voxelType, 1)
-    thresholder=vtk.vtkImageThreshold()
-    thresholder.SetInputData(imageData)
-    thresholder.SetInValue(0)
-    thresholder.SetOutValue(0)
-    # Create volume node
-    volumeNode=slicer.vtkMRMLScalarVolumeNode()
-    volumeNode.SetSpacing(imageSpacing)
-    volumeNode.SetImageDataConnection(thresholder.GetOutputPort())
-    # Add volume to scene
-    slicer.mrmlScene.AddNode(volumeNode)
-    displayNode=slicer.vtkMRMLScalarVolumeDisplayNode()
-    slicer.mrmlScene.AddNode(displayNode)
-    colorNode = slicer.util.getNode('Grey')
-    displayNode.SetAndObserveColorNodeID(colorNode.GetID())
-    volumeNode.SetAndObserveDisplayNodeID(displayNode.GetID())
-    volumeNode.CreateDefaultStorageNode()
-    # name volume
-    volume_name = str(labelType)+'_trial_'+str(trial_num)+'_nsamp_'+str(numSamp)
-    volumeNode.SetName(volume_name)
-
-    return volumeNode
-
-  def bsplineRegisterNumSamp(self,fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSampInput,splineGridSizeInput):
-    """ Performs bspline registration for inputted nodes with inputted number of samples
+  def bsplineRegisterNumSamp(self,fixedLabelDistanceMap,movingLabelDistanceMap,newTransformNode,affineTransformNode,numSampInput,splineGridSizeInput,
+                             numberOfThreads=None,onCompletion=None):
+    """ Performs bspline registration for inputted nodes with inputted number of samples. numberOfThreads limits the
+    ITK threads of BRAINSFit. Inside a PipelineScheduler stage the registration is only started: the time is None and
+    onCompletion(registerTime) is called once it is done
     """
-    # Print to Slicer CLI
-    print('Running BSpline Registration...'),
-    start_time = time.time()
-
     registrationParameters = {'fixedVolume':fixedLabelDistanceMap.GetID(), 'movingVolume':movingLabelDistanceMap.GetID(),'useBSpline':True,'splineGridSize':str(splineGridSizeInput),'numberOfSamples':str(numSampInput),'costMetric':'MSE','bsplineTransform':newTransformNode.GetID(),'initialTransform':affineTransformNode.GetID()}
-    slicer.cli.run(slicer.modules.brainsfit, None, registrationParameters, wait_for_completion=True)
-    print('bsplineRegistrationCompleted!'),
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print(('(%0.2f s)')) % float(end_time-start_time)
-
-    return float(end_time-start_time), newTransformNode
+    if numberOfThreads:
+      registrationParameters['numberOfThreads'] = int(numberOfThreads)
 
-  def transformNodewithBspline(self, movingSimilarityLabel, BSPLINETransform):
-    # tranform input node using bspline transform from registration
-    movingSimilarityLabel.SetAndObserveTransformNodeID(BSPLINETransform.GetID())
-    slicer.vtkSlicerTransformLogic().hardenTransform(movingSimilarityLabel) # hardens transform
+    registerTime = []
+    def registrationDone():
+      registerTime.append(time.time()-startTime)
+      if onCompletion:
+        onCompletion(registerTime[0])
 
-  def processTransformedNode(self, inputNode):
-    # threshold and smooth an input node
-    self.ThresholdScalarVolume(inputNode, 20) # set to label value of 20
-    self.LabelMapSmoothing(inputNode, inputNode, 0.3)
+    with traceSpan('CustomRegisterLogic.bsplineRegisterNumSamp', 'Running BSpline Registration', numberOfSamples=numSampInput,
+                   splineGridSize=str(splineGridSizeInput), bsplineTransform=newTransformNode.GetID(), numberOfThreads=numberOfThreads):
+      startTime = time.time()
+      runCLI(slicer.modules.brainsfit, registrationParameters, registrationDone) # only launches BRAINSFit inside a stage
 
-  def ComputeSimilarityMetric(self, volumeA, volumeB):
-    # Computes the similarity metric for the labels chosen by thew widget
+    return (registerTime[0] if registerTime else None), newTransformNode
 
-    # Print to Slicer CLI
-    print('Computing Similarity Metric...'),
-    start_time = time.time()
-
-    import SimpleITK as sitk
-    import sitkUtils
+  def runSampleSweep(self, fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode, numSamplestoTry, numTrials, splineGridSize):
+    """ Runs the BSpline registration of every (number of samples, trial), one at a time unless maxConcurrentJobs > 1.
+    Returns {(numSamp, trial_num): (register_time, transformNode)} and how the times were measured
+    """
+    threadsPerJob = self.threadsPerJob or multiprocessing.cpu_count()
+    maxConcurrentJobs = max(1, self.maxConcurrentJobs or 1)
 
-    A_img  = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress( volumeA.GetName()))
-    B_img = sitk.ReadImage(sitkUtils.GetSlicerITKReadWriteAddress(  volumeB.GetName()))
-    similarity_filter = sitk.SimilarityIndexImageFilter()
-    similarity_filter.Execute(A_img, B_img)
+    registrations = {}
+    jobs = []
+    for numSamp in numSamplestoTry:
+      for trial in range(0,numTrials):
+        trial_num = trial+1
+        jobs.append((numSamp, trial_num, self.CreateNewTransform(trial_num,numSamp)))
+
+    with traceSpan('CustomRegisterLogic.runSampleSweep', 'Running BSpline Registrations', jobs=len(jobs),
+                   maxConcurrentJobs=maxConcurrentJobs, threadsPerJob=threadsPerJob):
+      if maxConcurrentJobs == 1:
+        for numSamp, trial_num, transformNode in jobs:
+          registrations[(numSamp, trial_num)] = self.bsplineRegisterNumSamp(fixedLabelDistanceMap, movingLabelDistanceMap, transformNode,
+                                                                            affineTransformNode, numSamp, splineGridSize, threadsPerJob)
+        timing = 'alone, %d threads' % threadsPerJob
+      else:
+        stages = [self.registrationJobStage(fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode, transformNode,
+                                            numSamp, trial_num, splineGridSize, threadsPerJob, registrations)
+                  for numSamp, trial_num, transformNode in jobs]
+        PipelineScheduler(maxConcurrentJobs).execute(stages, {})
+        timing = 'up to %d at a time, %d threads each, launch to completion' % (maxConcurrentJobs, threadsPerJob)
+
+    return registrations, timing
+
+  def registrationJobStage(self, fixedLabelDistanceMap, movingLabelDistanceMap, affineTransformNode, transformNode,
+                           numSamp, trial_num, splineGridSize, threadsPerJob, registrations):
+    """ Pipeline stage of one sweep job. The time of the registration is stored in registrations when BRAINSFit is done
+    """
+    def registrationDone(register_time):
+      registrations[(numSamp, trial_num)] = (register_time, transformNode)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    def launch():
+      self.bsplineRegisterNumSamp(fixedLabelDistanceMap, movingLabelDistanceMap, transformNode, affineTransformNode,
+                                  numSamp, splineGridSize, threadsPerJob, registrationDone)
 
-    return similarity_filter.GetSimilarityIndex()
+    return PipelineStage(transformNode.GetName(), [], {transformNode.GetName(): transformNode}, launch,
+                         parameters={'numberOfSamples': numSamp, 'trial': trial_num, 'numberOfThreads': threadsPerJob})
 
+  @traced('Evaluating similarity')
+  def evaluateSimilarity(self, labelPairs, transformNode, sigma=0.4, blurredGroups=None):
+    """ Warps the moving labels of labelPairs through transformNode and compares them with their fixed labels. Returns
+    a row per pair with the names, dice, jaccard, volumeDifference (mm3) and voxel counts
+    """
+    if blurredGroups is None:
+      blurredGroups = self.blurSimilarityLabels(labelPairs, sigma)
+
+    table = [None]*len(labelPairs)
+    for group, blurred, box in blurredGroups:
+      groupFixedLabel = labelPairs[group[0]][0]
+      warpedMasks = self.warpLabels([labelPairs[index][1] for index in group], groupFixedLabel, transformNode, blurredLabels=(blurred, box))
+      fixedBits = numpy.zeros(warpedMasks.shape[:3], numpy.uint8)
+      movingBits = numpy.zeros(warpedMasks.shape[:3], numpy.uint8)
+      for bit, index in enumerate(group):
+        fixedBits |= (arrayFromVolume(labelPairs[index][0]) != 0).astype(numpy.uint8) << bit
+        movingBits |= warpedMasks[..., bit].astype(numpy.uint8) << bit
+
+      spacing = groupFixedLabel.GetSpacing()
+      for index, agreement in zip(group, labelAgreements(fixedBits, movingBits, len(group), spacing[0]*spacing[1]*spacing[2])):
+        agreement.update(fixed=labelPairs[index][0].GetName(), moving=labelPairs[index][1].GetName())
+        table[index] = agreement
+    return table
+
+  @traced('Blurring similarity labels')
+  def blurSimilarityLabels(self, labelPairs, sigma=0.4):
+    """ Groups the (fixed label, moving label) pairs whose fixed labels and whose moving labels share a grid (up to 8 per
+    group) and blurs the moving labels of every group (blurLabels). Returns a list of (pair indices, blurred, box)
+    """
+    groups = []
+    for index, (fixedLabel, movingLabel) in enumerate(labelPairs):
+      for group in groups:
+        groupFixedLabel, groupMovingLabel = labelPairs[group[0]]
+        if len(group) < 8 and sameVolumeGeometry(groupFixedLabel, fixedLabel) and sameVolumeGeometry(groupMovingLabel, movingLabel):
+          group.append(index)
+          break
+      else:
+        groups.append([index])
+    return [(group,) + self.blurLabels([labelPairs[index][1] for index in group], sigma) for group in groups]
+
+  def blurLabels(self, movingLabels, sigma=0.4):
+    """ Blurs labels on one grid into the components of a float image of the box around them. Returns the [k,j,i,label]
+    array and the box, or (None, None) if the labels are empty
+    """
+    spacing = movingLabels[0].GetSpacing()
+    sigmas = [sigma/abs(spacing[2-axis]) for axis in range(3)] # in voxels, k, j, i order
+
+    labelMask = numpy.zeros(arrayFromVolume(movingLabels[0]).shape, dtype=bool)
+    for movingLabel in movingLabels:
+      labelMask |= arrayFromVolume(movingLabel) != 0
+    box = labelBoundingBox(labelMask, None, [int(math.ceil(3*sigmas[2-axis]))+1 for axis in range(3)])
+    if box is None:
+      return None, None
+
+    blurred = numpy.empty(labelMask[box].shape+(len(movingLabels),), dtype=numpy.float32)
+    for component, movingLabel in enumerate(movingLabels):
+      blurred[..., component] = gaussianSmoothArray(arrayFromVolume(movingLabel)[box] != 0, sigmas)
+    return blurred, box
+
+  @traced('Warping labels')
+  def warpLabels(self, movingLabels, referenceVolume, transformNode, sigma=0.4, blurredLabels=None):
+    """ Warps labels on one grid through transformNode onto referenceVolume in a single linear resample. Returns the
+    [k,j,i,label] masks
+    """
+    blurred, box = blurredLabels or self.blurLabels(movingLabels, sigma)
+    if box is None:
+      referenceDimensions = referenceVolume.GetImageData().GetDimensions()
+      return numpy.zeros((referenceDimensions[2], referenceDimensions[1], referenceDimensions[0], len(movingLabels)), dtype=bool)
+    warped = resliceArray(blurred, movingLabels[0], referenceVolume, transformNode, linear=True, offset=[axisBox.start for axisBox in box])
+    return warped > 0.5
+
+  @traced('Additional Label Map Smoothing')
   def LabelMapSmoothing(self, inputVolume, outputVolume, Sigma, *labelNumber):
     """ Smooths an input volume labelmap using value of sigma provided (number from 0-5). Optionally smooths only selected labels if more arguments passed
     """
-    # Print to Slicer CLI
-    print('Additional Label Map Smoothing...'),
-    start_time = time.time()
+    if not self.useCLI and self.hasImageData(inputVolume):
+        smoothed = smoothLabelArray(arrayFromVolume(inputVolume), inputVolume.GetSpacing(), Sigma, labelNumber or None)
+        allocateVolumeLike(inputVolume, outputVolume)[:] = smoothed
+        arrayFromVolumeModified(outputVolume)
+        return
 
     # Run the slicer module in CLI
     cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': outputVolume.GetID(), 'gaussianSigma': Sigma} # input and output defined as same
@@ -708,26 +803,6 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
         cliParams["labelToSmooth"] = labelNumber
 
     cliNode = slicer.cli.run(slicer.modules.labelmapsmoothing, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-
-  def ThresholdScalarVolume(self, inputVolume, newLabelVal):
-    """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
-    """
-    # Print to Slicer CLI
-    print('Changing Label Value...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
 
   def showResults(self,parameterNode):
     # duplicate moving volume
@@ -810,6 +885,7 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return
 
+  @traced()
   def getBoundingBox(self,fixedLabelNodeID,movingLabelNodeID):
 
     ls = sitk.LabelStatisticsImageFilter()
@@ -817,11 +893,8 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
     fixedLabelNode = slicer.mrmlScene.GetNodeByID(fixedLabelNodeID)
     movingLabelNode = slicer.mrmlScene.GetNodeByID(movingLabelNodeID)
 
-    fixedLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(fixedLabelNode.GetName())
-    movingLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(movingLabelNode.GetName())
-
-    fixedLabelImage = sitk.ReadImage(fixedLabelAddress)
-    movingLabelImage = sitk.ReadImage(movingLabelAddress)
+    fixedLabelImage = imageFromVolume(fixedLabelNode, view=True) # only used for the union below
+    movingLabelImage = imageFromVolume(movingLabelNode, view=True)
 
     cast = sitk.CastImageFilter()
     cast.SetOutputPixelType(2)
@@ -838,20 +911,46 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     return (bbMin,bbMax)
 
-  def preProcessLabel(self,labelNodeID,bbMin,bbMax):
-
-    # Start the timer
-    start_time = time.time()
+  def segmentationSmoothingSettings(self):
+    """ Returns the version and parameters (other than the volumes) the segmentationsmoothing CLI runs with
+    """
+    cliNode = slicer.cli.createNode(slicer.modules.segmentationsmoothing, self.smoothingParameters)
+    settings = {'moduleVersion': cliNode.GetModuleVersion()}
+    for group in range(cliNode.GetNumberOfParameterGroups()):
+      for index in range(cliNode.GetNumberOfParametersInGroup(group)):
+        name = cliNode.GetParameterName(group, index)
+        if name not in ('inputImageName', 'outputImageName'):
+          settings[name] = cliNode.GetParameterAsString(name)
+    slicer.mrmlScene.RemoveNode(cliNode)
+    return settings
+
+  @traced('Preprocessing label')
+  def preProcessLabel(self,labelNodeID,bbMin,bbMax,cache=None,smoothingSettings=None):
+    """ Crops and smooths a label and computes its distance map. With a StageCache the cropped and smoothed label and
+    the distance map are looked up by the content of the label, the crop and the smoothingSettings first
+    """
 
     print('Label node ID: '+labelNodeID)
 
     labelNode = slicer.util.getNode(labelNodeID)
+    croppedLabelName = labelNode.GetName()+'-Cropped'
+    smoothLabelName = labelNode.GetName()+'-Smoothed'
+    distanceMapName = labelNode.GetName()+'-DistanceMap'
 
-    labelNodeAddress = sitkUtils.GetSlicerITKReadWriteAddress(labelNode.GetName())
-
-    print('Label node address: '+str(labelNodeAddress))
-
-    labelImage = sitk.ReadImage(labelNodeAddress)
+    if cache:
+      stage = PipelineStage('CustomRegister.preProcessLabel', ['label'],
+                            {'cropped': self.createVolumeNode(croppedLabelName), 'smoothed': self.createVolumeNode(smoothLabelName),
+                             'distanceMap': self.createVolumeNode(distanceMapName)}, None,
+                            parameters={'bbMin': [int(size) for size in bbMin], 'bbMax': [int(size) for size in bbMax],
+                                        'smoothing': sorted((smoothingSettings or self.segmentationSmoothingSettings()).items()),
+                                        'squaredDistance': False})
+      cacheKey = cache.key(stage, {'label': labelNode})
+      outputs = cache.load(cacheKey, stage)
+      if outputs is not None:
+        print('Preprocessed label loaded from cache')
+        return outputs['distanceMap']
+
+    labelImage = imageFromVolume(labelNode, view=True) # only used for the crop below
 
     print('Read image: '+str(labelImage))
 
@@ -862,19 +961,15 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     print('Cropped image done: '+str(croppedImage))
 
-    croppedLabelName = labelNode.GetName()+'-Cropped'
-    sitkUtils.PushToSlicer(croppedImage,croppedLabelName,overwrite=True)
+    croppedLabel = updateVolumeFromImage(croppedImage, self.createVolumeNode(croppedLabelName))
     print('Cropped volume pushed')
 
-    croppedLabel = slicer.util.getNode(croppedLabelName)
-
     print('Smoothed image done')
 
-    smoothLabelName = labelNode.GetName()+'-Smoothed'
     smoothLabel = self.createVolumeNode(smoothLabelName)
 
     # smooth the labels
-    smoothingParameters = {'inputImageName':croppedLabel.GetID(), 'outputImageName':smoothLabel.GetID()}
+    smoothingParameters = dict(self.smoothingParameters, inputImageName=croppedLabel.GetID(), outputImageName=smoothLabel.GetID())
     print(str(smoothingParameters))
     cliNode = slicer.cli.run(slicer.modules.segmentationsmoothing, None, smoothingParameters, wait_for_completion = True)
 
@@ -888,26 +983,27 @@ class CustomRegisterLogic(ScriptedLoadableModuleLogic):
 
     dt = sitk.SignedMaurerDistanceMapImageFilter()
     dt.SetSquaredDistance(False)
-    distanceMapName = labelNode.GetName()+'-DistanceMap'
     print('Reading smoothed image: '+smoothLabel.GetID())
-    smoothLabelAddress = sitkUtils.GetSlicerITKReadWriteAddress(smoothLabel.GetName())    
-    smoothLabelImage = sitk.ReadImage(smoothLabelAddress)
-    print(smoothLabelAddress)
-    distanceImage = dt.Execute(smoothLabelImage)
-    sitkUtils.PushToSlicer(distanceImage, distanceMapName, overwrite=True)
+    distanceImage = dt.Execute(imageFromVolume(smoothLabel, view=True))
+    distanceMap = updateVolumeFromImage(distanceImage, self.createVolumeNode(distanceMapName))
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('Label preprocessing done (%0.2f s)') % float(end_time-start_time)
+    if cache:
+      cache.store(cacheKey, stage, {'cropped': croppedLabel, 'smoothed': smoothLabel, 'distanceMap': distanceMap})
 
-    return slicer.util.getNode(distanceMapName)
+    return distanceMap
 
   def createVolumeNode(self,name):
-    import sitkUtils
-    node = sitkUtils.CreateNewVolumeNode(name,overwrite=True)
-    storageNode = slicer.vtkMRMLNRRDStorageNode()
-    slicer.mrmlScene.AddNode(storageNode)
-    node.SetAndObserveStorageNodeID(storageNode.GetID())
+    """ Returns the scalar volume node called name, adding it to the scene if there is none
+    """
+    node = slicer.mrmlScene.GetFirstNodeByName(name)
+    if node is None or not node.IsA('vtkMRMLScalarVolumeNode'):
+      node = slicer.vtkMRMLScalarVolumeNode()
+      node.SetName(name)
+      slicer.mrmlScene.AddNode(node)
+    if node.GetStorageNode() is None:
+      storageNode = slicer.vtkMRMLNRRDStorageNode()
+      slicer.mrmlScene.AddNode(storageNode)
+      node.SetAndObserveStorageNodeID(storageNode.GetID())
     return node
 
 class CustomRegisterTest(ScriptedLoadableModuleTest):
@@ -927,6 +1023,12 @@ class CustomRegisterTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_CustomRegister1()
+    self.setUp()
+    self.test_EvaluateSimilarity()
+    self.setUp()
+    self.test_WarpLabels()
+    self.setUp()
+    self.test_SimilarityLabelPairs()
 
   def test_CustomRegister1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -971,3 +1073,99 @@ class CustomRegisterTest(ScriptedLoadableModuleTest):
      * add main() so that registration could be run from command line
 
     '''
+
+  def createLabelVolume(self, name, voxels):
+    """ Creates a labelmap node in the scene holding the given [k,j,i] voxel values
+    """
+    voxels = numpy.array(voxels, dtype=numpy.uint8)
+    labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+    labelNode.SetName(name)
+    slicer.mrmlScene.AddNode(labelNode)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    labelNode.SetAndObserveImageData(imageData)
+    arrayFromVolume(labelNode)[:] = voxels
+    arrayFromVolumeModified(labelNode)
+    return labelNode
+
+  def createTranslation(self, name, translation):
+    """ Creates a linear transform node that moves (transform to parent) by the RAS translation
+    """
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(3):
+      matrix.SetElement(row, 3, translation[row])
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    transformNode.SetName(name)
+    slicer.mrmlScene.AddNode(transformNode)
+    transformNode.SetMatrixTransformToParent(matrix)
+    return transformNode
+
+  def test_EvaluateSimilarity(self):
+    """ The similarity of moving labels registered by a translation onto their fixed labels
+    """
+    self.delayDisplay("Starting the similarity test")
+    logic = CustomRegisterLogic()
+
+    cubes = {}
+    for name, start in (('fixedA', 5), ('movingA', 2), ('fixedB', 4), ('movingB', 2)):
+      voxels = numpy.zeros((8, 8, 12))
+      voxels[2:6, 2:6, start:start+4] = 1
+      cubes[name] = self.createLabelVolume(name, voxels)
+    transformNode = self.createTranslation('translation', (3, 0, 0))
+
+    table = logic.evaluateSimilarity([(cubes['fixedA'], cubes['movingA']), (cubes['fixedB'], cubes['movingB'])], transformNode)
+    self.assertEqual([(row['fixed'], row['moving']) for row in table], [('fixedA', 'movingA'), ('fixedB', 'movingB')])
+    self.assertEqual(table[0]['dice'], 1.0) # movingA lands on fixedA
+    self.assertEqual(table[1]['dice'], 0.75) # movingB lands one voxel past fixedB
+    self.assertEqual(table[1]['jaccard'], 0.6)
+    self.assertEqual(table[1]['volumeDifference'], 0.0)
+
+    table = logic.evaluateSimilarity([(cubes['fixedA'], cubes['fixedA'])], self.createTranslation('identity', (0, 0, 0)))
+    self.assertEqual(table[0]['dice'], 1.0)
+    self.delayDisplay('Test passed!')
+
+  def test_WarpLabels(self):
+    """ Warping a cube label through a translation moves the cube, also with labels blurred once beforehand
+    """
+    self.delayDisplay("Starting the label warping test")
+    logic = CustomRegisterLogic()
+
+    voxels = numpy.zeros((10, 10, 16))
+    voxels[3:7, 3:7, 2:6] = 1
+    cube = self.createLabelVolume('cube', voxels)
+    empty = self.createLabelVolume('empty', numpy.zeros((10, 10, 16)))
+    reference = self.createLabelVolume('reference', numpy.zeros((10, 10, 16)))
+    transformNode = self.createTranslation('translation', (5, 0, 0))
+
+    expected = numpy.zeros((10, 10, 16), dtype=bool)
+    expected[3:7, 3:7, 7:11] = True
+    warped = logic.warpLabels([cube, empty], reference, transformNode)
+    self.assertEqual(warped.shape, (10, 10, 16, 2))
+    self.assertEqual(warped[..., 0].tolist(), expected.tolist())
+    self.assertFalse(warped[..., 1].any())
+
+    blurredLabels = logic.blurLabels([cube])
+    self.assertEqual(logic.warpLabels([cube], reference, transformNode, blurredLabels=blurredLabels)[..., 0].tolist(), expected.tolist())
+    self.assertEqual(logic.blurLabels([empty]), (None, None))
+    self.delayDisplay('Test passed!')
+
+  def test_SimilarityLabelPairs(self):
+    """ Similarity labels are read in fixed and moving pairs, and a half pair or a missing node is an error
+    """
+    self.delayDisplay("Starting the similarity label pairs test")
+    logic = CustomRegisterLogic()
+    labels = [self.createLabelVolume(name, [[[1]]]) for name in ('fixed1', 'moving1', 'fixed2')]
+    parameterNode = slicer.vtkMRMLScriptedModuleNode()
+    slicer.mrmlScene.AddNode(parameterNode)
+    parameterNode.SetAttribute('FixedSimilarityLabel1NodeID', labels[0].GetID())
+    parameterNode.SetAttribute('MovingSimilarityLabel1NodeID', labels[1].GetID())
+    self.assertEqual(logic.similarityLabelPairs(parameterNode), [(labels[0], labels[1])])
+
+    parameterNode.SetAttribute('FixedSimilarityLabel2NodeID', labels[2].GetID())
+    with self.assertRaisesRegexp(ValueError, 'MovingSimilarityLabel2NodeID is not set'):
+      logic.similarityLabelPairs(parameterNode)
+    parameterNode.SetAttribute('MovingSimilarityLabel2NodeID', 'vtkMRMLLabelMapVolumeNodeMissing')
+    with self.assertRaisesRegexp(ValueError, 'not in the scene'):
+      logic.similarityLabelPairs(parameterNode)
+    self.delayDisplay('Test passed!')
@@ -3,7 +3,26 @@ import unittest
 from __main__ import vtk, qt, ctk, slicer
 from slicer.ScriptedLoadableModule import *
 import logging
+import math
 import time # for measuring time of processing steps
+import json
+import shutil
+import struct
+import zlib
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
+from vtk.util import numpy_support
+from RegistrationWorkflowLib.volumes import arrayFromVolume, arrayFromVolumeModified, allocateVolumeLike, sameVolumeGeometry, registrationLabelArray
+from RegistrationWorkflowLib.volumes import labelBoundingBox, labelBounds, gaussianSmoothArray, smoothLabelArray, labelHausdorffDistance
+from RegistrationWorkflowLib.volumes import labelAgreement, labelAgreements, resliceArray
+from RegistrationWorkflowLib.tracer import tracing, traceSpan, traced
+from RegistrationWorkflowLib.memory import SceneMemoryMonitor
+from RegistrationWorkflowLib.pipeline import runCLI, deferringCLILaunches, PipelineStage, PipelineScheduler
+from RegistrationWorkflowLib.cache import StageCache, StageCheckpoint
+from RegistrationWorkflowLib.images import imageFromVolume, updateVolumeFromImage
+from RegistrationWorkflowLib.files import inputRoot, inputFileSpecs, inputNodeName, readFileHeader, readVolumeVoxels, readInputFile
+from RegistrationWorkflowLib.files import validationErrors, writeNrrd, DecompressedInputCache, WriteBehindSaver
 
 
 def numericInputFrame(parent, label, tooltip, minimum, maximum, step, decimals):
@@ -75,11 +94,40 @@ class PreProcessWidget(ScriptedLoadableModuleWidget):
     PatientNumberMethodFormLayout = qt.QFormLayout(PatientNumberMethodFrame)
     PatientNumberIterationsFrame, self.PatientNumberIterationsSpinBox = numericInputFrame(self.parent,"Patient Number:","Tooltip",56,110,1,0)
     PatientNumberMethodFormLayout.addWidget(PatientNumberIterationsFrame)
+    ConcurrentStagesFrame, self.ConcurrentStagesSpinBox = numericInputFrame(self.parent,"Concurrent Stages:",
+                                                                            "Number of processing stages (CLI modules) run at the same time",1,8,1,0)
+    self.ConcurrentStagesSpinBox.value = 2
+    PatientNumberMethodFormLayout.addWidget(ConcurrentStagesFrame)
 
     self.SaveDataCheckBox = qt.QCheckBox("Save Results to Disk")
     self.SaveDataCheckBox.checked = False
     parametersFormLayout.addWidget(self.SaveDataCheckBox)
 
+    self.UseCacheCheckBox = qt.QCheckBox("Reuse Cached Results")
+    self.UseCacheCheckBox.toolTip = "Load the results of processing stages whose inputs and parameters did not change from the cache"
+    self.UseCacheCheckBox.checked = True
+    parametersFormLayout.addWidget(self.UseCacheCheckBox)
+
+    self.UseInputCacheCheckBox = qt.QCheckBox("Cache Decompressed Inputs")
+    self.UseInputCacheCheckBox.toolTip = ("Keep uncompressed copies of the input volumes in PreProcessInputCache in the Slicer temporary directory, "
+                                          "so that later runs map them instead of decompressing the inputs again")
+    self.UseInputCacheCheckBox.checked = False
+    parametersFormLayout.addWidget(self.UseInputCacheCheckBox)
+    InputCacheSizeFrame, self.InputCacheSizeSpinBox = numericInputFrame(self.parent,"Input Cache Size Limit (GB):",
+        "Once the decompressed inputs take more space, the least recently used ones are deleted",1,1000,1,0)
+    self.InputCacheSizeSpinBox.value = 10
+    parametersFormLayout.addWidget(InputCacheSizeFrame)
+
+    self.MonitorMemoryCheckBox = qt.QCheckBox("Report Memory Usage")
+    self.MonitorMemoryCheckBox.toolTip = "Print the memory use of every processing stage and the nodes the run leaves in the scene"
+    self.MonitorMemoryCheckBox.checked = False
+    parametersFormLayout.addWidget(self.MonitorMemoryCheckBox)
+
+    self.ResumeCheckBox = qt.QCheckBox("Resume Previous Run")
+    self.ResumeCheckBox.toolTip = "Restore the stages a previous run of this patient completed instead of starting over"
+    self.ResumeCheckBox.checked = False
+    parametersFormLayout.addWidget(self.ResumeCheckBox)
+
     # Apply Button
     #
     self.applyButton = qt.QPushButton("Apply")
@@ -104,7 +152,21 @@ class PreProcessWidget(ScriptedLoadableModuleWidget):
 
   def onApplyButton(self):
     logic = PreProcessLogic()
-    logic.run(str(int(self.PatientNumberIterationsSpinBox.value)), self.SaveDataCheckBox.checked)
+    if self.UseCacheCheckBox.checked:
+      logic.cacheDirectory = os.path.join(slicer.app.temporaryPath, 'PreProcessCache')
+    if self.UseInputCacheCheckBox.checked:
+      logic.inputCacheDirectory = os.path.join(slicer.app.temporaryPath, 'PreProcessInputCache')
+      logic.inputCacheSizeLimit = int(self.InputCacheSizeSpinBox.value)*1024**3
+    logic.workingDirectory = os.path.join(slicer.app.temporaryPath, 'PreProcessCheckpoints')
+    logic.traceDirectory = os.path.join(slicer.app.temporaryPath, 'PreProcessTraces')
+    logic.monitorMemory = self.MonitorMemoryCheckBox.checked
+    try:
+      logic.run(str(int(self.PatientNumberIterationsSpinBox.value)), self.SaveDataCheckBox.checked, int(self.ConcurrentStagesSpinBox.value),
+                self.ResumeCheckBox.checked)
+    finally:
+      # Files queued before a failure are still written, and the saver threads are stopped
+      if not logic.waitForPendingWrites():
+        slicer.util.errorDisplay('Not all results could be saved, see the Python console for the files that failed')
 # PreProcessLogic
 #
 
@@ -118,6 +180,24 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
   https://github.com/Slicer/Slicer/blob/master/Base/Python/slicer/ScriptedLoadableModule.py
   """
 
+  def __init__(self, parent=None, useCLI=False):
+    ScriptedLoadableModuleLogic.__init__(self, parent)
+    self.useCLI = useCLI # True runs label operations through the Slicer CLI modules instead of on the voxel arrays
+    self.cacheDirectory = None # directory of the StageCache for the results of the processing stages (None disables caching)
+    self.cacheSizeLimit = 20*1024**3 # bytes
+    self.inputCacheDirectory = None # directory of the DecompressedInputCache of the input volumes (None decompresses them every run)
+    self.inputCacheSizeLimit = 10*1024**3 # bytes
+    self.roiMargin = 10.0 # mm around the labels that the smoothing steps process (the rest of the volume is not smoothed)
+    self.monitorMemory = False # True reports the memory use of every stage and the nodes a run leaves in the scene
+    self.traceDirectory = None # a Chrome trace of every run is written to this directory (None disables the trace files)
+    self.workingDirectory = None # stage outputs are checkpointed to workingDirectory/Patient<number> (None disables checkpoints)
+    self.writeBehind = True # saving only snapshots the results, the files are written in the background until run ends
+    self.compressionLevel = 6 # gzip level of the saved NRRD files (0 writes them uncompressed)
+    self.saver = None # WriteBehindSaver, created by the first save
+    self.validationReport = None # report of the last validateInputs
+    self.deepValidation = False # True also checks the label values and model positions of the inputs (reads them fully)
+    self.transferMRLabels = False # True moves the MR VM and index lesion labels onto ARFI with transferLabels instead of through models
+
   def hasImageData(self,volumeNode):
     """This is an example logic method that
     returns true if the passed in volume
@@ -131,50 +211,126 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
       return False
     return True
 
-  def isValidUltrasoundData(self, VolumeNode1, VolumeNode2, VolumeNode3, ModelNode1, ModelNode2):
-    """Validates if ultrasound data is defined
+  @traced('Validating inputs')
+  def validateInputs(self, PatientNumber, root=inputRoot, deep=False):
+    """ Checks the input files of a patient from their headers, with deep also their label values and model bounds.
+    Returns a report {'patient', 'valid', 'errors', 'warnings', 'checks'}
     """
-    if not inputVolumeNode1:
-      logging.debug('isValidInputOutputData failed: no input ARFI volume node defined')
-      return False
-    if not inputVolumeNode2:
-      logging.debug('isValidInputOutputData failed: no input Bmode volume node defined')
-      return False
-    if not inputModelNode:
-      logging.debug('isValidInputOutputData failed: no input capsule model node defined')
-      return False
-    if not outputVolumeNode:
-      logging.debug('isValidInputOutputData failed: no output capsule labelmap node defined')
-      return False
-    if inputVolumeNode1.GetID()==inputVolumeNode2.GetID():
-      logging.debug('isValidInputOutputData failed: ARFI and Bmode inputs are the same node.')
-      return False
-    return True
-
-  def isValidMRIData(self, inputVolumeNode1, inputVolumeNode2, outputVolumeNode):
-    """Validates if the output is not the same as input
-    """
-    if not inputVolumeNode1:
-      logging.debug('isValidInputOutputData failed: no input T2-MRI volume node defined')
-      return False
-    if not inputVolumeNode2:
-      logging.debug('isValidInputOutputData failed: no input T2 capsule segmentation volume node defined')
-      return False
-    if not outputVolumeNode:
-      logging.debug('isValidInputOutputData failed: no output capsule labelmap node defined')
-      return False
-    if inputVolumeNode1.GetID()==outputVolumeNode.GetID():
-      logging.debug('isValidInputOutputData failed: Input and output segmentation are the same node. Create a new output volume to avoid this error.')
-      return False
-    return True
-
+    report = {'patient': PatientNumber, 'valid': True, 'errors': 0, 'warnings': 0, 'checks': []}
+
+    def record(name, check, status, message=''):
+      report['checks'].append({'input': name, 'check': check, 'status': status, 'message': message})
+      if status == 'error':
+        report['valid'] = False
+        report['errors'] += 1
+      elif status == 'warning':
+        report['warnings'] += 1
+
+    # Every file on its own
+    paths = {}
+    headers = {}
+    for name, path, kind in inputFileSpecs(PatientNumber):
+      paths[name] = root+path
+      if not os.path.isfile(root+path):
+        record(name, 'exists', 'error', root+path+' not found')
+        continue
+      try:
+        header = readFileHeader(root+path)
+      except (IOError, ValueError, KeyError, struct.error) as error:
+        record(name, 'header', 'error', str(error))
+        continue
+      if kind == 'model':
+        record(name, 'points', 'ok' if header['numberOfPoints'] > 0 else 'error', '%d points' % header['numberOfPoints'])
+        if header['numberOfPoints'] > 0:
+          headers[name] = header
+        continue
+      dimensions, spacing = header['dimensions'], header['spacing']
+      if len(dimensions) < 3 or any(size != 1 for size in dimensions[3:]) or min(dimensions[:3]) < 1:
+        record(name, 'dimensions', 'error', 'not a 3D volume: %s' % dimensions)
+        continue
+      record(name, 'dimensions', 'ok', 'x'.join(str(size) for size in dimensions[:3]))
+      if len(spacing) < 3 or not all(0 < axisSpacing < float('inf') for axisSpacing in spacing[:3]):
+        record(name, 'spacing', 'error', 'invalid spacing %s' % spacing)
+        continue
+      record(name, 'spacing', 'ok', ' '.join('%g' % axisSpacing for axisSpacing in spacing[:3]))
+      record(name, 'dtype', 'ok', header['dtype']) # labelmaps saved as floats are fine if their values are integers (deep)
+      headers[name] = header
+
+    # Segmentations have to be on the grid of the image they were drawn on
+    for name, imageName, status in (('inputCC', 'inputARFI', 'error'), ('inputBmode', 'inputARFI', 'warning'),
+                                    ('inputMRCaps_Seg', 'inputT2', 'error'), ('inputMRZones_Seg', 'inputT2', 'error'),
+                                    ('inputMRVM_Seg', 'inputT2', 'error'), ('inputMRIndex_Seg', 'inputT2', 'error')):
+      if name not in headers or imageName not in headers:
+        continue
+      header, imageHeader = headers[name], headers[imageName]
+      differences = []
+      if header['dimensions'][:3] != imageHeader['dimensions'][:3]:
+        differences.append('dimensions %s instead of %s' % (header['dimensions'][:3], imageHeader['dimensions'][:3]))
+      if not numpy.allclose(header['spacing'][:3], imageHeader['spacing'][:3], rtol=1e-3):
+        differences.append('spacing %s instead of %s' % (header['spacing'][:3], imageHeader['spacing'][:3]))
+      if 'directions' in header and 'directions' in imageHeader and not numpy.allclose(header['directions'], imageHeader['directions'], atol=1e-3):
+        differences.append('directions %s instead of %s' % (header['directions'], imageHeader['directions']))
+      record(name, 'grid of '+imageName, status if differences else 'ok', ', '.join(differences))
+
+    # Label values, only read for a deep validation as the whole labelmaps are decompressed
+    for name, requiredLabels in (('inputCC', []), ('inputMRCaps_Seg', []), ('inputMRZones_Seg', [9]),
+                                 ('inputMRVM_Seg', []), ('inputMRIndex_Seg', [])):
+      if not deep or name not in headers:
+        continue
+      try:
+        voxels = readVolumeVoxels(paths[name], headers[name])
+      except (IOError, ValueError, zlib.error) as error:
+        record(name, 'labels', 'warning', 'could not read the voxels: %s' % error)
+        continue
+      if voxels.dtype.kind == 'f' and (voxels != numpy.round(voxels)).any():
+        record(name, 'labels', 'error', 'labelmap of type %s with non-integer values' % voxels.dtype.name)
+        continue
+      labels = [int(label) for label in numpy.unique(voxels)]
+      missingLabels = [label for label in requiredLabels if label not in labels]
+      if not any(labels):
+        record(name, 'labels', 'error', 'empty labelmap')
+      elif missingLabels:
+        record(name, 'labels', 'error', 'label %s missing, found %s' % (', '.join(str(label) for label in missingLabels), labels))
+      else:
+        record(name, 'labels', 'ok', ', '.join(str(label) for label in labels))
+
+    # The ultrasound models have to be inside the ARFI volume as CenterVolume places it (US_transform flips both the same way)
+    if deep and 'inputARFI' in headers and 'directions' in headers['inputARFI']:
+      header = headers['inputARFI']
+      extent = numpy.array(header['dimensions'][:3])-1
+      spacing = numpy.array(header['spacing'][:3])
+      origin = extent*spacing/2
+      origin[2] = -origin[2]
+      axes = numpy.array(header['directions']).T*spacing # columns: RAS step per voxel index
+      corners = numpy.array([origin + axes.dot([i, j, k]) for i in (0, extent[0]) for j in (0, extent[1]) for k in (0, extent[2])])
+      volumeLower, volumeUpper = corners.min(axis=0), corners.max(axis=0)
+      for name in ('inputUSCaps_Model', 'inputUSCG_Model', 'inputUSVM_Model', 'inputUSIndex_Model'):
+        if name not in headers:
+          continue
+        reader = vtk.vtkPolyDataReader()
+        reader.SetFileName(paths[name])
+        reader.Update()
+        bounds = numpy.array(reader.GetOutput().GetBounds())
+        modelLower, modelUpper = bounds[0::2], bounds[1::2]
+        message = 'model %s, volume %s' % (' '.join('%0.1f..%0.1f' % axisBounds for axisBounds in zip(modelLower, modelUpper)),
+                                           ' '.join('%0.1f..%0.1f' % axisBounds for axisBounds in zip(volumeLower, volumeUpper)))
+        if (modelUpper < volumeLower).any() or (modelLower > volumeUpper).any():
+          record(name, 'inside inputARFI', 'error', 'no overlap: '+message)
+        elif (modelLower < volumeLower-spacing.max()).any() or (modelUpper > volumeUpper+spacing.max()).any():
+          record(name, 'inside inputARFI', 'warning', 'partly outside: '+message)
+        else:
+          record(name, 'inside inputARFI', 'ok', message)
+
+    for check in report['checks']:
+      if check['status'] == 'warning':
+        logging.warning('Input %s, %s: %s' % (check['input'], check['check'], check['message']))
+    self.validationReport = report
+    return report
+
+  @traced('Centering volume')
   def CenterVolume(self, *inputVolumes):
     """ Centers an inputted volume using the image spacing, size, and origin of the volume
     """
-    # Print to Slicer CLI
-    print('Centering volume...'),
-    start_time = time.time()
-
     for inputVolume in inputVolumes: # cycle through all input volumes
 
         # Use image size and spacing to find origin coordinates
@@ -186,17 +342,10 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
         # Set input volume origin to the new origin
         inputVolume.SetOrigin(new_origin)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
+  @traced('Transforming Ultrasound input')
   def US_transform(self, *ARFIinputs):
     """ Performs inversion transform with [1 1 -1 1] diagonal entries on Ultrasound inputs
     """
-    # Print to Slicer CLI
-    print('Transforming Ultrasound input...'),
-    start_time = time.time()
-
     # Create inverting transform matrix
     invert_transform = vtk.vtkMatrix4x4()
     invert_transform.SetElement(2,2,-1) # put a -1 in 3rd entry of diagonal of matrix
@@ -210,35 +359,158 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # inputUSCaps_Model.ApplyTransformMatrix(invert_transform)
     # inputUSCG_Model.ApplyTransformMatrix(invert_transform)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
+  @traced('Converting Model to Label Map')
   def ModelToLabelMap(self, inputVolume, inputModel, outputVolume, sampleDistance):
-    """ Converts models into a labelmap on the input T2-MRI volume using sample distance  provided(smaller than smallest pixel width in input volume)
+    """ Converts models into a labelmap on the input T2-MRI volume using sample distance  provided(smaller than smallest pixel width in input volume).
+    The sample distance is only used by the modeltolabelmap CLI (useCLI); rasterizeModel tests every voxel center inside the model bounds
     """
-    # Print to Slicer CLI
-    print('Converting Model to Label Map...'),
-    start_time = time.time()
-
     # Get spacing of inputVolume and multiply by 0.8 to determine sample distance
     # samplevoxeldistance = round(0.8*min(inputVolume.GetSpacing()),2) # rounds to 2 decimal points for 80% of smallest voxel
 
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': outputVolume.GetID(), 'sampleDistance': sampleDistance, 'labelValue': 10}
-    cliNode = slicer.cli.run(slicer.modules.modeltolabelmap, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    if self.useCLI:
+        # Run the slicer module in CLI
+        cliParams = {'InputVolume': inputVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': outputVolume.GetID(), 'sampleDistance': sampleDistance, 'labelValue': 10}
+        cliNode = runCLI(slicer.modules.modeltolabelmap, cliParams)
+    else:
+        self.rasterizeModel(inputVolume, inputModel, outputVolume, 10)
 
-  def MRCapModelMaker(self, inputMRlabel):
-    """ Converts MRI labelmap segemntation into slicer VTK model node
+  @traced('Converting Models to Label Maps')
+  def ModelsToLabelMap(self, inputVolume, modelLabels, sampleDistance):
+    """ Batch version of ModelToLabelMap: rasterizes the (model, output volume, label value) triples of modelLabels onto the grid of inputVolume
     """
-    # Print to Slicer CLI
-    print('Creating MR Model...'),
+    if self.useCLI:
+      # Run the slicer module in CLI for every model
+      for inputModel, outputVolume, labelValue in modelLabels:
+        cliParams = {'InputVolume': inputVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': outputVolume.GetID(),
+                     'sampleDistance': sampleDistance, 'labelValue': labelValue}
+        cliNode = runCLI(slicer.modules.modeltolabelmap, cliParams)
+    else:
+      self.rasterizeModels(inputVolume, modelLabels)
+
+  def rasterizeModel(self, referenceVolume, inputModel, outputVolume, labelValue=10):
+    """ In-process modeltolabelmap: labelValue in the voxels of the referenceVolume grid with centers inside inputModel
+    """
+    self.rasterizeModels(referenceVolume, [(inputModel, outputVolume, labelValue)])
+
+  def rasterizeModels(self, referenceVolume, modelLabels, multiLabelVolume=None):
+    """ rasterizeModel for (model, output volume, label value) triples with one grid setup, or all into multiLabelVolume
+    """
+    # Bring the surfaces into the voxel index (IJK) space of the reference volume
+    rasToIJK = vtk.vtkMatrix4x4()
+    referenceVolume.GetRASToIJKMatrix(rasToIJK)
+    rasToIJKTransform = vtk.vtkTransform()
+    rasToIJKTransform.SetMatrix(rasToIJK)
+    transformer = vtk.vtkTransformPolyDataFilter()
+    transformer.SetTransform(rasToIJKTransform)
+    triangulator = vtk.vtkTriangleFilter()
+    triangulator.SetInputConnection(transformer.GetOutputPort())
+
+    # Scanline fill of a surface at the voxel centers of an extent
+    stencil = vtk.vtkPolyDataToImageStencil()
+    stencil.SetOutputOrigin(0, 0, 0)
+    stencil.SetOutputSpacing(1, 1, 1)
+    stencilImage = vtk.vtkImageStencilToImage()
+    stencilImage.SetInputConnection(stencil.GetOutputPort())
+    stencilImage.SetOutsideValue(0)
+    stencilImage.SetOutputScalarType(vtk.VTK_UNSIGNED_CHAR)
+
+    dimensions = referenceVolume.GetImageData().GetDimensions()
+    if multiLabelVolume:
+      multiLabelVoxels = allocateVolumeLike(referenceVolume, multiLabelVolume, vtk.VTK_UNSIGNED_CHAR)
+
+    for inputModel, outputVolume, labelValue in modelLabels:
+      if multiLabelVolume:
+        outputVoxels = multiLabelVoxels
+      else:
+        outputVoxels = allocateVolumeLike(referenceVolume, outputVolume, vtk.VTK_UNSIGNED_CHAR)
+
+      transformer.SetInputData(inputModel.GetPolyData())
+      triangulator.Update()
+      surface = vtk.vtkPolyData()
+      surface.DeepCopy(triangulator.GetOutput())
+
+      # Voxel extent covered by the model bounds, clipped to the reference grid
+      bounds = surface.GetBounds()
+      extent = []
+      for axis in range(3):
+        extent.append(max(0, int(math.ceil(bounds[2*axis]))))
+        extent.append(min(dimensions[axis]-1, int(math.floor(bounds[2*axis+1]))))
+
+      if surface.GetNumberOfPoints() == 0 or extent[0] > extent[1] or extent[2] > extent[3] or extent[4] > extent[5]:
+        logging.warning('rasterizeModels: model %s does not overlap volume %s' % (inputModel.GetName(), referenceVolume.GetName()))
+      else:
+        stencil.SetInputData(surface)
+        stencil.SetOutputWholeExtent(extent)
+        stencilImage.SetInsideValue(labelValue)
+        stencilImage.Update()
+        boxShape = (extent[5]-extent[4]+1, extent[3]-extent[2]+1, extent[1]-extent[0]+1)
+        boxVoxels = numpy_support.vtk_to_numpy(stencilImage.GetOutput().GetPointData().GetScalars()).reshape(boxShape)
+        outputBox = outputVoxels[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1]
+        numpy.copyto(outputBox, boxVoxels, where=boxVoxels != 0)
+
+      if not multiLabelVolume:
+        arrayFromVolumeModified(outputVolume)
+
+    if multiLabelVolume:
+      arrayFromVolumeModified(multiLabelVolume)
+
+  def compareModelToLabelMap(self, referenceVolume, inputModel, sampleDistance=0.1):
+    """ Rasterizes a model with both the modeltolabelmap CLI and rasterizeModel and prints/returns the run times and the
+    agreement of the two labelmaps (voxel counts, number of differing voxels and Dice coefficient)
+    """
+    cliLabel = self.CreateNewLabelVolume(inputModel.GetName()+'-cli-label')
+    nativeLabel = self.CreateNewLabelVolume(inputModel.GetName()+'-native-label')
+
     start_time = time.time()
+    cliParams = {'InputVolume': referenceVolume.GetID(), 'surface': inputModel.GetID(), 'OutputVolume': cliLabel.GetID(),
+                 'sampleDistance': sampleDistance, 'labelValue': 10}
+    slicer.cli.run(slicer.modules.modeltolabelmap, None, cliParams, wait_for_completion=True)
+    cliTime = time.time()-start_time
 
+    start_time = time.time()
+    self.rasterizeModel(referenceVolume, inputModel, nativeLabel, 10)
+    nativeTime = time.time()-start_time
+
+    agreement = labelAgreement(arrayFromVolume(cliLabel), arrayFromVolume(nativeLabel))
+    comparison = {'cliTime': cliTime, 'nativeTime': nativeTime, 'cliVoxels': agreement['voxelsA'], 'nativeVoxels': agreement['voxelsB'],
+                  'differentVoxels': agreement['differentVoxels'], 'dice': agreement['dice']}
+    print('%s: modeltolabelmap %0.2f s (%i voxels), rasterizeModel %0.2f s (%i voxels), %i voxels differ, Dice %0.4f' % (
+          inputModel.GetName(), cliTime, comparison['cliVoxels'], nativeTime, comparison['nativeVoxels'],
+          comparison['differentVoxels'], comparison['dice']))
+
+    self.RemoveNode(cliLabel, nativeLabel)
+    return comparison
+
+  def compareLabelMapSmoothing(self, inputVolume, Sigma, *labelNumber):
+    """ Smooths a copy of inputVolume with both the labelmapsmoothing CLI and smoothLabelArray and prints/returns the
+    run times and the agreement of the results (voxel counts, number of differing voxels and Dice coefficient)
+    """
+    cliLabel = self.CreateNewLabelVolume(inputVolume.GetName()+'-cli-smoothed')
+    cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': cliLabel.GetID(), 'gaussianSigma': Sigma}
+    if labelNumber:
+      cliParams["labelToSmooth"] = labelNumber
+    with traceSpan('compareLabelMapSmoothing:cli') as cliSpan:
+      slicer.cli.run(slicer.modules.labelmapsmoothing, None, cliParams, wait_for_completion=True)
+
+    with traceSpan('compareLabelMapSmoothing:native') as nativeSpan:
+      nativeVoxels = smoothLabelArray(arrayFromVolume(inputVolume), inputVolume.GetSpacing(), Sigma, labelNumber or None)
+
+    agreement = labelAgreement(arrayFromVolume(cliLabel), nativeVoxels)
+    comparison = {'cliTime': cliSpan.elapsed, 'nativeTime': nativeSpan.elapsed, 'speedup': cliSpan.elapsed/max(nativeSpan.elapsed, 1e-6),
+                  'cliVoxels': agreement['voxelsA'], 'nativeVoxels': agreement['voxelsB'],
+                  'differentVoxels': agreement['differentVoxels'], 'dice': agreement['dice']}
+    print('%s: labelmapsmoothing %0.2f s (%i voxels), smoothLabelArray %0.2f s (%i voxels), %0.1fx faster, %i voxels differ, Dice %0.4f' % (
+          inputVolume.GetName(), comparison['cliTime'], comparison['cliVoxels'], comparison['nativeTime'], comparison['nativeVoxels'],
+          comparison['speedup'], comparison['differentVoxels'], comparison['dice']))
+
+    self.RemoveNode(cliLabel)
+    return comparison
+
+  @traced('Creating MR Model')
+  def MRCapModelMaker(self, inputMRlabel):
+    """ Converts MRI labelmap segemntation into slicer VTK model node 'mr-cap_1_1'. Returns None when the
+    pipeline scheduler launched it, as the model only exists once modelmaker has finished
+    """
     # Set model parameters
     parameters = {} 
     parameters["InputVolume"] = inputMRlabel.GetID()
@@ -276,24 +548,20 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     parameters["ModelSceneFile"] = outHierarchy
 
     # Run the module from the command line
-    slicer.cli.run(slicer.modules.modelmaker, None, parameters, wait_for_completion=True)
+    runCLI(slicer.modules.modelmaker, parameters)
 
     # Define the output model as the created model in the scene
-    outputMRModel = slicer.util.getNode('mr-cap_1_1') # cap label has label value of 1 so model created is Model_1_1
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    outputMRModel = None
+    if not deferringCLILaunches():
+        outputMRModel = slicer.util.getNode('mr-cap_1_1') # cap label has label value of 1 so model created is Model_1_1
 
     return outputMRModel    
 
-  def MRModelMaker(self, inputMRlabel, smoothingValue):
-    """ Converts MRI tumor labelmap segemntation into slicer VTK model node
+  @traced('Creating MRI Model')
+  def MRModelMaker(self, inputMRlabel, smoothingValue, modelName='model'):
+    """ Converts MRI tumor labelmap segemntation into slicer VTK model node named modelName+'_34_34'. Returns None
+    when the pipeline scheduler launched it, as the model only exists once modelmaker has finished
     """
-    # Print to Slicer CLI
-    print('Creating MRI Model...'),
-    start_time = time.time()
-
     # Change input label value
     self.ThresholdScalarVolume(inputMRlabel,  34)
 
@@ -311,7 +579,7 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     parameters["Decimate"] = 0.1
     parameters["Smooth"] = int(smoothingValue) # make sure it is an integer
     parameters["Pad"] = True
-    parameters["Name"] = 'model'
+    parameters["Name"] = modelName
 
     # # Need to create new model heirarchy node for models to enter the scene
     # numNodes = slicer.mrmlScene.GetNumberOfNodesByClass( "vtkMRMLModelHierarchyNode" )
@@ -335,27 +603,25 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     parameters["ModelSceneFile"] = outHierarchy
 
     # Run the module from the command line
-    slicer.cli.run(slicer.modules.modelmaker, None, parameters, wait_for_completion=True)
+    runCLI(slicer.modules.modelmaker, parameters)
 
     # Define the output model as the created model in the scene
-    outputMRModel = slicer.util.getNode('model_34_34') # created model has label value of 34 
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    outputMRModel = None
+    if not deferringCLILaunches():
+        outputMRModel = slicer.util.getNode(modelName+'_34_34') # created model has label value of 34 
 
     return outputMRModel  
 
-
+  @traced('Translating MRI inputs to U/S capsule')
   def MR_translate(self, movingMRIModel, fixedUSModel, *MRIinputs): 
-    """ Translates MRI capsule and T2 imaging volume to roughly align with US capsule model so T2 prostate is within ARFI image
+    """ Translates MRI capsule and T2 imaging volume to roughly align with US capsule model so T2 prostate is within ARFI image.
+    movingMRIModel is either the MRI capsule model or the MRI capsule labelmap
     """
-    # Print to Slicer CLI
-    print('Translating MRI inputs to U/S capsule...'),
-    start_time = time.time()
-
     # Find out coordinates of models to be used for translation matrix
-    moving_bounds = movingMRIModel.GetPolyData().GetBounds()
+    if movingMRIModel.IsA('vtkMRMLScalarVolumeNode'):
+        moving_bounds = labelBounds(movingMRIModel)
+    else:
+        moving_bounds = movingMRIModel.GetPolyData().GetBounds()
     fixed_bounds  =   fixedUSModel.GetPolyData().GetBounds()
 
     
@@ -372,313 +638,501 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     for MRIinput in MRIinputs:
         MRIinput.ApplyTransformMatrix(translate_transform)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
   
+  @traced('Smoothing label volume')
   def SegmentationSmoothing(self, inputVolume, outputsmoothedVolume, *labelNumber):
-    """ Smooths an input volume into an outputVolume using the Segmentation Smoothing Module from SlicerProstate module
+    """ Smooths an input volume into an outputVolume using the Segmentation Smoothing Module from SlicerProstate module.
+    Only the region of the label plus roiMargin mm is smoothed, the rest of the output is 0
     """
-    # Print to Slicer CLI
-    print('Smoothing label volume...'),
-    start_time = time.time()
+    # Crop to the region of the label to smooth
+    roi = self.cropToLabelROI(inputVolume, self.roiMargin, int(labelNumber[0]) if labelNumber else None)
 
     # Define parameters for smoothing
     parameters = {}
-    parameters["inputImageName"]= inputVolume.GetID()
-    parameters["outputImageName"]= outputsmoothedVolume.GetID()
+    parameters["inputImageName"]= roi['input'].GetID() if roi else inputVolume.GetID()
+    parameters["outputImageName"]= roi['output'].GetID() if roi else outputsmoothedVolume.GetID()
     if labelNumber:
         parameters['labelNumber'] = int(labelNumber[0]) # have to grab first value of tuple for optional argument
 
     # Rn the smoothing segmentation module from CLI
-    cliNode = slicer.cli.run(slicer.modules.segmentationsmoothing, None, parameters, wait_for_completion = True)
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    cliNode = runCLI(slicer.modules.segmentationsmoothing, parameters,
+                     (lambda: self.pasteLabelROI(roi, outputsmoothedVolume, keepOutside=False)) if roi else None)
 
+  @traced('Resampling volumes to match ARFI')
   def ResampleVolumefromReference(self, referenceVolume, *inputVolumes):
     """ Resamples an input volume to match ARFI reference volume spacing, size, orientation, and origin
     """
-    # Print to Slicer CLI
-    print('Resampling volumes to match ARFI...'),
-    start_time = time.time()
+    if not self.useCLI:
+        self.resampleVolumes(referenceVolume, inputVolumes)
+        return
 
     for inputVolume in inputVolumes:
         # Run Resample ScalarVectorDWIVolume Module from CLI
         cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': inputVolume.GetID(), 'referenceVolume': referenceVolume.GetID()}
-        cliNode = slicer.cli.run(slicer.modules.resamplescalarvectordwivolume, None, cliParams, wait_for_completion=True)
+        cliNode = runCLI(slicer.modules.resamplescalarvectordwivolume, cliParams)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+  def resampleVolumes(self, referenceVolume, inputVolumes, numberOfThreads=None):
+    """ Resamples the input volumes in place onto the grid of referenceVolume, in parallel and without temporary files
+    """
+    referenceIJKToRAS = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(referenceIJKToRAS)
+    dimensions = referenceVolume.GetImageData().GetDimensions()
 
+    reslicers = []
+    for inputVolume in inputVolumes:
+      # Reference voxel index -> RAS -> input voxel index
+      inputRASToIJK = vtk.vtkMatrix4x4()
+      inputVolume.GetRASToIJKMatrix(inputRASToIJK)
+      resliceAxes = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Multiply4x4(inputRASToIJK, referenceIJKToRAS, resliceAxes)
+
+      reslice = vtk.vtkImageReslice()
+      reslice.SetInputData(inputVolume.GetImageData())
+      reslice.SetResliceAxes(resliceAxes)
+      reslice.SetOutputOrigin(0, 0, 0)
+      reslice.SetOutputSpacing(1, 1, 1)
+      reslice.SetOutputExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+      reslice.SetBackgroundLevel(0)
+      if inputVolume.IsA('vtkMRMLLabelMapVolumeNode'):
+        reslice.SetInterpolationModeToNearestNeighbor()
+      else:
+        reslice.SetInterpolationModeToLinear()
+      reslicers.append(reslice)
+
+    pool = ThreadPool(numberOfThreads or max(1, min(len(reslicers), multiprocessing.cpu_count())))
+    try:
+      pool.map(lambda reslice: reslice.Update(), reslicers)
+    finally:
+      pool.close()
+      pool.join()
+
+    # Scene changes stay on the main thread
+    for inputVolume, reslice in zip(inputVolumes, reslicers):
+      resampledImage = vtk.vtkImageData()
+      resampledImage.ShallowCopy(reslice.GetOutput())
+      inputVolume.SetIJKToRASMatrix(referenceIJKToRAS)
+      inputVolume.SetAndObserveImageData(resampledImage)
+
+  @traced('Transferring labels')
+  def transferLabels(self, referenceVolume, labelTransfers, numberOfThreads=None):
+    """ Moves the (input label, output volume, sigma, label value) labels onto referenceVolume by blurring, resampling
+    and thresholding them, without building a model
+    """
+    referenceIJKToRAS = vtk.vtkMatrix4x4()
+    referenceVolume.GetIJKToRASMatrix(referenceIJKToRAS)
+    referenceRASToIJK = vtk.vtkMatrix4x4()
+    referenceVolume.GetRASToIJKMatrix(referenceRASToIJK)
+    dimensions = referenceVolume.GetImageData().GetDimensions()
+
+    reslicers = []
+    for inputLabel, outputVolume, sigma, labelValue in labelTransfers:
+      voxels = arrayFromVolume(inputLabel)
+      spacing = inputLabel.GetSpacing()
+      sigmas = [sigma/abs(spacing[2-axis]) for axis in range(3)] # in voxels, k, j, i order
+      # Blur the box around the label with room for the kernel and a zero border for the interpolation
+      box = labelBoundingBox(voxels, None, [int(math.ceil(3*sigmas[2-axis]))+1 for axis in range(3)])
+      if box is None:
+        logging.warning('transferLabels: label %s is empty' % inputLabel.GetName())
+        reslicers.append(None)
+        continue
+      blurred = gaussianSmoothArray(voxels[box] != 0, sigmas, numberOfThreads)
+      boxImage = vtk.vtkImageData()
+      boxImage.SetDimensions(blurred.shape[2], blurred.shape[1], blurred.shape[0])
+      boxImage.AllocateScalars(vtk.VTK_FLOAT, 1)
+      numpy_support.vtk_to_numpy(boxImage.GetPointData().GetScalars()).reshape(blurred.shape)[:] = blurred
+
+      # Reference voxel index -> RAS -> input voxel index -> box voxel index
+      inputIJKToRAS = vtk.vtkMatrix4x4()
+      inputLabel.GetIJKToRASMatrix(inputIJKToRAS)
+      inputRASToIJK = vtk.vtkMatrix4x4()
+      inputLabel.GetRASToIJKMatrix(inputRASToIJK)
+      for row, axis in enumerate((2, 1, 0)):
+        inputRASToIJK.SetElement(row, 3, inputRASToIJK.GetElement(row, 3)-box[axis].start)
+      resliceAxes = vtk.vtkMatrix4x4()
+      vtk.vtkMatrix4x4.Multiply4x4(inputRASToIJK, referenceIJKToRAS, resliceAxes)
+
+      # Only the reference voxels within the box are resampled
+      corners = []
+      for k in (box[0].start, box[0].stop-1):
+        for j in (box[1].start, box[1].stop-1):
+          for i in (box[2].start, box[2].stop-1):
+            corners.append(referenceRASToIJK.MultiplyPoint(inputIJKToRAS.MultiplyPoint((i, j, k, 1))))
+      corners = numpy.array(corners)[:, :3]
+      extent = []
+      for axis in range(3):
+        extent.append(max(0, int(math.floor(corners[:, axis].min()))))
+        extent.append(min(dimensions[axis]-1, int(math.ceil(corners[:, axis].max()))))
+      if extent[0] > extent[1] or extent[2] > extent[3] or extent[4] > extent[5]:
+        logging.warning('transferLabels: label %s does not overlap volume %s' % (inputLabel.GetName(), referenceVolume.GetName()))
+        reslicers.append(None)
+        continue
+
+      reslice = vtk.vtkImageReslice()
+      reslice.SetInputData(boxImage)
+      reslice.SetResliceAxes(resliceAxes)
+      reslice.SetOutputOrigin(0, 0, 0)
+      reslice.SetOutputSpacing(1, 1, 1)
+      reslice.SetOutputExtent(extent)
+      reslice.SetBackgroundLevel(0)
+      reslice.SetInterpolationModeToLinear()
+      reslicers.append((reslice, extent))
+
+    pool = ThreadPool(numberOfThreads or max(1, min(len(reslicers), multiprocessing.cpu_count())))
+    try:
+      pool.map(lambda resliced: resliced and resliced[0].Update(), reslicers)
+    finally:
+      pool.close()
+      pool.join()
+
+    # Scene changes stay on the main thread
+    for (inputLabel, outputVolume, sigma, labelValue), resliced in zip(labelTransfers, reslicers):
+      outputVoxels = allocateVolumeLike(referenceVolume, outputVolume, vtk.VTK_UNSIGNED_CHAR)
+      if resliced:
+        reslice, extent = resliced
+        boxShape = (extent[5]-extent[4]+1, extent[3]-extent[2]+1, extent[1]-extent[0]+1)
+        boxVoxels = numpy_support.vtk_to_numpy(reslice.GetOutput().GetPointData().GetScalars()).reshape(boxShape)
+        outputVoxels[extent[4]:extent[5]+1, extent[2]:extent[3]+1, extent[0]:extent[1]+1][boxVoxels > 0.5] = labelValue
+      arrayFromVolumeModified(outputVolume)
+
+  def compareLabelTransfer(self, referenceVolume, inputLabel, inputModel, sigma, sampleDistance=0.1):
+    """ Prints and returns the run times and agreement of transferLabels and of Model Maker + ModelToLabelMap
+    """
+    modelLabel = self.CreateNewLabelVolume(inputModel.GetName()+'-model-label')
+    transferredLabel = self.CreateNewLabelVolume(inputLabel.GetName()+'-transferred-label')
+
+    with traceSpan('compareLabelTransfer:model') as modelSpan:
+      self.ModelToLabelMap(referenceVolume, inputModel, modelLabel, sampleDistance)
+    with traceSpan('compareLabelTransfer:transfer') as transferSpan:
+      self.transferLabels(referenceVolume, [(inputLabel, transferredLabel, sigma, 10)])
+
+    modelVoxels, transferredVoxels = arrayFromVolume(modelLabel), arrayFromVolume(transferredLabel)
+    agreement = labelAgreement(modelVoxels, transferredVoxels)
+    comparison = {'modelTime': modelSpan.elapsed, 'transferTime': transferSpan.elapsed, 'modelVoxels': agreement['voxelsA'],
+                  'transferVoxels': agreement['voxelsB'], 'differentVoxels': agreement['differentVoxels'], 'dice': agreement['dice'],
+                  'hausdorff': labelHausdorffDistance(modelVoxels, transferredVoxels, referenceVolume.GetSpacing())}
+    print('%s: ModelToLabelMap %0.2f s (%i voxels), transferLabels %0.2f s (%i voxels), %i voxels differ, Dice %0.4f, Hausdorff %s mm' % (
+          inputLabel.GetName(), comparison['modelTime'], comparison['modelVoxels'], comparison['transferTime'], comparison['transferVoxels'],
+          comparison['differentVoxels'], comparison['dice'], comparison['hausdorff']))
+
+    self.RemoveNode(modelLabel, transferredLabel)
+    return comparison
+
+  @traced('Additional Label Map Smoothing')
   def LabelMapSmoothing(self, inputVolume, Sigma, *labelNumber):
     """ Smooths an input volume labelmap using value of sigma provided (number from 0-5). Optionally smooths only selected labels if more arguments passed
+    (smoothLabelArray, or the CLI on the region of the labels with useCLI). Only the smoothed labels are kept
     """
-    # Print to Slicer CLI
-    print('Additional Label Map Smoothing...'),
-    start_time = time.time()
+    if not self.useCLI and self.hasImageData(inputVolume):
+        smoothed = smoothLabelArray(arrayFromVolume(inputVolume), inputVolume.GetSpacing(), Sigma, labelNumber or None)
+        arrayFromVolume(inputVolume)[:] = smoothed
+        arrayFromVolumeModified(inputVolume)
+        return
+
+    # Crop to the region of the labels to smooth
+    roi = self.cropToLabelROI(inputVolume, max(self.roiMargin, 4*Sigma), labelNumber[0] if len(labelNumber) == 1 else None)
 
     # Run the slicer module in CLI
-    cliParams = {'inputVolume': inputVolume.GetID(), 'outputVolume': inputVolume.GetID(), 'gaussianSigma': Sigma} # input and output defined as same
+    cliParams = {'inputVolume': roi['input'].GetID() if roi else inputVolume.GetID(), # input and output defined as same
+                 'outputVolume': roi['output'].GetID() if roi else inputVolume.GetID(), 'gaussianSigma': Sigma}
     if labelNumber:
         cliParams["labelToSmooth"] = labelNumber
 
-    cliNode = slicer.cli.run(slicer.modules.labelmapsmoothing, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    cliNode = runCLI(slicer.modules.labelmapsmoothing, cliParams,
+                     (lambda: self.pasteLabelROI(roi, inputVolume, keepOutside=False)) if roi else None)
 
+  def cropToLabelROI(self, inputVolume, margin, labelNumber=None):
+    """ Copies the box around the (labelNumber) voxels of inputVolume plus margin mm into ROI nodes for a CLI module.
+    Returns None if the ROI would not be smaller than the volume
+    """
+    voxels = arrayFromVolume(inputVolume)
+    spacing = inputVolume.GetSpacing()
+    box = labelBoundingBox(voxels, labelNumber, [int(math.ceil(margin/abs(axisSpacing))) for axisSpacing in spacing])
+    if box is None or all(axisSlice.stop-axisSlice.start == size for axisSlice, size in zip(box, voxels.shape)):
+      return None
+
+    ijkToRAS = vtk.vtkMatrix4x4()
+    inputVolume.GetIJKToRASMatrix(ijkToRAS)
+    roiIJKToRAS = vtk.vtkMatrix4x4()
+    roiIJKToRAS.DeepCopy(ijkToRAS)
+    roiOrigin = ijkToRAS.MultiplyPoint((box[2].start, box[1].start, box[0].start, 1))
+    for row in range(3):
+      roiIJKToRAS.SetElement(row, 3, roiOrigin[row])
+
+    roi = {'box': box, 'ijkToRAS': ijkToRAS, 'dimensions': inputVolume.GetImageData().GetDimensions(),
+           'scalarType': inputVolume.GetImageData().GetScalarType()}
+    for role in ('input', 'output'):
+      roiVolume = slicer.vtkMRMLLabelMapVolumeNode()
+      roiVolume.SetName(slicer.mrmlScene.GenerateUniqueName(inputVolume.GetName()+'-ROI'))
+      roiVolume.SetHideFromEditors(True)
+      slicer.mrmlScene.AddNode(roiVolume)
+      roiVolume.SetIJKToRASMatrix(roiIJKToRAS)
+      roi[role] = roiVolume
+    roiImage = vtk.vtkImageData()
+    roiImage.SetDimensions(box[2].stop-box[2].start, box[1].stop-box[1].start, box[0].stop-box[0].start)
+    roiImage.AllocateScalars(roi['scalarType'], 1)
+    roi['input'].SetAndObserveImageData(roiImage)
+    arrayFromVolume(roi['input'])[:] = voxels[box]
+    arrayFromVolumeModified(roi['input'])
+    return roi
+
+  def pasteLabelROI(self, roi, outputVolume, keepOutside):
+    """ Writes the CLI result on a cropToLabelROI ROI into outputVolume and removes the ROI nodes. With keepOutside, the
+    voxels outside of the ROI are kept
+    """
+    roiVoxels = arrayFromVolume(roi['output'])
+    if not keepOutside:
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(roi['dimensions'])
+      imageData.AllocateScalars(roi['output'].GetImageData().GetScalarType(), 1)
+      imageData.GetPointData().GetScalars().Fill(0)
+      outputVolume.SetIJKToRASMatrix(roi['ijkToRAS'])
+      outputVolume.SetAndObserveImageData(imageData)
+    arrayFromVolume(outputVolume)[roi['box']] = roiVoxels
+    arrayFromVolumeModified(outputVolume)
+    slicer.mrmlScene.RemoveNode(roi['input'])
+    slicer.mrmlScene.RemoveNode(roi['output'])
+
+  @traced('Changing Label Value')
   def ThresholdScalarVolume(self, inputVolume, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
-    # Print to Slicer CLI
-    print('Changing Label Value...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    if self.useCLI or not self.hasImageData(inputVolume):
+        # Run the slicer module in CLI
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': newLabelVal} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    else:
+        self.thresholdAboveArray(inputVolume, 0.5, newLabelVal)
 
+  @traced('Removing unnecessary nodes from MRML scene')
   def RemoveNode(self, *NodestoRemove):
     """ Removes all nodes passed as arguments
     """
-    # Print to Slicer CLI
-    print('Removing unnecessary nodes from MRML scene...'),
-    start_time = time.time()
-
     # Cycle to remove input nodes
     for node in NodestoRemove:
         slicer.mrmlScene.RemoveNode(node)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
  
-  def CreateRegistrationLabel(self, inputCapsule, inputCG, inputVM, registerLabel):
-
-    # Print to Slicer CLI
-    print('Creating Registration Label...'),
-    start_time = time.time()
-
-    # Change Label Values for processing
-    self.ThresholdScalarVolume(inputCapsule,  1) 
-    self.ThresholdScalarVolume(inputCG,       2)
-    self.ThresholdScalarVolume(inputVM,       3)
+  @traced('Creating Registration Label')
+  def CreateRegistrationLabel(self, inputCapsule, inputCG, inputVM, registerLabel, labelValue=1):
+    """ Creates the registration label (PZ plus VM) with value labelValue on the grid of the CG label
+    """
 
-    # Combine CG and Capsule Labelmaps
-    self.ImageLabelCombine(inputCG, inputCapsule, registerLabel) # first label overwrites second
+    if self.useCLI or not (sameVolumeGeometry(inputCG, inputCapsule) and sameVolumeGeometry(inputCG, inputVM)):
+        # Change Label Values for processing
+        self.ThresholdScalarVolume(inputCapsule,  1) 
+        self.ThresholdScalarVolume(inputCG,       2)
+        self.ThresholdScalarVolume(inputVM,       3)
 
-    # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
-    self.ThresholdAbove(registerLabel, 1.5, 0) # PZ has value of 1
+        # Combine CG and Capsule Labelmaps
+        self.ImageLabelCombine(inputCG, inputCapsule, registerLabel) # first label overwrites second
 
-    # # Threshold VM to 1 before adding
-    self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
+        # # Threshold out areas of only CG and areas of CG/capsule overlap to get only PZ
+        self.ThresholdAbove(registerLabel, 1.5, 0) # PZ has value of 1
 
-    # # Add VM to output Label
-    self.ImageLabelCombine(registerLabel, inputVM, registerLabel) # first label overwrites 2nd label
+        # # Threshold VM to 1 before adding
+        self.ThresholdAbove(inputVM, 0.5, 1) #(input volume, new label value for nonzero pixels)
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+        # # Add VM to output Label
+        self.ImageLabelCombine(registerLabel, inputVM, registerLabel) # first label overwrites 2nd label
 
+        if labelValue != 1:
+            self.ThresholdScalarVolume(registerLabel, labelValue)
+    else:
+        # Fused single pass that leaves the input segmentations untouched
+        capsuleVoxels = arrayFromVolume(inputCapsule)
+        cgVoxels = arrayFromVolume(inputCG)
+        vmVoxels = arrayFromVolume(inputVM)
+        if registerLabel.GetID() in (inputCapsule.GetID(), inputCG.GetID(), inputVM.GetID()):
+            registerVoxels = registrationLabelArray(capsuleVoxels, cgVoxels, vmVoxels, labelValue)
+            arrayFromVolume(registerLabel)[:] = registerVoxels
+        else:
+            registerVoxels = allocateVolumeLike(inputCG, registerLabel)
+            registrationLabelArray(capsuleVoxels, cgVoxels, vmVoxels, labelValue, out=registerVoxels)
+        arrayFromVolumeModified(registerLabel)
+
+  @traced('Combining Labels')
   def ImageLabelCombine(self, inputLabelA, inputLabelB, outputLabel):
     """ Combines labelmaps with label A overwriting label B if any overlapping area
     """
-    # Print to Slicer CLI
-    print('Combining Labels...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputLabelMap_A': inputLabelA.GetID(),'InputLabelMap_B': inputLabelB.GetID(), 'OutputLabelMap': outputLabel.GetID()} 
-    cliNode = slicer.cli.run(slicer.modules.imagelabelcombine, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    if self.useCLI or not sameVolumeGeometry(inputLabelA, inputLabelB):
+        # Run the slicer module in CLI
+        cliParams = {'InputLabelMap_A': inputLabelA.GetID(),'InputLabelMap_B': inputLabelB.GetID(), 'OutputLabelMap': outputLabel.GetID()} 
+        cliNode = slicer.cli.run(slicer.modules.imagelabelcombine, None, cliParams, wait_for_completion=True)
+    else:
+        self.combineLabelArrays(inputLabelA, inputLabelB, outputLabel)
 
+  @traced('Thresholding Label Value')
   def ThresholdAbove(self, inputVolume, thresholdVal, newLabelVal):
     """ Thresholds nonzero values on an input labelmap volume to the newLabelVal number while leaving all 0 values untouched
     """
-    # Print to Slicer CLI
-    print('Thresholding Label Value...'),
-    start_time = time.time()
-
-    # Run the slicer module in CLI
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': thresholdVal, 'OutsideValue': newLabelVal} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+    if self.useCLI or not self.hasImageData(inputVolume):
+        # Run the slicer module in CLI
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': thresholdVal, 'OutsideValue': newLabelVal} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    else:
+        self.thresholdAboveArray(inputVolume, thresholdVal, newLabelVal)
 
+  @traced('Thresholding Label Value')
   def MRVMLabelValueProcess(self, inputVolume):
     """ Inverts zero and nonzero label values for a labelmap """
-    # Print to Slicer CLI
-    print('Thresholding Label Value...'),
-    start_time = time.time()
+    if self.useCLI or not self.hasImageData(inputVolume):
+        # Turn zero values into 3
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': 3, 'Negate': True} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+
+        # Turn values of above 5 into 0
+        cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 5, 'OutsideValue': 0} 
+        cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+    else:
+        self.thresholdAboveArray(inputVolume, 0.5, 3, negate=True)
+        self.thresholdAboveArray(inputVolume, 5, 0)
 
-    # Turn zero values into 3
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 0.5, 'OutsideValue': 3, 'Negate': True} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
+  def thresholdAboveArray(self, inputVolume, thresholdVal, newLabelVal, negate=False):
+    """ In-process version of the thresholdscalarvolume 'Above' CLI: sets voxels above thresholdVal to newLabelVal in place.
+    With negate the voxels at or below thresholdVal are set instead
+    """
+    voxels = arrayFromVolume(inputVolume)
+    if negate:
+      voxels[voxels <= thresholdVal] = newLabelVal
+    else:
+      voxels[voxels > thresholdVal] = newLabelVal
+    arrayFromVolumeModified(inputVolume)
 
-    # Turn values of above 5 into 0
-    cliParams = {'InputVolume': inputVolume.GetID(), 'OutputVolume': inputVolume.GetID(), 'ThresholdType': 'Above', 'ThresholdValue': 5, 'OutsideValue': 0} 
-    cliNode = slicer.cli.run(slicer.modules.thresholdscalarvolume, None, cliParams, wait_for_completion=True)
-    
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
+  def combineLabelArrays(self, inputLabelA, inputLabelB, outputLabel):
+    """ In-process version of the imagelabelcombine CLI: nonzero voxels of label A overwrite label B. Output takes the geometry of label A
+    """
+    voxelsA = arrayFromVolume(inputLabelA)
+    combined = numpy.where(voxelsA != 0, voxelsA, arrayFromVolume(inputLabelB))
+    if outputLabel.GetID() != inputLabelA.GetID():
+      allocateVolumeLike(inputLabelA, outputLabel)
+    arrayFromVolume(outputLabel)[:] = combined
+    arrayFromVolumeModified(outputLabel)
+
+  def saveNode(self, node, path):
+    """ Saves node to path, in the background with writeBehind
+    """
+    if not self.writeBehind:
+      slicer.util.saveNode(node, path)
+      return
+    if self.saver is None:
+      self.saver = WriteBehindSaver(compressionLevel=self.compressionLevel)
+    self.saver.compressionLevel = self.compressionLevel
+    self.saver.save(node, path)
+
+  def waitForPendingWrites(self):
+    """ Waits until the files queued by write-behind saving are written and stops the saver threads (a later save
+    starts new ones). Returns False if any of the files could not be written
+    """
+    if self.saver is None:
+      return True
+    saver, self.saver = self.saver, None
+    with traceSpan('waitForPendingWrites', 'Waiting for pending writes'):
+      return not saver.close()
 
+  @traced('Saving Ultrasound Results')
   def SaveUSRegistrationInputs(self, PatientNumber, inputARFI,  inputBmode,  inputCC, outputUSCaps_Seg,  outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label):
     """ Saves Ultrasound volumes and labelmaps after preprocessing prior to registration
     """
-    # Print to Slicer CLI
-    print('Saving Ultrasound Results...'),
-    start_time = time.time()
-
     # Define filepath    
     root = '/luscinia/ProstateStudy/invivo/Patient'
     inputspath = '/Registration/RegistrationInputs/'
 
     # Save Ultrasound Files
-    slicer.util.saveNode(inputARFI,              (root+PatientNumber+inputspath+'us_ARFI.nii'))
-    slicer.util.saveNode(inputBmode,             (root+PatientNumber+inputspath+'us_Bmode.nii'))
-    slicer.util.saveNode(inputCC,                (root+PatientNumber+inputspath+'us_ARFICCMask.nrrd'))
-    slicer.util.saveNode(outputUSCaps_Seg,       (root+PatientNumber+inputspath+'us_cap-label.nrrd'))
-    slicer.util.saveNode(outputUSCG_Seg,         (root+PatientNumber+inputspath+'us_cg-label.nrrd'))
-    slicer.util.saveNode(outputUSVM_Seg,         (root+PatientNumber+inputspath+'us_urethra-label.nrrd'))
-    slicer.util.saveNode(outputUSIndex_Seg,      (root+PatientNumber+inputspath+'us_indexlesion-label.nrrd'))
-    slicer.util.saveNode(outputUSRegister_Label, (root+PatientNumber+inputspath+'us_registration-label.nrrd'))
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    # Return time elapsed
-    return float(end_time-start_time)
-
+    self.saveNode(inputARFI,              (root+PatientNumber+inputspath+'us_ARFI.nii'))
+    self.saveNode(inputBmode,             (root+PatientNumber+inputspath+'us_Bmode.nii'))
+    self.saveNode(inputCC,                (root+PatientNumber+inputspath+'us_ARFICCMask.nrrd'))
+    self.saveNode(outputUSCaps_Seg,       (root+PatientNumber+inputspath+'us_cap-label.nrrd'))
+    self.saveNode(outputUSCG_Seg,         (root+PatientNumber+inputspath+'us_cg-label.nrrd'))
+    self.saveNode(outputUSVM_Seg,         (root+PatientNumber+inputspath+'us_urethra-label.nrrd'))
+    self.saveNode(outputUSIndex_Seg,      (root+PatientNumber+inputspath+'us_indexlesion-label.nrrd'))
+    self.saveNode(outputUSRegister_Label, (root+PatientNumber+inputspath+'us_registration-label.nrrd'))
+
+  @traced('Saving MRI Results')
   def SaveMRRegistrationInputs(self, PatientNumber, inputT2, outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label):
     """ Saves MRI volumes and labelmaps after preprocessing prior to registration
     """
-    # Print to Slicer CLI
-    print('Saving MRI Results...'),
-    start_time = time.time()
-
     # Define filepath    
     root = '/luscinia/ProstateStudy/invivo/Patient'
     inputspath = '/Registration/RegistrationInputs/'
 
     # Save MRI Files
-    slicer.util.saveNode(inputT2,                (root+PatientNumber+inputspath+'mr_T2_AXIAL.nii'))
-    slicer.util.saveNode(outputMRCaps_Seg,       (root+PatientNumber+inputspath+'mr_cap-label.nrrd'))
-    slicer.util.saveNode(outputMRCG_Seg,         (root+PatientNumber+inputspath+'mr_cg-label.nrrd'))
-    slicer.util.saveNode(outputMRVM_Seg,         (root+PatientNumber+inputspath+'mr_urethra-label.nrrd'))
-    slicer.util.saveNode(outputMRIndex_Seg,      (root+PatientNumber+inputspath+'mr_indexlesion-label.nrrd'))
-    slicer.util.saveNode(outputMRRegister_Label, (root+PatientNumber+inputspath+'mr_registration-label.nrrd'))
-
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    # Return time elapsed
-    return float(end_time-start_time)
-
+    self.saveNode(inputT2,                (root+PatientNumber+inputspath+'mr_T2_AXIAL.nii'))
+    self.saveNode(outputMRCaps_Seg,       (root+PatientNumber+inputspath+'mr_cap-label.nrrd'))
+    self.saveNode(outputMRCG_Seg,         (root+PatientNumber+inputspath+'mr_cg-label.nrrd'))
+    self.saveNode(outputMRVM_Seg,         (root+PatientNumber+inputspath+'mr_urethra-label.nrrd'))
+    self.saveNode(outputMRIndex_Seg,      (root+PatientNumber+inputspath+'mr_indexlesion-label.nrrd'))
+    self.saveNode(outputMRRegister_Label, (root+PatientNumber+inputspath+'mr_registration-label.nrrd'))
+
+  @traced('Loading Ultrasound Inputs')
   def loadUSInputs(self,PatientNumber):
     """ Loads Ultrasound inputs from designated location on luscinia to nodes in the scene. If inputs are not present, saves node variable as a string with missing filepath for error output
     """
+    inputFiles = inputFileSpecs(PatientNumber, 'US')
+    nodes = self.loadInputFiles([(inputRoot+path, kind) for name, path, kind in inputFiles])
 
-    # Print to Slicer CLI
-    print('Loading Ultrasound Inputs...'),
-    start_time = time.time()
-
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/ARFI_Norm_HistEq.nii.gz'):
-        inputARFI = slicer.util.getNode('ARFI_Norm_HistEq')
-    else:
-        inputARFI = '/invivo/Patient'+PatientNumber+'/slicer/ARFI_Norm_HistEq.nii.gz'
-
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/Bmode.nii.gz'):
-        inputBmode = slicer.util.getNode('Bmode')
-    else: 
-        inputBmode = '/invivo/Patient'+PatientNumber+'/slicer/Bmode.nii.gz'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/ARFI_CC_Mask.nii.gz'):
-        inputCC = slicer.util.getNode('ARFI_CC_Mask')
-    else:
-        inputCC = '/invivo/Patient'+PatientNumber+'/slicer/ARFI_CC_Mask.nii.gz'
-
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_cap.vtk'):
-        inputUSCaps_Model = slicer.util.getNode('us_cap')
-    else:
-        inputUSCaps_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_cap.vtk'
-
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_cg.vtk'):
-        inputUSCG_Model = slicer.util.getNode('us_cg')
-    else:
-        inputUSCG_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_cg.vtk'
-
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_urethra.vtk'):
-        inputUSVM_Model = slicer.util.getNode('us_urethra')
-    else:
-        inputUSVM_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_urethra.vtk'
-
-    if slicer.util.loadModel('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/slicer/us_lesion1.vtk'):
-        inputUSIndex_Model = slicer.util.getNode('us_lesion1')
-    else:
-        inputUSIndex_Model = '/invivo/Patient'+PatientNumber+'/slicer/us_lesion1.vtk'
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model
+    # inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model
+    return tuple(node or path for node, (name, path, kind) in zip(nodes, inputFiles))
 
+  @traced('Loading MRI Inputs')
   def loadMRInputs(self,PatientNumber):
     """ Loads Ultrasound inputs from designated location on luscinia to nodes in the scene
     """
+    inputFiles = inputFileSpecs(PatientNumber, 'MR')
+    nodes = self.loadInputFiles([(inputRoot+path, kind) for name, path, kind in inputFiles])
 
-    # Print to Slicer CLI
-    print('Loading MRI Inputs...'),
-    start_time = time.time()
-
-    if slicer.util.loadVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/T2/P'+PatientNumber+'_no_PHI.nii.gz'):
-        inputT2 = slicer.util.getNode('P'+PatientNumber+'_no_PHI')
-    else:
-        inputT2 = '/invivo/Patient'+PatientNumber+'/MRI_Images/T2/P'+PatientNumber+'_no_PHI.nii.gz'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/P'+PatientNumber+'_segmentation_final.nrrd'):
-        inputMRCaps_Seg = slicer.util.getNode('P'+PatientNumber+'_segmentation_final')
-    else:
-        inputMRCaps_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/P'+PatientNumber+'_segmentation_final.nrrd'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_zones_seg.nii.gz'):
-        inputMRZones_Seg = slicer.util.getNode('P'+PatientNumber+'_zones_seg')
-    else:
-        inputMRZones_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_zones_seg.nii.gz'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_urethra_seg.nrrd'):
-        inputMRVM_Seg = slicer.util.getNode('P'+PatientNumber+'_urethra_seg')
-    else:
-        inputMRVM_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Anatomy/P'+PatientNumber+'_urethra_seg.nrrd'
-
-    if slicer.util.loadLabelVolume('/luscinia/ProstateStudy/invivo/Patient'+PatientNumber+'/MRI_Images/Cancer/P'+PatientNumber+'_lesion1_seg.nrrd'):
-        inputMRIndex_Seg = slicer.util.getNode('P'+PatientNumber+'_lesion1_seg')
-    else:
-        inputMRIndex_Seg = '/invivo/Patient'+PatientNumber+'/MRI_Images/Cancer/P'+PatientNumber+'_lesion1_seg.nrrd'
-
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
-    return inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg
+    # inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg
+    return tuple(node or path for node, (name, path, kind) in zip(nodes, inputFiles))
   
+  def loadInputFiles(self, inputFiles, numberOfThreads=None):
+    """ Loads the (path, kind) inputFiles, read in a thread pool or from the input cache. Returns the nodes, None for
+    missing files
+    """
+    inputCache = DecompressedInputCache(self.inputCacheDirectory, self.inputCacheSizeLimit) if self.inputCacheDirectory else None
+
+    def readOrFail(path):
+      try:
+        return inputCache.read(path) if inputCache else readInputFile(path)
+      except Exception as error: # ImportError, unsupported files, ...
+        return error
+
+    pool = ThreadPool(numberOfThreads or max(1, min(len(inputFiles), 8))) # mostly waiting for the file system
+    try:
+      results = pool.map(readOrFail, [path for path, kind in inputFiles])
+    finally:
+      pool.close()
+      pool.join()
+
+    nodes = []
+    for (path, kind), result in zip(inputFiles, results):
+      if result is None:
+        nodes.append(None)
+        continue
+      if isinstance(result, Exception):
+        logging.warning('Parallel loading of %s failed (%s), using slicer.util instead' % (path, result))
+        load = {'volume': slicer.util.loadVolume, 'label': slicer.util.loadLabelVolume, 'model': slicer.util.loadModel}[kind]
+        nodes.append(slicer.util.getNode(inputNodeName(path)) if load(path) else None)
+        continue
+
+      if kind == 'model':
+        node = slicer.vtkMRMLModelNode()
+      elif kind == 'label':
+        node = slicer.vtkMRMLLabelMapVolumeNode()
+      else:
+        node = slicer.vtkMRMLScalarVolumeNode()
+      node.SetName(result['name'])
+      slicer.mrmlScene.AddNode(node)
+      if kind == 'model':
+        node.SetAndObservePolyData(result['polyData'])
+      else:
+        node.SetIJKToRASMatrix(result['ijkToRAS'])
+        node.SetAndObserveImageData(result['imageData'])
+      node.CreateDefaultDisplayNodes()
+      node.CreateDefaultStorageNode()
+      logging.info('Loaded %s: read %0.2f s, convert %0.2f s%s' % (path, result['readTime'], result['convertTime'],
+                                                                   ' (input cache)' if result.get('cached') else ''))
+      nodes.append(node)
+    return nodes
+
   def CreateNewLabelVolume(self,name):
     """ Creates a new labelmap volume with the inputted name
     """
@@ -698,44 +1152,30 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
 
     return labelNode
 
+  @traced('Preallocating Ultrasound Outputs')
   def createUSOutputs(self):
     """ Preallocates output labelmaps with correct names for US
     """
 
-    # Print to Slicer CLI
-    print('Preallocating Ultrasound Outputs...'),
-    start_time = time.time()
-
     outputUSCaps_Seg =       self.CreateNewLabelVolume('us_cap-label')
     outputUSCG_Seg =         self.CreateNewLabelVolume('us_cg-label')
     outputUSVM_Seg =         self.CreateNewLabelVolume('us_urethra-label')
     outputUSIndex_Seg =      self.CreateNewLabelVolume('us_indexlesion-label')
     outputUSRegister_Label = self.CreateNewLabelVolume('us_registration-label')
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
     return outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label
 
+  @traced('Preallocating MRI Outputs')
   def createMROutputs(self):
     """ Preallocates output labelmaps with correct names for MR
     """
 
-    # Print to Slicer CLI
-    print('Preallocating MRI Outputs...'),
-    start_time = time.time()
-
     outputMRCaps_Seg =       self.CreateNewLabelVolume('mr_cap-label')
     outputMRCG_Seg =         self.CreateNewLabelVolume('mr_cg-label')
     outputMRVM_Seg =         self.CreateNewLabelVolume('mr_urethra-label')
     outputMRIndex_Seg =      self.CreateNewLabelVolume('mr_indexlesion-label')
     outputMRRegister_Label = self.CreateNewLabelVolume('mr_registration-label')
 
-    # print to Slicer CLI
-    end_time = time.time()
-    print('done (%0.2f s)') % float(end_time-start_time)
-
     return outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label
 
   def CheckAllInputsPresent(self, *inputNodes):
@@ -754,38 +1194,244 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
         return False
 
 
-  def run(self, PatientNumber, SaveDataBool):
-  #"""
-  #      inputARFI,   inputBmode,  inputCC,  inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model,  inputUSIndex_Model,
-  #                                          outputUSCaps_Seg,  outputUSCG_Seg,  outputUSVM_Seg,   outputUSIndex_Seg,  outputUSRegister_Label,
-  #      inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg, 
-  #                outputMRCaps_Seg, outputMRCG_Seg,    outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label):"""
+  def createPipelineStages(self, products):
+    """ Declares the processing steps of run() as PipelineStages. Product names are the node names used in run(),
+    with a ':step' suffix for the state of a node after a step that changes it
     """
-    Run the actual algorithm
+    inputARFI, inputCC, inputT2 = products['inputARFI'], products['inputCC'], products['inputT2']
+    inputUSCaps_Model, inputUSCG_Model = products['inputUSCaps_Model'], products['inputUSCG_Model']
+    inputUSVM_Model, inputUSIndex_Model = products['inputUSVM_Model'], products['inputUSIndex_Model']
+    inputMRCaps_Seg, inputMRZones_Seg = products['inputMRCaps_Seg'], products['inputMRZones_Seg']
+    inputMRVM_Seg, inputMRIndex_Seg = products['inputMRVM_Seg'], products['inputMRIndex_Seg']
+    outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg = products['outputUSCaps_Seg'], products['outputUSCG_Seg'], products['outputUSVM_Seg']
+    outputUSIndex_Seg, outputUSRegister_Label = products['outputUSIndex_Seg'], products['outputUSRegister_Label']
+    outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg = products['outputMRCaps_Seg'], products['outputMRCG_Seg'], products['outputMRVM_Seg']
+    outputMRIndex_Seg, outputMRRegister_Label = products['outputMRIndex_Seg'], products['outputMRRegister_Label']
+    useCLI = self.useCLI # part of the cache key of every cacheable stage, the CLI and native results differ slightly
+    roiMargin = self.roiMargin
+
+    def createUSLabels():
+      # Change label map values for output labels before saving
+      self.ThresholdScalarVolume(outputUSCaps_Seg,  1)  #(input volume, new label value for nonzero pixels) # 1 for Capsule
+      self.ThresholdScalarVolume(outputUSCG_Seg,    2)  # 2 is CG label
+      self.ThresholdScalarVolume(outputUSVM_Seg,    3)  # 3 for VM
+      self.ThresholdScalarVolume(outputUSIndex_Seg, 34) # 34 for index tumor
+      self.ThresholdScalarVolume(inputCC,         255) # 255 for CC Mask label
+
+      # Create output registration labelmap combining Capsule, CG, and VM labelmaps (10 for registration label)
+      self.CreateRegistrationLabel(outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSRegister_Label, 10)
+
+    def createMRLabels():
+      # Change label map values for output labels before saving
+      self.ThresholdScalarVolume(outputMRCaps_Seg,  1)  # 1 for MRI Capsule
+      self.ThresholdScalarVolume(outputMRCG_Seg,    2)  # 2 is CG label
+      self.ThresholdScalarVolume(outputMRVM_Seg,    3)  # 3 for VM
+      self.ThresholdScalarVolume(outputMRIndex_Seg, 34) # 34 for index tumor
+
+      # Create output registration labelmap combining Capsule, CG, and VM labelmaps (10 for registration label)
+      self.CreateRegistrationLabel(outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRRegister_Label, 10)
+
+    # The MR translation only needs the bounds of the MR capsule, which are taken from the smoothed label directly
+    # unless useCLI is set, in which case a Model Maker model of the capsule is made for them as before
+    if useCLI:
+      mrCapsule = 'intermediateMRCaps_Model'
+      mrCapsuleStages = [
+        # Make Model of MRI input capsule segmentation using Model Maker Module for MRI translation coordinates
+        PipelineStage('MakeMRCapsuleModel', ['inputMRCaps_Seg:smoothed'], {'intermediateMRCaps_Model': None},
+                      lambda: self.MRCapModelMaker(inputMRCaps_Seg),
+                      lambda: {'intermediateMRCaps_Model': slicer.util.getNode('mr-cap_1_1')},
+                      parameters={'smooth': 70}, cacheable=True)]
+    else:
+      mrCapsule = 'inputMRCaps_Seg:smoothed'
+      mrCapsuleStages = []
+
+    if self.transferMRLabels:
+      mrLesionStages = [
+        # Move the MRI veramontanum and tumor labels onto ARFI in the label domain, the sigmas stand in for the
+        # Model Maker smoothing of 30 and 20 (compareLabelTransfer shows how close the labels are)
+        PipelineStage('TransferMRLabels', ['inputARFI', 'inputMRVM_Seg:translated', 'inputMRIndex_Seg:translated'],
+                      {'outputMRVM_Seg:rasterized': outputMRVM_Seg, 'outputMRIndex_Seg:rasterized': outputMRIndex_Seg},
+                      lambda: self.transferLabels(inputARFI, [(inputMRVM_Seg, outputMRVM_Seg, 0.75, 10),
+                                                              (inputMRIndex_Seg, outputMRIndex_Seg, 0.5, 10)]),
+                      parameters={'labelValue': 10, 'sigmas': [0.75, 0.5]}, cacheable=True)]
+    else:
+      mrLesionStages = [
+        # Make models of MRI index lesion and veramontanum
+        # (modelmaker needs the segmentation label at 34, so the segmentation is changed too)
+        PipelineStage('MakeMRIndexModel', ['inputMRIndex_Seg:translated'],
+                      {'inputMRIndex_Model': None, 'inputMRIndex_Seg:thresholded': inputMRIndex_Seg},
+                      lambda: self.MRModelMaker(inputMRIndex_Seg, 20, 'mr-indexlesion'), # smooth 20
+                      lambda: {'inputMRIndex_Model': slicer.util.getNode('mr-indexlesion_34_34')},
+                      parameters={'smooth': 20, 'name': 'mr-indexlesion', 'useCLI': useCLI}, cacheable=True),
+        PipelineStage('MakeMRVMModel', ['inputMRVM_Seg:translated'], {'inputMRVM_Model': None, 'inputMRVM_Seg:thresholded': inputMRVM_Seg},
+                      lambda: self.MRModelMaker(inputMRVM_Seg, 30, 'mr-urethra'), # smooth 30
+                      lambda: {'inputMRVM_Model': slicer.util.getNode('mr-urethra_34_34')},
+                      parameters={'smooth': 30, 'name': 'mr-urethra', 'useCLI': useCLI}, cacheable=True),
+
+        # Model to labelmap for MRI veramontanum and tumor models (** LONG STEP **)
+        PipelineStage('RasterizeMRModels', ['inputARFI', 'inputMRVM_Model', 'inputMRIndex_Model'],
+                      {'outputMRVM_Seg:rasterized': outputMRVM_Seg, 'outputMRIndex_Seg:rasterized': outputMRIndex_Seg},
+                      lambda: self.ModelsToLabelMap(inputARFI, [(products['inputMRVM_Model'], outputMRVM_Seg, 10),
+                                                                (products['inputMRIndex_Model'], outputMRIndex_Seg, 10)], 0.1),
+                      parameters={'labelValue': 10, 'sampleDistance': 0.1, 'useCLI': useCLI}, cacheable=True)]
+
+    return [
+      # Model to labelmap for ultrasound veramontanum and tumor models (** LONG STEP **), only needs the ultrasound inputs
+      PipelineStage('RasterizeUSModels', ['inputARFI', 'inputUSVM_Model', 'inputUSIndex_Model'],
+                    {'outputUSVM_Seg:rasterized': outputUSVM_Seg, 'outputUSIndex_Seg:rasterized': outputUSIndex_Seg},
+                    lambda: self.ModelsToLabelMap(inputARFI, [(inputUSVM_Model, outputUSVM_Seg, 10),
+                                                              (inputUSIndex_Model, outputUSIndex_Seg, 10)], 0.1),
+                    parameters={'labelValue': 10, 'sampleDistance': 0.1, 'useCLI': useCLI}, cacheable=True),
+
+      # Smooth MR Final Segmentation to turn into single labelmap of capsule
+      PipelineStage('SmoothMRCapsule', ['inputMRCaps_Seg'], {'inputMRCaps_Seg:smoothed': inputMRCaps_Seg},
+                    lambda: self.SegmentationSmoothing(inputMRCaps_Seg, inputMRCaps_Seg),
+                    parameters={'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+    ] + mrCapsuleStages + [
+      # Transform MRI inputs to match Ultrasound so that MR capsule fits in US volume prior to registration
+      PipelineStage('TranslateMR', [mrCapsule, 'inputUSCaps_Model', 'inputT2', 'inputMRZones_Seg', 'inputMRVM_Seg', 'inputMRIndex_Seg'],
+                    {'inputT2:translated': inputT2, 'inputMRCaps_Seg:translated': inputMRCaps_Seg, 'inputMRZones_Seg:translated': inputMRZones_Seg,
+                     'inputMRVM_Seg:translated': inputMRVM_Seg, 'inputMRIndex_Seg:translated': inputMRIndex_Seg},
+                    lambda: self.MR_translate(products['intermediateMRCaps_Model'] if useCLI else inputMRCaps_Seg, inputUSCaps_Model,
+                                              inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg)),
+    ] + mrLesionStages + [
+      # Convert US Capsule and CG models to labelmap on translated T2 volume (use T2 for faster conversion since larger image spacing)
+      PipelineStage('RasterizeUSCapsuleCG', ['inputT2:translated', 'inputUSCaps_Model', 'inputUSCG_Model'],
+                    {'outputUSCaps_Seg:rasterized': outputUSCaps_Seg, 'outputUSCG_Seg:rasterized': outputUSCG_Seg},
+                    lambda: self.ModelsToLabelMap(inputT2, [(inputUSCaps_Model, outputUSCaps_Seg, 10), (inputUSCG_Model, outputUSCG_Seg, 10)], 0.25),
+                    parameters={'labelValue': 10, 'sampleDistance': 0.25, 'useCLI': useCLI}, cacheable=True),
+
+      # Use Segmentation Smoothing Module on US and MRI Capsule and US CG labels
+      PipelineStage('SmoothUSCapsule', ['outputUSCaps_Seg:rasterized'], {'outputUSCaps_Seg:smoothed': outputUSCaps_Seg},
+                    lambda: self.SegmentationSmoothing(outputUSCaps_Seg, outputUSCaps_Seg), # (inputVolume, outputVolume)
+                    parameters={'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+      PipelineStage('SmoothUSCG', ['outputUSCG_Seg:rasterized'], {'outputUSCG_Seg:smoothed': outputUSCG_Seg},
+                    lambda: self.SegmentationSmoothing(outputUSCG_Seg, outputUSCG_Seg),
+                    parameters={'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+      PipelineStage('SmoothMRCapsuleLabel', ['inputMRCaps_Seg:translated'], {'outputMRCaps_Seg:smoothed': outputMRCaps_Seg},
+                    lambda: self.SegmentationSmoothing(inputMRCaps_Seg, outputMRCaps_Seg),
+                    parameters={'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+
+      # Use Segmentation Smoothing on MRI zones seg to pick out and smooth only central gland values
+      PipelineStage('SmoothMRCGLabel', ['inputMRZones_Seg:translated'], {'outputMRCG_Seg:smoothed': outputMRCG_Seg},
+                    lambda: self.SegmentationSmoothing(inputMRZones_Seg, outputMRCG_Seg, 9), # label value 9
+                    parameters={'labelNumber': 9, 'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+
+      # Resample all segmentations and volumes to match ARFI spacing, size, orientation, origin
+      # (the US capsule and CG stages must be done with the T2 grid before it is resampled)
+      PipelineStage('ResampleToARFI', ['inputARFI', 'outputUSCaps_Seg:smoothed', 'outputUSCG_Seg:smoothed',
+                                       'outputMRCaps_Seg:smoothed', 'outputMRCG_Seg:smoothed', 'inputT2:translated'],
+                    {'outputUSCaps_Seg:resampled': outputUSCaps_Seg, 'outputUSCG_Seg:resampled': outputUSCG_Seg,
+                     'outputMRCaps_Seg:resampled': outputMRCaps_Seg, 'outputMRCG_Seg:resampled': outputMRCG_Seg, 'inputT2:resampled': inputT2},
+                    lambda: self.ResampleVolumefromReference(inputARFI, outputUSCaps_Seg, outputUSCG_Seg, outputMRCaps_Seg, outputMRCG_Seg, inputT2),
+                    parameters={'useCLI': useCLI}, cacheable=True),
+
+      # Additional smoothing of output labelmaps in label map smoothing module using sigma = 3 (SlicerProstate manuscript)
+      PipelineStage('LabelSmoothUSCapsule', ['outputUSCaps_Seg:resampled'], {'outputUSCaps_Seg:labelsmoothed': outputUSCaps_Seg},
+                    lambda: self.LabelMapSmoothing(outputUSCaps_Seg, 1), #(input/output volume, sigma, [label to smooth-optional])
+                    parameters={'sigma': 1, 'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+      PipelineStage('LabelSmoothUSCG', ['outputUSCG_Seg:resampled'], {'outputUSCG_Seg:labelsmoothed': outputUSCG_Seg},
+                    lambda: self.LabelMapSmoothing(outputUSCG_Seg, 1),
+                    parameters={'sigma': 1, 'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+      PipelineStage('LabelSmoothMRCapsule', ['outputMRCaps_Seg:resampled'], {'outputMRCaps_Seg:labelsmoothed': outputMRCaps_Seg},
+                    lambda: self.LabelMapSmoothing(outputMRCaps_Seg, 1),
+                    parameters={'sigma': 1, 'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+      PipelineStage('LabelSmoothMRCG', ['outputMRCG_Seg:resampled'], {'outputMRCG_Seg:labelsmoothed': outputMRCG_Seg},
+                    lambda: self.LabelMapSmoothing(outputMRCG_Seg, 1),
+                    parameters={'sigma': 1, 'roiMargin': roiMargin, 'useCLI': useCLI}, cacheable=True),
+
+      # Final label values and registration labelmaps for MR and US
+      PipelineStage('CreateUSLabels', ['outputUSCaps_Seg:labelsmoothed', 'outputUSCG_Seg:labelsmoothed', 'outputUSVM_Seg:rasterized',
+                                       'outputUSIndex_Seg:rasterized', 'inputCC'],
+                    {'outputUSCaps_Seg:final': outputUSCaps_Seg, 'outputUSCG_Seg:final': outputUSCG_Seg, 'outputUSVM_Seg:final': outputUSVM_Seg,
+                     'outputUSIndex_Seg:final': outputUSIndex_Seg, 'inputCC:final': inputCC, 'outputUSRegister_Label:final': outputUSRegister_Label},
+                    createUSLabels),
+      PipelineStage('CreateMRLabels', ['outputMRCaps_Seg:labelsmoothed', 'outputMRCG_Seg:labelsmoothed', 'outputMRVM_Seg:rasterized',
+                                       'outputMRIndex_Seg:rasterized'],
+                    {'outputMRCaps_Seg:final': outputMRCaps_Seg, 'outputMRCG_Seg:final': outputMRCG_Seg, 'outputMRVM_Seg:final': outputMRVM_Seg,
+                     'outputMRIndex_Seg:final': outputMRIndex_Seg, 'outputMRRegister_Label:final': outputMRRegister_Label},
+                    createMRLabels),
+      ]
+
+  def run(self, PatientNumber, SaveDataBool, maxConcurrentStages=2, resume=False):
+    """
+    Run the actual algorithm. Up to maxConcurrentStages processing stages run at the same time (1 runs them one after another).
+    With a workingDirectory, resume restores the stages a previous run of the patient completed and continues from there.
+    With a traceDirectory, the timing of all processing steps is written there as a Chrome trace.
+    With monitorMemory, the memory use of the stages and the nodes left in the scene are printed (and traced).
+    With writeBehind, the files are written in the background while the results are saved; run returns once they are written
     """
-
     # Print to Slicer CLI
     logging.info('\n\nProcessing started')
-    start_time_overall = time.time() # start timer
     print('Expected Algorithm Time: 270 seconds') # based on previous trials of the algorithm
 
-    # Load Ultrasound Inputs
-    inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model = self.loadUSInputs(PatientNumber)
+    tracePath = None
+    if self.traceDirectory:
+        tracePath = os.path.join(self.traceDirectory, 'PreProcess-Patient%s-%s.json' % (PatientNumber, time.strftime('%Y%m%d-%H%M%S')))
+    with tracing(tracePath, patient=PatientNumber):
+        memoryMonitor = SceneMemoryMonitor() if self.monitorMemory else None
+        runSpan = traceSpan('PreProcessLogic.run', maxConcurrentStages=maxConcurrentStages, resume=resume)
+        try:
+            with runSpan:
+                total_savetime = self.processPatient(PatientNumber, SaveDataBool, maxConcurrentStages, resume, memoryMonitor)
+        except Exception:
+            print('Processing failed after % 0.1f seconds' % runSpan.elapsed)
+            raise
+        finally:
+            # Also report the memory of failed runs, they are the ones to look into
+            if memoryMonitor:
+                memoryMonitor.report()
+    if total_savetime is None:
+        return
 
-    # Create Ultrasound Outputs
-    outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label = self.createUSOutputs()
-    
-    # Load MRI Inputs
-    inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg = self.loadMRInputs(PatientNumber)
+    # Print Completion Status to Slicer CLI
+    logging.info('Processing completed')
+    print('Overall Algorithm Time: % 0.1f seconds') % float(runSpan.elapsed-total_savetime)
+    if SaveDataBool:
+        print('Overall Saving Time: % 0.1f seconds') % float(total_savetime)
+    print('Overall Elapsed Time: % 0.1f seconds') % float(runSpan.elapsed)
 
-    # Create MR Outputs
-    outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label = self.createMROutputs()
+    return True
+
+  def processPatient(self, PatientNumber, SaveDataBool, maxConcurrentStages, resume, memoryMonitor=None):
+  #"""
+  #      inputARFI,   inputBmode,  inputCC,  inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model,  inputUSIndex_Model,
+  #                                          outputUSCaps_Seg,  outputUSCG_Seg,  outputUSVM_Seg,   outputUSIndex_Seg,  outputUSRegister_Label,
+  #      inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg, 
+  #                outputMRCaps_Seg, outputMRCG_Seg,    outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label):"""
+    """
+    Loads, processes and (if SaveDataBool) saves one patient for run(). Returns the time spent saving, or None if inputs are missing
+    """
+    # Fail before loading anything if input files are missing or inconsistent
+    validation = self.validateInputs(PatientNumber, deep=self.deepValidation)
+    if not validation['valid']:
+        print "Exiting process. Inputs not valid: %s" % validationErrors(validation)
+        return None
+
+    if memoryMonitor:
+        memoryMonitor.stageStarted('Load')
+    try:
+        with traceSpan('Load'):
+            # Load Ultrasound Inputs
+            inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model = self.loadUSInputs(PatientNumber)
+
+            # Create Ultrasound Outputs
+            outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label = self.createUSOutputs()
+
+            # Load MRI Inputs
+            inputT2, inputMRCaps_Seg, inputMRZones_Seg, inputMRVM_Seg, inputMRIndex_Seg = self.loadMRInputs(PatientNumber)
+
+            # Create MR Outputs
+            outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label = self.createMROutputs()
+    finally:
+        if memoryMonitor:
+            memoryMonitor.stageFinished('Load')
 
     # Check if all inputs present
     if not self.CheckAllInputsPresent(inputARFI, inputBmode, inputCC, inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model, inputUSIndex_Model, 
                                       inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg):
         print "Exiting process. Not all inputs supplied."
-        return
+        return None
     
     # Center all of the volume inputs
     self.CenterVolume(inputARFI, inputBmode, inputCC, inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg, inputMRIndex_Seg)
@@ -793,90 +1439,43 @@ class PreProcessLogic(ScriptedLoadableModuleLogic):
     # # Transform all US inputs using inversion transform
     self.US_transform(inputARFI,   inputBmode,  inputCC,  inputUSCaps_Model, inputUSCG_Model, inputUSVM_Model,  inputUSIndex_Model)
 
-    # Smooth MR Final Segmentation to turn into single labelmap of capsule
-    self.SegmentationSmoothing(inputMRCaps_Seg, inputMRCaps_Seg)
-    
-    # Make Model of MRI input capsule segmentation using Model Maker Module for MRI translation coordinates
-    intermediateMRCaps_Model = self.MRCapModelMaker(inputMRCaps_Seg)
-
-    # # Transform MRI inputs to match Ultrasound so that MR capsule fits in US volume prior to registration
-    self.MR_translate(intermediateMRCaps_Model, inputUSCaps_Model, inputT2,  inputMRCaps_Seg,  inputMRZones_Seg,  inputMRVM_Seg,  inputMRIndex_Seg) # add more MRI inputs to the function
-
-    # Make models of MRI index lesion and veramontanum
-    inputMRIndex_Model = self.MRModelMaker(inputMRIndex_Seg, 20) # smooth 20
-    inputMRVM_Model    = self.MRModelMaker(inputMRVM_Seg,    30) # smooth 30
-
-    # Convert US Capsule and CG models to labelmap on T2 volume (use T2 for faster conversion since larger image spacing)
-    self.ModelToLabelMap(inputT2, inputUSCaps_Model, outputUSCaps_Seg, 0.25)
-    self.ModelToLabelMap(inputT2, inputUSCG_Model, outputUSCG_Seg, 0.25)
-
-    # Use Segmentation Smoothing Module on US and MRI Capsule and US CG labels
-    self.SegmentationSmoothing(outputUSCaps_Seg, outputUSCaps_Seg) # (inputVolume, outputVolume)
-    self.SegmentationSmoothing(outputUSCG_Seg,   outputUSCG_Seg) # define input and output as same volume to keep segmentation applied to output
-    self.SegmentationSmoothing(inputMRCaps_Seg,  outputMRCaps_Seg)
-
-    # Use Segmentation Smoothing on MRI zones seg to pick out and smooth only central gland values
-    self.SegmentationSmoothing(inputMRZones_Seg, outputMRCG_Seg, 9) # label value 9
-
-    # Resample all segmentations and volumes to match ARFI spacing, size, orientation, origin
-    self.ResampleVolumefromReference(inputARFI, outputUSCaps_Seg, outputUSCG_Seg, outputMRCaps_Seg, outputMRCG_Seg, inputT2)
-
-    # Additional smoothing of output labelmaps in label map smoothing module using sigma = 3 (SlicerProstate manuscript)
-    self.LabelMapSmoothing(outputUSCaps_Seg, 1) #(input/output volume, sigma for gaussian smoothing, [label to smooth-optional])
-    self.LabelMapSmoothing(outputUSCG_Seg,   1)
-    self.LabelMapSmoothing(outputMRCaps_Seg, 1)
-    self.LabelMapSmoothing(outputMRCG_Seg,   1)
-
-    # Model to labelmap for veramontanum models (** LONG STEP **)
-    self.ModelToLabelMap(inputARFI, inputUSVM_Model, outputUSVM_Seg, 0.1)
-    self.ModelToLabelMap(inputARFI, inputMRVM_Model, outputMRVM_Seg, 0.1)
-
-    # Model to labelmap for tumor models for ARFI and MRI (** LONG STEP **)
-    self.ModelToLabelMap(inputARFI, inputUSIndex_Model, outputUSIndex_Seg, 0.1)
-    self.ModelToLabelMap(inputARFI, inputMRIndex_Model, outputMRIndex_Seg, 0.1)
-
-    # Change Label Value for MRI registration label
-    # self.MRVMLabelValueProcess(outputMRVM_Seg)
-    
-    ### Change label map values for output labels before saving
-    # For Ultrasound
-    self.ThresholdScalarVolume(outputUSCaps_Seg,  1)  #(input volume, new label value for nonzero pixels) # 1 for Capsule
-    self.ThresholdScalarVolume(outputUSCG_Seg,    2)  # 2 is CG label
-    self.ThresholdScalarVolume(outputUSVM_Seg,    3)  # 3 for VM
-    self.ThresholdScalarVolume(outputUSIndex_Seg, 34) # 34 for index tumor
-    self.ThresholdScalarVolume(inputCC,         255) # 255 for CC Mask label
-
-    # For MRI
-    self.ThresholdScalarVolume(outputMRCaps_Seg,  1)  # 1 for MRI Capsule
-    self.ThresholdScalarVolume(outputMRCG_Seg,    2)  # 2 is CG label
-    self.ThresholdScalarVolume(outputMRVM_Seg,    3)  # 3 for VM
-    self.ThresholdScalarVolume(outputMRIndex_Seg, 34) # 34 for index tumor
-
-    # Create output registration labelmap for MR and US combining Capsule, CG, and VM labelmaps
-    self.CreateRegistrationLabel(outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSRegister_Label) # for ultrasound
-    self.CreateRegistrationLabel(outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRRegister_Label) # for ultrasound
-
-    # Change label value for registration labels
-    self.ThresholdScalarVolume(outputUSRegister_Label, 10) # 10 for registration label
-    self.ThresholdScalarVolume(outputMRRegister_Label, 10) # 10 for registration label
+    # Name the nodes the processing stages start from
+    products = {'inputARFI': inputARFI, 'inputBmode': inputBmode, 'inputCC': inputCC,
+                'inputUSCaps_Model': inputUSCaps_Model, 'inputUSCG_Model': inputUSCG_Model,
+                'inputUSVM_Model': inputUSVM_Model, 'inputUSIndex_Model': inputUSIndex_Model,
+                'inputT2': inputT2, 'inputMRCaps_Seg': inputMRCaps_Seg, 'inputMRZones_Seg': inputMRZones_Seg,
+                'inputMRVM_Seg': inputMRVM_Seg, 'inputMRIndex_Seg': inputMRIndex_Seg,
+                'outputUSCaps_Seg': outputUSCaps_Seg, 'outputUSCG_Seg': outputUSCG_Seg, 'outputUSVM_Seg': outputUSVM_Seg,
+                'outputUSIndex_Seg': outputUSIndex_Seg, 'outputUSRegister_Label': outputUSRegister_Label,
+                'outputMRCaps_Seg': outputMRCaps_Seg, 'outputMRCG_Seg': outputMRCG_Seg, 'outputMRVM_Seg': outputMRVM_Seg,
+                'outputMRIndex_Seg': outputMRIndex_Seg, 'outputMRRegister_Label': outputMRRegister_Label}
+
+    # Run the processing stages (independent ultrasound and MRI stages run concurrently)
+    # (unchanged stages are loaded from the stage cache if there is one)
+    # (finished stages are checkpointed and, when resuming, restored from the patient working directory)
+    cache = StageCache(self.cacheDirectory, self.cacheSizeLimit) if self.cacheDirectory else None
+    checkpoint = StageCheckpoint(os.path.join(self.workingDirectory, 'Patient'+PatientNumber), resume) if self.workingDirectory else None
+    scheduler = PipelineScheduler(maxConcurrentStages, cache=cache, checkpoint=checkpoint, memoryMonitor=memoryMonitor)
+    scheduler.execute(self.createPipelineStages(products), products)
 
     # Save data if user specifies and figure out time required to save data
-    if SaveDataBool:
-        US_savetime = self.SaveUSRegistrationInputs(PatientNumber, inputARFI,   inputBmode,  inputCC, outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label)
-        MR_savetime = self.SaveMRRegistrationInputs(PatientNumber, inputT2,                           outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label)
-        total_savetime = US_savetime + MR_savetime
-    else:
-        total_savetime = 0
-        
-    # Print Completion Status to Slicer CLI
-    end_time_overall = time.time()
-    logging.info('Processing completed')
-    print('Overall Algorithm Time: % 0.1f seconds') % float(end_time_overall-start_time_overall-total_savetime)
-    if SaveDataBool:
-        print('Overall Saving Time: % 0.1f seconds') % float(total_savetime)
-    print('Overall Elapsed Time: % 0.1f seconds') % float(end_time_overall-start_time_overall)
-
-    return True
+    if not SaveDataBool:
+        return 0
+    if memoryMonitor:
+        memoryMonitor.stageStarted('Save')
+    try:
+        with traceSpan('Save') as saveSpan:
+            self.SaveUSRegistrationInputs(PatientNumber, inputARFI,   inputBmode,  inputCC,
+                                          outputUSCaps_Seg, outputUSCG_Seg, outputUSVM_Seg, outputUSIndex_Seg, outputUSRegister_Label)
+            self.SaveMRRegistrationInputs(PatientNumber, inputT2,
+                                          outputMRCaps_Seg, outputMRCG_Seg, outputMRVM_Seg, outputMRIndex_Seg, outputMRRegister_Label)
+            # The next steps (CreateRegisterLabel, CustomRegister) read the files
+            if not self.waitForPendingWrites():
+                raise IOError('Not all results of patient %s could be saved (see the log)' % PatientNumber)
+    finally:
+        if memoryMonitor:
+            memoryMonitor.stageFinished('Save')
+    return saveSpan.elapsed
 
 class PreProcessTest(ScriptedLoadableModuleTest):
   """
@@ -895,6 +1494,36 @@ class PreProcessTest(ScriptedLoadableModuleTest):
     """
     self.setUp()
     self.test_PreProcess1()
+    self.setUp()
+    self.test_LabelArrayOperations()
+    self.setUp()
+    self.test_RegistrationLabel()
+    self.setUp()
+    self.test_RasterizeModel()
+    self.setUp()
+    self.test_ResampleVolumes()
+    self.setUp()
+    self.test_LabelROI()
+    self.setUp()
+    self.test_SmoothLabelArray()
+    self.setUp()
+    self.test_TransferLabels()
+    self.setUp()
+    self.test_LabelAgreements()
+    self.setUp()
+    self.test_DecompressedInputCache()
+    self.setUp()
+    self.test_SimpleITKRoundTrip()
+    self.setUp()
+    self.test_ResliceArray()
+    self.setUp()
+    self.test_StageCache()
+    self.setUp()
+    self.test_LabelMapSmoothingROI()
+    self.setUp()
+    self.test_LabelMapSmoothingPaths()
+    self.setUp()
+    self.test_BatchCohort()
 
   def test_PreProcess1(self):
     """ Ideally you should have several levels of tests.  At the lowest level
@@ -930,4 +1559,425 @@ class PreProcessTest(ScriptedLoadableModuleTest):
     volumeNode = slicer.util.getNode(pattern="FA")
     logic = PreProcessLogic()
     self.assertTrue( logic.hasImageData(volumeNode) )
-    self.delayDisplay('Test passed!')
\ No newline at end of file
+    self.delayDisplay('Test passed!')
+
+  def createLabelVolume(self, name, voxels):
+    """ Creates a labelmap node in the scene holding the given [k,j,i] nested list of voxel values
+    """
+    voxels = numpy.array(voxels, dtype=numpy.uint8)
+    labelNode = slicer.vtkMRMLLabelMapVolumeNode()
+    labelNode.SetName(name)
+    slicer.mrmlScene.AddNode(labelNode)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+    imageData.AllocateScalars(vtk.VTK_UNSIGNED_CHAR, 1)
+    labelNode.SetAndObserveImageData(imageData)
+    arrayFromVolume(labelNode)[:] = voxels
+    arrayFromVolumeModified(labelNode)
+    return labelNode
+
+  def test_ResampleVolumes(self):
+    """ Nearest neighbor resampling of a labelmap onto a coarser grid
+    """
+    self.delayDisplay("Starting the resampling test")
+    logic = PreProcessLogic()
+
+    label = self.createLabelVolume('label', [[[0, 0, 5, 5]] * 4] * 4) # i = 2, 3 are 5
+    reference = self.createLabelVolume('reference', numpy.zeros((2, 2, 2)))
+    reference.SetSpacing(2, 2, 2)
+    reference.SetOrigin(0.4, 0.4, 0.4) # voxel centers at i = 0.4 and 2.4 of label
+    logic.resampleVolumes(reference, [label])
+
+    self.assertTrue(sameVolumeGeometry(label, reference))
+    self.assertEqual(arrayFromVolume(label).tolist(), [[[0, 5]] * 2] * 2)
+    self.delayDisplay('Test passed!')
+
+  def test_LabelROI(self):
+    """ Cropping to the region of a label and pasting a (here unchanged) result back
+    """
+    self.delayDisplay("Starting the label ROI test")
+    logic = PreProcessLogic()
+
+    voxels = numpy.zeros((10, 10, 10))
+    voxels[4:6, 3:5, 2:4] = 1
+    voxels[0, 0, 0] = 2
+    label = self.createLabelVolume('label', voxels)
+    self.assertEqual(labelBoundingBox(voxels, 1, (1, 0, 2)), (slice(2, 8), slice(3, 5), slice(1, 5)))
+    self.assertEqual(labelBounds(label), (-0.5, 3.5, -0.5, 4.5, -0.5, 5.5))
+
+    roi = logic.cropToLabelROI(label, 1.0, 1)
+    self.assertEqual(arrayFromVolume(roi['input']).shape, (4, 4, 4))
+    allocateVolumeLike(roi['input'], roi['output'])[:] = arrayFromVolume(roi['input'])*3
+    output = self.createLabelVolume('output', [[[0]]])
+    logic.pasteLabelROI(roi, output, keepOutside=False)
+    self.assertTrue(sameVolumeGeometry(label, output))
+    self.assertEqual(arrayFromVolume(output).tolist(), ((voxels == 1)*3).tolist())
+    self.delayDisplay('Test passed!')
+
+  def test_SmoothLabelArray(self):
+    """ Gaussian label smoothing removes a one voxel spike and keeps a cube
+    """
+    self.delayDisplay("Starting the label smoothing test")
+    voxels = numpy.zeros((20, 20, 20), dtype=numpy.uint8)
+    voxels[5:15, 5:15, 5:15] = 3
+    voxels[2, 2, 2] = 3
+    voxels[17, 17, 17] = 1
+    smoothed = smoothLabelArray(voxels, (1, 1, 1), 1.0, numberOfThreads=2)
+    self.assertEqual(smoothed[10, 10, 10], 3)
+    self.assertEqual(smoothed[2, 2, 2], 0)
+    self.assertEqual(smoothed[17, 17, 17], 0) # only the largest label is smoothed by default
+    self.assertGreater(labelAgreement(voxels == 3, smoothed)['dice'], 0.9)
+    self.assertEqual(gaussianSmoothArray(voxels, (1, 1, 1), 1).tolist(), gaussianSmoothArray(voxels, (1, 1, 1), 3).tolist())
+    self.delayDisplay('Test passed!')
+
+  def test_LabelAgreements(self):
+    """ Comparing label pairs packed into bits gives the values of comparing each pair on its own
+    """
+    self.delayDisplay("Starting the label agreements test")
+    masksA = [numpy.zeros((10, 10, 10), dtype=bool) for pair in range(3)]
+    masksB = [numpy.zeros((10, 10, 10), dtype=bool) for pair in range(3)]
+    masksA[0][2:6, 2:6, 2:6] = True
+    masksB[0][3:7, 2:6, 2:6] = True
+    masksA[1][1:9, 1:9, 1:9] = True
+    masksB[1][1:9, 1:9, 1:9] = True
+    masksB[2][5, 5, 5] = True
+    bitsA = sum(mask.astype(numpy.uint8) << pair for pair, mask in enumerate(masksA)).astype(numpy.uint8)
+    bitsB = sum(mask.astype(numpy.uint8) << pair for pair, mask in enumerate(masksB)).astype(numpy.uint8)
+    agreements = labelAgreements(bitsA, bitsB, 3, 0.5)
+    for agreement, maskA, maskB in zip(agreements, masksA, masksB):
+      for key, value in labelAgreement(maskA, maskB).items():
+        self.assertEqual(agreement[key], value)
+    self.assertEqual(agreements[0]['jaccard'], 48.0/80)
+    self.assertEqual(agreements[1]['jaccard'], 1.0)
+    self.assertEqual(agreements[2]['dice'], 0.0)
+    self.assertEqual(agreements[2]['volumeDifference'], 0.5)
+    self.delayDisplay('Test passed!')
+
+  def test_DecompressedInputCache(self):
+    """ The input cache hits for unchanged files, misses once a file changed and evicts the least recently used entries
+    """
+    self.delayDisplay("Starting the input cache test")
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      ijkToRAS = numpy.diag([-0.5, -0.5, 2.0, 1.0])
+      paths = []
+      for index in range(3):
+        paths.append(os.path.join(directory, 'input%d.nrrd' % index))
+        writeNrrd(paths[-1], numpy.arange(1000, dtype=numpy.int16).reshape(10, 10, 10) + index, ijkToRAS)
+      cache = DecompressedInputCache(os.path.join(directory, 'cache'))
+
+      # Hit after the first read stored the volume
+      self.assertIsNone(cache.load(paths[0]))
+      self.assertFalse(cache.read(paths[0]).get('cached'))
+      cached = cache.load(paths[0])
+      self.assertTrue(cached['cached'])
+      voxels = numpy_support.vtk_to_numpy(cached['imageData'].GetPointData().GetScalars()).reshape(10, 10, 10)
+      self.assertEqual(voxels.tolist(), numpy.arange(1000).reshape(10, 10, 10).tolist())
+      self.assertEqual([cached['ijkToRAS'].GetElement(row, row) for row in range(4)], [-0.5, -0.5, 2.0, 1.0])
+
+      # Miss once the source file was modified
+      modifiedTime = os.path.getmtime(paths[0]) + 10
+      os.utime(paths[0], (modifiedTime, modifiedTime))
+      self.assertIsNone(cache.load(paths[0]))
+
+      # The entry of input1 was used less recently than the one of input0, so it is evicted when input2 does not fit
+      cache = DecompressedInputCache(os.path.join(directory, 'lru-cache'))
+      cache.read(paths[0])
+      cache.read(paths[1])
+      entrySize = os.path.getsize(cache.entryPath(paths[0]))
+      for path, lastUsed in ((paths[0], time.time() - 200), (paths[1], time.time() - 100)):
+        os.utime(cache.entryPath(path), (lastUsed, lastUsed))
+      self.assertIsNotNone(cache.load(paths[0])) # makes input0 the most recently used
+      cache.maxBytes = 2*entrySize
+      cache.read(paths[2])
+      self.assertTrue(os.path.exists(cache.entryPath(paths[0])))
+      self.assertFalse(os.path.exists(cache.entryPath(paths[1])))
+      self.assertTrue(os.path.exists(cache.entryPath(paths[2])))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_SimpleITKRoundTrip(self):
+    """ A volume passed to SimpleITK and back keeps its voxels and its (rotated) geometry, and the copies are independent
+    """
+    self.delayDisplay("Starting the SimpleITK round trip test")
+    import SimpleITK as sitk
+    voxels = numpy.arange(24).reshape(2, 3, 4)
+    volume = self.createLabelVolume('volume', voxels)
+    ijkToRAS = numpy.array([[0, -1, 0, 10], [0.5, 0, 0, -5], [0, 0, 2, 3], [0, 0, 0, 1]]) # i along A, j along L
+    matrix = vtk.vtkMatrix4x4()
+    for row in range(4):
+      for column in range(4):
+        matrix.SetElement(row, column, ijkToRAS[row, column])
+    volume.SetIJKToRASMatrix(matrix)
+
+    image = imageFromVolume(volume)
+    self.assertEqual(image.GetSize(), (4, 3, 2))
+    self.assertEqual(sitk.GetArrayFromImage(image).tolist(), voxels.tolist())
+    numpy.testing.assert_allclose(image.GetSpacing(), (0.5, 1, 2))
+    numpy.testing.assert_allclose(image.GetDirection(), (0, 1, 0, -1, 0, 0, 0, 0, 1)) # LPS
+    numpy.testing.assert_allclose(image.GetOrigin(), (-10, 5, 3))
+
+    output = self.createLabelVolume('output', [[[0]]])
+    updateVolumeFromImage(image, output)
+    outputMatrix = vtk.vtkMatrix4x4()
+    output.GetIJKToRASMatrix(outputMatrix)
+    self.assertEqual(arrayFromVolume(output).tolist(), voxels.tolist())
+    numpy.testing.assert_allclose(output.GetSpacing(), (0.5, 1, 2))
+    numpy.testing.assert_allclose(output.GetOrigin(), (10, -5, 3))
+    numpy.testing.assert_allclose([[outputMatrix.GetElement(row, column) for column in range(4)] for row in range(4)], ijkToRAS, atol=1e-12)
+
+    # Neither the image nor the node share voxels with the other, unless the image is an explicit view
+    arrayFromVolume(output)[:] = 0
+    arrayFromVolume(volume)[0, 0, 0] = 100
+    self.assertEqual(sitk.GetArrayViewFromImage(image).tolist(), voxels.tolist())
+    if hasattr(sitk, 'GetImageViewFromArray'):
+      self.assertEqual(sitk.GetArrayViewFromImage(imageFromVolume(volume, view=True))[0, 0, 0], 100)
+    self.delayDisplay('Test passed!')
+
+  def test_ResliceArray(self):
+    """ Reslicing through a translation moves the voxels by the translation, also for a cropped multi-component array
+    """
+    self.delayDisplay("Starting the reslice test")
+    voxels = numpy.zeros((4, 4, 10), dtype=numpy.uint8)
+    voxels[1:3, 1:3, 2:4] = 7
+    label = self.createLabelVolume('label', voxels)
+    reference = self.createLabelVolume('reference', numpy.zeros((4, 4, 10)))
+    transformNode = slicer.vtkMRMLLinearTransformNode()
+    slicer.mrmlScene.AddNode(transformNode)
+    translation = vtk.vtkMatrix4x4()
+    translation.SetElement(0, 3, 3) # 3 mm along R, which is i
+    transformNode.SetMatrixTransformToParent(translation)
+
+    expected = numpy.zeros((4, 4, 10), dtype=numpy.uint8)
+    expected[1:3, 1:3, 5:7] = 7
+    self.assertEqual(resliceArray(voxels, label, reference).tolist(), voxels.tolist())
+    self.assertEqual(resliceArray(voxels, label, reference, transformNode).tolist(), expected.tolist())
+
+    components = numpy.stack([voxels[1:3, 1:3, 2:4], 2*voxels[1:3, 1:3, 2:4]], axis=-1).astype(numpy.float32)
+    resliced = resliceArray(components, label, reference, transformNode, linear=True, offset=(1, 1, 2))
+    self.assertEqual(resliced.shape, (4, 4, 10, 2))
+    numpy.testing.assert_allclose(resliced[..., 0], expected)
+    numpy.testing.assert_allclose(resliced[..., 1], 2*expected)
+    self.delayDisplay('Test passed!')
+
+  def test_StageCache(self):
+    """ Cached outputs are restored all together, and an unreadable entry leaves the outputs alone and is deleted
+    """
+    self.delayDisplay("Starting the stage cache test")
+    import tempfile
+    directory = tempfile.mkdtemp()
+    try:
+      cache = StageCache(directory)
+      label = self.createLabelVolume('label', [[[0, 1, 2]]])
+      model = slicer.vtkMRMLModelNode()
+      sphere = vtk.vtkSphereSource()
+      sphere.Update()
+      model.SetAndObservePolyData(sphere.GetOutput())
+      stage = PipelineStage('stage', [], {'label': label, 'model': model}, lambda: None, cacheable=True)
+      key = cache.key(stage, {})
+      cache.store(key, stage, {'label': label, 'model': model})
+
+      restoredLabel = self.createLabelVolume('restoredLabel', [[[0]]])
+      restoredModel = slicer.vtkMRMLModelNode()
+      restoredStage = PipelineStage('stage', [], {'label': restoredLabel, 'model': restoredModel}, lambda: None, cacheable=True)
+      outputs = cache.load(key, restoredStage)
+      self.assertEqual(outputs, {'label': restoredLabel, 'model': restoredModel})
+      self.assertEqual(arrayFromVolume(restoredLabel).tolist(), [[[0, 1, 2]]])
+      self.assertEqual(restoredModel.GetPolyData().GetNumberOfPoints(), sphere.GetOutput().GetNumberOfPoints())
+
+      # The model snapshot (written after the label one) is lost: nothing is restored
+      untouchedLabel = self.createLabelVolume('untouchedLabel', [[[5]]])
+      untouchedStage = PipelineStage('stage', [], {'label': untouchedLabel, 'model': slicer.vtkMRMLModelNode()}, lambda: None, cacheable=True)
+      os.remove(os.path.join(cache.entryPath(key), '1.vtk'))
+      self.assertIsNone(cache.load(key, untouchedStage))
+      self.assertEqual(arrayFromVolume(untouchedLabel).tolist(), [[[5]]])
+      self.assertFalse(os.path.exists(cache.entryPath(key)))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
+
+  def test_LabelMapSmoothingROI(self):
+    """ Smoothing a label with the CLI on its region gives the result of smoothing the whole volume
+    """
+    self.delayDisplay("Starting the label smoothing region test")
+    logic = PreProcessLogic(useCLI=True)
+
+    voxels = numpy.zeros((30, 30, 30))
+    voxels[5:15, 5:15, 5:15] = 1
+    voxels[18:26, 16:26, 15:25] = 2
+    wholeVolume = self.createLabelVolume('whole', voxels)
+    region = self.createLabelVolume('region', voxels)
+    logic.roiMargin = 1000.0 # the region would be the whole volume, so it is not cropped
+    logic.LabelMapSmoothing(wholeVolume, 1, 2)
+    logic.roiMargin = 4.0
+    logic.LabelMapSmoothing(region, 1, 2)
+
+    self.assertTrue(sameVolumeGeometry(wholeVolume, region))
+    self.assertEqual(set(numpy.unique(arrayFromVolume(region))), set([0, 2]))
+    self.assertEqual(arrayFromVolume(region).tolist(), arrayFromVolume(wholeVolume).tolist())
+    self.assertEqual(len(slicer.util.getNodes('*-ROI*')), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_LabelMapSmoothingPaths(self):
+    """ smoothLabelArray and the labelmapsmoothing CLI keep the same labels of a multi-label volume and agree on their voxels
+    """
+    self.delayDisplay("Starting the label smoothing paths test")
+    voxels = numpy.zeros((30, 30, 30))
+    voxels[5:15, 5:15, 5:15] = 1
+    voxels[18:26, 16:26, 15:25] = 2
+    voxels[2:6, 20:28, 2:10] = 3
+    for labelNumber, expectedLabel in (((), 3), ((1,), 1), ((2,), 2)):
+      results = []
+      for useCLI in (False, True):
+        label = self.createLabelVolume('label-%s' % useCLI, voxels)
+        PreProcessLogic(useCLI=useCLI).LabelMapSmoothing(label, 1, *labelNumber)
+        results.append(arrayFromVolume(label).copy())
+      nativeVoxels, cliVoxels = results
+      self.assertEqual(set(numpy.unique(nativeVoxels)), set([0, expectedLabel]))
+      self.assertEqual(set(numpy.unique(cliVoxels)), set([0, expectedLabel]))
+      self.assertGreater(labelAgreement(cliVoxels, nativeVoxels)['dice'], 0.95)
+    self.delayDisplay('Test passed!')
+
+  def test_TransferLabels(self):
+    """ Transferring a cube label onto a grid of half the spacing keeps the cube
+    """
+    self.delayDisplay("Starting the label transfer test")
+    logic = PreProcessLogic()
+
+    voxels = numpy.zeros((20, 20, 20))
+    voxels[5:15, 5:15, 5:15] = 1
+    inputLabel = self.createLabelVolume('input', voxels)
+    reference = self.createLabelVolume('reference', numpy.zeros((40, 40, 40)))
+    reference.SetSpacing(0.5, 0.5, 0.5)
+    reference.SetOrigin(-0.25, -0.25, -0.25)
+    output = self.createLabelVolume('output', [[[0]]])
+    logic.transferLabels(reference, [(inputLabel, output, 0.5, 10)])
+
+    expected = numpy.zeros((40, 40, 40))
+    expected[10:30, 10:30, 10:30] = 10
+    self.assertTrue(sameVolumeGeometry(reference, output))
+    self.assertEqual(set(numpy.unique(arrayFromVolume(output))), set([0, 10]))
+    self.assertGreater(labelAgreement(expected, arrayFromVolume(output))['dice'], 0.9)
+    self.delayDisplay('Test passed!')
+
+  def test_LabelArrayOperations(self):
+    """ Checks the in-process label operations against the results of the thresholdscalarvolume and imagelabelcombine CLIs
+    """
+    self.delayDisplay("Starting the label operation test")
+    logic = PreProcessLogic()
+
+    labelA = self.createLabelVolume('labelA', [[[0, 1, 2, 0], [5, 0, 9, 0]]])
+    logic.ThresholdScalarVolume(labelA, 7)
+    self.assertEqual(arrayFromVolume(labelA).tolist(), [[[0, 7, 7, 0], [7, 0, 7, 0]]])
+
+    labelB = self.createLabelVolume('labelB', [[[0, 1, 2, 0], [5, 0, 9, 0]]])
+    logic.ThresholdAbove(labelB, 1.5, 0)
+    self.assertEqual(arrayFromVolume(labelB).tolist(), [[[0, 1, 0, 0], [0, 0, 0, 0]]])
+
+    labelC = self.createLabelVolume('labelC', [[[0, 2, 0, 0], [0, 0, 0, 2]]])
+    labelD = self.createLabelVolume('labelD', [[[1, 1, 0, 3], [0, 0, 0, 3]]])
+    combined = self.createLabelVolume('combined', [[[0]]])
+    logic.ImageLabelCombine(labelC, labelD, combined)
+    self.assertEqual(arrayFromVolume(combined).tolist(), [[[1, 2, 0, 3], [0, 0, 0, 2]]])
+
+    labelE = self.createLabelVolume('labelE', [[[0, 1, 7, 4]]])
+    logic.MRVMLabelValueProcess(labelE)
+    self.assertEqual(arrayFromVolume(labelE).tolist(), [[[3, 1, 0, 4]]])
+    self.delayDisplay('Test passed!')
+
+  def test_RegistrationLabel(self):
+    """ Checks that the fused registration label matches the threshold/combine sequence and leaves its inputs untouched
+    """
+    self.delayDisplay("Starting the registration label test")
+    logic = PreProcessLogic()
+
+    capsule = self.createLabelVolume('capsule', [[[0, 1, 1, 1, 1, 0]]])
+    cg = self.createLabelVolume('cg', [[[0, 0, 2, 2, 0, 0]]])
+    vm = self.createLabelVolume('vm', [[[0, 0, 0, 3, 0, 3]]])
+    registerLabel = self.createLabelVolume('register', [[[0]]])
+    logic.CreateRegistrationLabel(capsule, cg, vm, registerLabel, 10)
+    self.assertEqual(arrayFromVolume(registerLabel).tolist(), [[[0, 10, 0, 10, 10, 10]]])
+    self.assertEqual(arrayFromVolume(vm).tolist(), [[[0, 0, 0, 3, 0, 3]]])
+    self.delayDisplay('Test passed!')
+
+  def test_RasterizeModel(self):
+    """ Rasterizes a sphere model and checks the labelled volume against the volume of the sphere
+    """
+    self.delayDisplay("Starting the model rasterization test")
+    logic = PreProcessLogic()
+
+    reference = self.createLabelVolume('reference', numpy.zeros((20, 20, 20)))
+    sphere = vtk.vtkSphereSource()
+    sphere.SetCenter(10, 10, 10)
+    sphere.SetRadius(5)
+    sphere.SetThetaResolution(64)
+    sphere.SetPhiResolution(64)
+    sphere.Update()
+    sphereModel = slicer.vtkMRMLModelNode()
+    sphereModel.SetName('sphere')
+    sphereModel.SetAndObservePolyData(sphere.GetOutput())
+    slicer.mrmlScene.AddNode(sphereModel)
+
+    sphereLabel = self.createLabelVolume('sphere-label', [[[0]]])
+    logic.rasterizeModel(reference, sphereModel, sphereLabel, 10)
+    sphereVoxels = arrayFromVolume(sphereLabel)
+    self.assertEqual(sphereVoxels.shape, (20, 20, 20))
+    self.assertEqual(sphereVoxels[10, 10, 10], 10)
+    self.assertEqual(sphereVoxels[0, 0, 0], 0)
+    self.assertAlmostEqual((sphereVoxels == 10).sum() / (4.0/3.0*math.pi*5**3), 1.0, delta=0.1)
+
+    # Batch rasterization into one multi-label volume
+    multiLabel = self.createLabelVolume('multi-label', [[[0]]])
+    logic.rasterizeModels(reference, [(sphereModel, None, 10), (sphereModel, None, 3)], multiLabel)
+    multiLabelVoxels = arrayFromVolume(multiLabel)
+    self.assertEqual((multiLabelVoxels == 3).sum(), (sphereVoxels == 10).sum())
+    self.assertEqual((multiLabelVoxels == 10).sum(), 0)
+    self.delayDisplay('Test passed!')
+
+  def test_BatchCohort(self):
+    """ The batch command line starts a worker per patient with the options and thread limit, and summarizes their reports
+    """
+    self.delayDisplay("Starting the batch cohort test")
+    import tempfile
+    from RegistrationWorkflowLib import batch
+    self.assertEqual(batch.parsePatientNumbers('56-58, 63,'), ['56', '57', '58', '63'])
+
+    directory = tempfile.mkdtemp()
+    try:
+      # Stands in for Slicer: writes a report for every patient but 57, and keeps the command line and thread limit
+      worker = os.path.join(directory, 'worker.sh')
+      with open(worker, 'w') as workerFile:
+        workerFile.write('#!/bin/sh\n'
+                         'arguments="$*"\n'
+                         'while [ $# -gt 0 ]; do\n'
+                         '  case "$1" in --patient) patient=$2; shift;; --report) report=$2; shift;; esac\n'
+                         '  shift\n'
+                         'done\n'
+                         'if [ "$patient" = 57 ]; then exit 3; fi\n'
+                         'echo "{\\"patient\\": \\"$patient\\", \\"success\\": true, \\"error\\": null, \\"elapsed\\": 1.5, '
+                         '\\"threads\\": \\"$ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS\\", \\"arguments\\": \\"$arguments\\"}" > "$report"\n')
+      os.chmod(worker, 0o755)
+      outputDirectory = os.path.join(directory, 'reports')
+      self.assertEqual(batch.main(['--patients', '56-58', '--workers', '2', '--threads-per-worker', '3', '--output-dir', outputDirectory,
+                                   '--slicer', worker, '--save', '--deep']), 1)
+
+      with open(os.path.join(outputDirectory, 'summary.json')) as summaryFile:
+        summary = json.load(summaryFile)
+      self.assertEqual((summary['patients'], summary['succeeded'], summary['failed']), (3, 2, ['57']))
+      self.assertEqual(summary['meanPatientTime'], 1.5)
+      reports = dict((report['patient'], report) for report in summary['reports'])
+      self.assertEqual(reports['57']['error'], 'Worker exited with code 3 without a report')
+      self.assertEqual(reports['56']['threads'], '3')
+      arguments = reports['58']['arguments'].split()
+      self.assertEqual(arguments[:3], ['--no-splash', '--no-main-window', '--python-script'])
+      self.assertTrue(arguments[3].endswith('batch.py'))
+      for flag in ('--worker', '--save', '--deep'):
+        self.assertIn(flag, arguments)
+      self.assertNotIn('--resume', arguments)
+      self.assertEqual(arguments[arguments.index('--report')+1], os.path.join(outputDirectory, 'Patient58.json'))
+      self.assertTrue(os.path.exists(os.path.join(outputDirectory, 'Patient57.log')))
+    finally:
+      shutil.rmtree(directory, ignore_errors=True)
+    self.delayDisplay('Test passed!')
@@ -0,0 +1,2 @@
+""" Code shared by the registration workflow modules, installed with the PreProcess module
+"""
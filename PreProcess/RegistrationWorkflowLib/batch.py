@@ -0,0 +1,192 @@
+""" Batch processing of patients from the command line, every patient in its own headless Slicer process
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from multiprocessing.pool import ThreadPool
+import slicer
+from RegistrationWorkflowLib.files import CohortIndex, validationErrors
+
+
+def parsePatientNumbers(patientSpec):
+  """ Expands a patient list such as '56-60,63,70' to ['56', '57', '58', '59', '60', '63', '70']
+  """
+  patientNumbers = []
+  for part in patientSpec.split(','):
+    part = part.strip()
+    if not part:
+      continue
+    if '-' in part:
+      first, last = part.split('-', 1)
+      patientNumbers.extend(str(number) for number in range(int(first), int(last)+1))
+    else:
+      patientNumbers.append(str(int(part)))
+  return patientNumbers
+
+def slicerExecutable():
+  """ Path of the Slicer executable to start worker processes with (the launcher sets up the library paths)
+  """
+  if hasattr(slicer.app, 'launcherExecutableFilePath') and slicer.app.launcherExecutableFilePath:
+    return slicer.app.launcherExecutableFilePath
+  return slicer.app.applicationFilePath()
+
+def runPatientWorker(args):
+  """ Processes one patient in this (headless) Slicer process and writes a JSON report to args.report
+  """
+  from PreProcess import PreProcessLogic # the worker runs in Slicer with the PreProcess module loaded
+  logic = PreProcessLogic(useCLI=args.use_cli)
+  logic.cacheDirectory = args.cache_dir
+  logic.inputCacheDirectory = args.input_cache_dir
+  logic.inputCacheSizeLimit = int(args.input_cache_size*1024**3)
+  logic.workingDirectory = args.working_dir
+  logic.traceDirectory = args.trace_dir
+  logic.monitorMemory = args.monitor_memory
+  logic.transferMRLabels = args.transfer_mr_labels
+  logic.compressionLevel = args.compression_level
+  logic.deepValidation = args.deep
+  report = {'patient': args.patient, 'success': False, 'error': None, 'elapsed': None, 'validation': None}
+  start_time = time.time()
+  try:
+    if not logic.run(args.patient, args.save, args.concurrent_stages, args.resume):
+      if logic.validationReport and not logic.validationReport['valid']:
+        report['error'] = 'Inputs not valid: '+validationErrors(logic.validationReport)
+      else:
+        report['error'] = 'Not all inputs supplied'
+    else:
+      report['success'] = True
+  except Exception as error:
+    logging.exception('Processing patient %s failed' % args.patient)
+    report['error'] = '%s: %s' % (type(error).__name__, error)
+  finally:
+    if not logic.waitForPendingWrites(): # the worker process must not exit before the files are written
+      report['success'] = False
+      report['error'] = report['error'] or 'Not all results could be saved'
+  report['elapsed'] = time.time() - start_time
+  report['validation'] = logic.validationReport
+  with open(args.report, 'w') as reportFile:
+    json.dump(report, reportFile, indent=2)
+  return 0 if report['success'] else 1
+
+def runCohort(args):
+  """ Processes args.patients in up to args.workers headless Slicer processes at the same time and writes
+  the aggregated reports to args.output_dir/summary.json. Returns the number of failed patients
+  """
+  patientNumbers = parsePatientNumbers(args.patients) if args.patients else []
+  incompletePatients = {}
+  if args.index:
+    # Pick the patients from the input index instead of finding missing inputs in the workers
+    index = CohortIndex(args.index)
+    start_time = time.time()
+    headersRead = index.scan(patientNumbers or None)
+    if not patientNumbers:
+      patientNumbers = index.completePatients()
+    for patientNumber in patientNumbers:
+      missingInputs = index.missingInputs(patientNumber)
+      if missingInputs:
+        incompletePatients[patientNumber] = 'Missing or unreadable inputs: ' + ', '.join('%s (%s)' % missingInput for missingInput in missingInputs)
+    index.close()
+    print('Input index %s updated in %0.1f s (%d headers read), %d of %d patients complete' % (
+          args.index, time.time()-start_time, headersRead, len(patientNumbers)-len(incompletePatients), len(patientNumbers)))
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  executable = args.slicer or slicerExecutable()
+  scriptPath = os.path.splitext(os.path.abspath(__file__))[0] + '.py' # also when imported from the compiled file
+
+  # Every worker gets its share of the cores so that the workers do not oversubscribe the machine
+  environment = dict(os.environ)
+  for variable in ('ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS', 'OMP_NUM_THREADS'):
+    environment[variable] = str(args.threads_per_worker)
+
+  def processPatient(patientNumber):
+    if patientNumber in incompletePatients:
+      print('Patient %s FAILED: %s' % (patientNumber, incompletePatients[patientNumber]))
+      return {'patient': patientNumber, 'success': False, 'error': incompletePatients[patientNumber], 'elapsed': 0.0}
+    reportPath = os.path.join(args.output_dir, 'Patient'+patientNumber+'.json')
+    if os.path.exists(reportPath):
+      os.remove(reportPath)
+    command = [executable, '--no-splash', '--no-main-window', '--python-script', scriptPath,
+               '--worker', '--patient', patientNumber, '--report', reportPath,
+               '--concurrent-stages', str(args.concurrent_stages), '--compression-level', str(args.compression_level)]
+    for flag, value in (('--cache-dir', args.cache_dir), ('--input-cache-dir', args.input_cache_dir),
+                        ('--input-cache-size', str(args.input_cache_size)), ('--working-dir', args.working_dir),
+                        ('--trace-dir', args.trace_dir or args.output_dir)):
+      if value:
+        command += [flag, value]
+    for flag, value in (('--save', args.save), ('--resume', args.resume), ('--use-cli', args.use_cli), ('--monitor-memory', args.monitor_memory),
+                        ('--transfer-mr-labels', args.transfer_mr_labels), ('--deep', args.deep)):
+      if value:
+        command.append(flag)
+
+    start_time = time.time()
+    with open(os.path.join(args.output_dir, 'Patient'+patientNumber+'.log'), 'w') as logFile:
+      returnCode = subprocess.call(command, stdout=logFile, stderr=subprocess.STDOUT, env=environment)
+    try:
+      with open(reportPath) as reportFile:
+        report = json.load(reportFile)
+    except (IOError, ValueError):
+      report = {'patient': patientNumber, 'success': False, 'error': 'Worker exited with code %d without a report' % returnCode,
+                'elapsed': time.time()-start_time}
+    print('Patient %s %s (%0.1f s)' % (patientNumber, 'done' if report['success'] else 'FAILED: %s' % report['error'], report['elapsed']))
+    return report
+
+  start_time = time.time()
+  pool = ThreadPool(max(1, args.workers))
+  try:
+    reports = pool.map(processPatient, patientNumbers)
+  finally:
+    pool.close()
+    pool.join()
+
+  failed = [report for report in reports if not report['success']]
+  elapsed = [report['elapsed'] for report in reports if report['success']]
+  summary = {'patients': len(reports), 'succeeded': len(reports)-len(failed), 'failed': [report['patient'] for report in failed],
+             'wallTime': time.time()-start_time, 'meanPatientTime': sum(elapsed)/len(elapsed) if elapsed else None, 'reports': reports}
+  with open(os.path.join(args.output_dir, 'summary.json'), 'w') as summaryFile:
+    json.dump(summary, summaryFile, indent=2)
+  print('%d of %d patients processed in %0.1f s' % (summary['succeeded'], summary['patients'], summary['wallTime']))
+  if failed:
+    print('Failed patients: ' + ', '.join(summary['failed']))
+  return len(failed)
+
+def main(argv=None):
+  """ Command line entry point, run through headless Slicer:
+  Slicer --no-main-window --python-script batch.py --patients 56-110 --workers 4 --output-dir reports
+  """
+  parser = argparse.ArgumentParser(description='Pre-process patients for registration')
+  parser.add_argument('--patients', help='patient numbers, for example 56-60,63 (default with --index: all patients with complete inputs)')
+  parser.add_argument('--index', help='SQLite index of the input files, updated before the patients are processed')
+  parser.add_argument('--workers', type=int, default=2, help='number of patients processed at the same time')
+  parser.add_argument('--threads-per-worker', type=int, default=2, help='ITK/OpenMP threads of every worker')
+  parser.add_argument('--concurrent-stages', type=int, default=2, help='processing stages run at the same time by every worker')
+  parser.add_argument('--output-dir', default='PreProcessReports', help='directory for the worker logs and reports')
+  parser.add_argument('--slicer', help='Slicer executable for the workers (default: this Slicer)')
+  parser.add_argument('--cache-dir', help='stage cache shared by the workers')
+  parser.add_argument('--input-cache-dir', help='cache of the decompressed input volumes shared by the workers')
+  parser.add_argument('--input-cache-size', type=float, default=10,
+                      help='size limit of the input cache in GB (least recently used inputs are deleted)')
+  parser.add_argument('--working-dir', help='directory for the stage checkpoints')
+  parser.add_argument('--trace-dir', help='directory for the Chrome traces of the patients (default: --output-dir)')
+  parser.add_argument('--save', action='store_true', help='save the results to disk')
+  parser.add_argument('--compression-level', type=int, default=6, help='gzip level of the saved NRRD files (0: uncompressed)')
+  parser.add_argument('--resume', action='store_true', help='resume from the stage checkpoints')
+  parser.add_argument('--use-cli', action='store_true', help='run label operations through the CLI modules')
+  parser.add_argument('--monitor-memory', action='store_true', help='log the memory use of every stage')
+  parser.add_argument('--transfer-mr-labels', action='store_true', help='transfer the MR VM and index lesion labels without models')
+  parser.add_argument('--deep', action='store_true', help='also validate the label values and model positions of the inputs (reads them fully)')
+  parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+  parser.add_argument('--patient', help=argparse.SUPPRESS)
+  parser.add_argument('--report', help=argparse.SUPPRESS)
+  args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+  if args.worker:
+    return runPatientWorker(args)
+  if not args.patients and not args.index:
+    parser.error('--patients or --index is required')
+  return 1 if runCohort(args) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,293 @@
+""" Node snapshots and the on-disk caches and checkpoints of pipeline stages
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+try:
+  import fcntl # locks the stage cache during eviction (not available on Windows)
+except ImportError:
+  fcntl = None
+import numpy
+import vtk
+from vtk.util import numpy_support
+import slicer
+from RegistrationWorkflowLib.volumes import arrayFromVolume
+
+
+def hashNode(node, digest):
+  """ Adds the content of a volume (voxels and geometry) or model (points and cells) node to a hashlib digest
+  """
+  if node is None:
+    digest.update(b'None')
+  elif node.IsA('vtkMRMLVolumeNode'):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(ijkToRAS)
+    digest.update(repr([ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)]).encode('utf-8'))
+    if node.GetImageData() is not None:
+      voxels = numpy.ascontiguousarray(arrayFromVolume(node))
+      digest.update(repr((voxels.shape, voxels.dtype.str)).encode('utf-8'))
+      digest.update(voxels.data)
+  elif node.IsA('vtkMRMLModelNode'):
+    polyData = node.GetPolyData()
+    if polyData is not None and polyData.GetNumberOfPoints() > 0:
+      digest.update(numpy.ascontiguousarray(numpy_support.vtk_to_numpy(polyData.GetPoints().GetData())).data)
+      for cells in (polyData.GetVerts(), polyData.GetLines(), polyData.GetPolys(), polyData.GetStrips()):
+        digest.update(numpy.ascontiguousarray(numpy_support.vtk_to_numpy(cells.GetData())).data)
+  else:
+    digest.update(node.GetID().encode('utf-8'))
+
+def saveNodeSnapshot(node, basePath):
+  """ Writes the content of a volume (basePath.npy + basePath.json geometry) or model (basePath.vtk) node
+  """
+  if node.IsA('vtkMRMLVolumeNode'):
+    ijkToRAS = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(ijkToRAS)
+    numpy.save(basePath+'.npy', arrayFromVolume(node))
+    with open(basePath+'.json', 'w') as geometryFile:
+      json.dump({'name': node.GetName(), 'scalarType': node.GetImageData().GetScalarType(),
+                 'ijkToRAS': [ijkToRAS.GetElement(row, column) for row in range(4) for column in range(4)]}, geometryFile)
+  else:
+    writer = vtk.vtkPolyDataWriter()
+    writer.SetInputData(node.GetPolyData())
+    writer.SetFileName(basePath+'.vtk')
+    writer.SetFileTypeToBinary()
+    if not writer.Write():
+      raise IOError('Could not write '+basePath+'.vtk')
+
+def readNodeSnapshot(basePath):
+  """ Reads a snapshot written by saveNodeSnapshot without touching the scene, for applyNodeSnapshot
+  """
+  if os.path.exists(basePath+'.npy'):
+    with open(basePath+'.json') as geometryFile:
+      geometry = json.load(geometryFile)
+    voxels = numpy.load(basePath+'.npy')
+    if voxels.ndim != 3:
+      raise ValueError('Not a 3D volume snapshot: '+basePath)
+    imageData = vtk.vtkImageData()
+    imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+    imageData.AllocateScalars(geometry['scalarType'], 1)
+    numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(voxels.shape)[:] = voxels
+    ijkToRAS = vtk.vtkMatrix4x4()
+    for index, value in enumerate(geometry['ijkToRAS']):
+      ijkToRAS.SetElement(index // 4, index % 4, value)
+    return {'imageData': imageData, 'ijkToRAS': ijkToRAS}
+
+  if not os.path.exists(basePath+'.vtk'):
+    raise IOError('No snapshot at '+basePath)
+  reader = vtk.vtkPolyDataReader()
+  reader.SetFileName(basePath+'.vtk')
+  reader.Update()
+  if reader.GetErrorCode() or reader.GetOutput() is None:
+    raise IOError('Could not read model snapshot '+basePath+'.vtk')
+  polyData = vtk.vtkPolyData()
+  polyData.DeepCopy(reader.GetOutput())
+  return {'polyData': polyData}
+
+def applyNodeSnapshot(node, snapshot, name=None):
+  """ Makes a snapshot of readNodeSnapshot the content of node. Models may pass node=None to create a new model node called name
+  """
+  if 'imageData' in snapshot:
+    node.SetIJKToRASMatrix(snapshot['ijkToRAS'])
+    node.SetAndObserveImageData(snapshot['imageData'])
+    return node
+
+  if node is None:
+    node = slicer.vtkMRMLModelNode()
+    node.SetName(name)
+    slicer.mrmlScene.AddNode(node)
+    displayNode = slicer.vtkMRMLModelDisplayNode()
+    slicer.mrmlScene.AddNode(displayNode)
+    node.SetAndObserveDisplayNodeID(displayNode.GetID())
+  node.SetAndObservePolyData(snapshot['polyData'])
+  return node
+
+def directorySize(path):
+  """ Returns the total size in bytes of the files below path
+  """
+  size = 0
+  for directory, subdirectories, files in os.walk(path):
+    for fileName in files:
+      try:
+        size += os.path.getsize(os.path.join(directory, fileName))
+      except OSError:
+        pass # removed by another process in the meantime
+  return size
+
+def evictLeastRecentlyUsed(directory, maxBytes, lockFileName='.lock'):
+  """ Deletes the least recently used entries (files or directories directly in directory, ordered by modification time)
+  until the entries use at most maxBytes. Hidden entries are skipped. The directory is locked meanwhile
+  """
+  lockFile = open(os.path.join(directory, lockFileName), 'a')
+  try:
+    if fcntl:
+      fcntl.flock(lockFile, fcntl.LOCK_EX)
+    entries = []
+    for entryName in os.listdir(directory):
+      if entryName.startswith('.'):
+        continue
+      entryPath = os.path.join(directory, entryName)
+      try:
+        entrySize = directorySize(entryPath) if os.path.isdir(entryPath) else os.path.getsize(entryPath)
+        entries.append((os.path.getmtime(entryPath), entrySize, entryPath))
+      except OSError:
+        continue
+    entries.sort()
+    totalSize = sum(entry[1] for entry in entries)
+    for lastUsed, entrySize, entryPath in entries:
+      if totalSize <= maxBytes:
+        break
+      # Move the entry out of the way first so that readers never see a partially deleted entry
+      deletedPath = os.path.join(directory, '.deleted-'+uuid.uuid4().hex)
+      try:
+        os.rename(entryPath, deletedPath)
+      except OSError:
+        continue
+      if os.path.isdir(deletedPath):
+        shutil.rmtree(deletedPath, ignore_errors=True)
+      else:
+        os.remove(deletedPath)
+      totalSize -= entrySize
+  finally:
+    if fcntl:
+      fcntl.flock(lockFile, fcntl.LOCK_UN)
+    lockFile.close()
+
+class StageCache(object):
+  """ On-disk cache of the outputs of cacheable PipelineStages, keyed by their inputs and parameters, that several
+  workers can share. The least recently used entries are evicted beyond maxBytes
+  """
+
+  version = 1 # change to invalidate entries written by older code
+
+  def __init__(self, directory, maxBytes=20*1024**3):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        if not os.path.isdir(directory): # another worker may have created it
+          raise
+
+  def key(self, stage, products):
+    """ Content hash of the stage inputs and parameters
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((self.version, stage.name, sorted(stage.parameters.items()))).encode('utf-8'))
+    for input in stage.inputs:
+      digest.update(input.encode('utf-8'))
+      hashNode(products[input], digest)
+    return digest.hexdigest()
+
+  def entryPath(self, key):
+    return os.path.join(self.directory, key)
+
+  def load(self, key, stage):
+    """ Restores the outputs of stage from the cache and returns them as a products dict, or None if there is no entry.
+    The outputs only change once every snapshot of the entry was read; entries that cannot be read are deleted
+    """
+    entryPath = self.entryPath(key)
+    if not os.path.isdir(entryPath):
+      return None
+    try:
+      with open(os.path.join(entryPath, 'outputs.json')) as outputsFile:
+        outputNames = json.load(outputsFile)
+      snapshots = dict((output, readNodeSnapshot(os.path.join(entryPath, str(index)))) for index, output in enumerate(sorted(stage.outputs)))
+      outputNames = dict((output, outputNames[output]) for output in snapshots)
+    except Exception as error: # any failure to read an entry only means a cache miss
+      logging.warning('Deleting the unreadable cache entry of stage %s: %s' % (stage.name, error))
+      shutil.rmtree(entryPath, ignore_errors=True)
+      return None
+    try:
+      os.utime(entryPath, None) # mark as recently used
+    except OSError:
+      pass # evicted meanwhile, the snapshots are read already
+    return dict((output, applyNodeSnapshot(stage.outputs[output], snapshots[output], outputNames[output])) for output in snapshots)
+
+  def store(self, key, stage, products):
+    """ Adds the outputs of a finished stage to the cache. Failures (for example a full disk) are logged and ignored
+    """
+    temporaryPath = os.path.join(self.directory, '.tmp-'+uuid.uuid4().hex)
+    try:
+      os.makedirs(temporaryPath)
+      outputNames = {}
+      for index, output in enumerate(sorted(stage.outputs)):
+        saveNodeSnapshot(products[output], os.path.join(temporaryPath, str(index)))
+        outputNames[output] = products[output].GetName()
+      with open(os.path.join(temporaryPath, 'outputs.json'), 'w') as outputsFile:
+        json.dump(outputNames, outputsFile)
+      try:
+        os.rename(temporaryPath, self.entryPath(key))
+      except OSError:
+        pass # another worker stored the same entry first
+      evictLeastRecentlyUsed(self.directory, self.maxBytes)
+    except (IOError, OSError) as error:
+      logging.warning('Could not cache the outputs of stage %s: %s' % (stage.name, error))
+    finally:
+      shutil.rmtree(temporaryPath, ignore_errors=True)
+
+class StageCheckpoint(object):
+  """ Checkpoints the outputs of finished PipelineStages to a working directory so that an interrupted run can be
+  resumed. manifest.json records the completed stages, their parameters and the files of their outputs
+  """
+
+  def __init__(self, directory, resume=False):
+    self.directory = directory
+    self.manifestPath = os.path.join(directory, 'manifest.json')
+    self.manifest = {'version': StageCache.version, 'stages': {}}
+    if resume and os.path.exists(self.manifestPath):
+      with open(self.manifestPath) as manifestFile:
+        manifest = json.load(manifestFile)
+      if manifest.get('version') == StageCache.version:
+        self.manifest = manifest
+    elif os.path.isdir(directory):
+      if os.path.exists(self.manifestPath):
+        logging.warning('Not resuming: discarding the checkpoint of the previous run in %s' % directory)
+      shutil.rmtree(directory) # start over, stale outputs must not be mixed with the new ones
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  def completedStages(self):
+    return sorted(self.manifest['stages'])
+
+  def restore(self, stage):
+    """ Restores the outputs of stage if the checkpoint completed it with the same parameters, returns them as a
+    products dict or None if the stage has to be run
+    """
+    record = self.manifest['stages'].get(stage.name)
+    try:
+      if record is None or record['parameters'] != json.loads(json.dumps(stage.parameters)) or set(record['outputs']) != set(stage.outputs):
+        return None
+      snapshots = dict((output, readNodeSnapshot(os.path.join(self.directory, entry['file']))) for output, entry in record['outputs'].items())
+    except Exception as error:
+      logging.warning('Could not restore stage %s from checkpoint: %s' % (stage.name, error))
+      return None
+    return dict((output, applyNodeSnapshot(stage.outputs[output], snapshots[output], record['outputs'][output]['name'])) for output in snapshots)
+
+  def save(self, stage, products):
+    """ Writes the outputs of a finished stage and records it in the manifest. Failures (for example a full disk)
+    are logged and only mean the stage is run again on resume
+    """
+    stagePath = os.path.join(self.directory, stage.name)
+    self.manifest['stages'].pop(stage.name, None)
+    try:
+      if os.path.isdir(stagePath):
+        shutil.rmtree(stagePath)
+      os.makedirs(stagePath)
+      record = {'parameters': stage.parameters, 'time': time.time(), 'outputs': {}}
+      for index, output in enumerate(sorted(stage.outputs)):
+        saveNodeSnapshot(products[output], os.path.join(stagePath, str(index)))
+        record['outputs'][output] = {'file': os.path.join(stage.name, str(index)), 'name': products[output].GetName()}
+      self.manifest['stages'][stage.name] = record
+
+      # Replace the manifest in one step so that an interrupted write leaves the previous manifest
+      temporaryPath = self.manifestPath + '.tmp'
+      with open(temporaryPath, 'w') as manifestFile:
+        json.dump(self.manifest, manifestFile, indent=2, sort_keys=True)
+      os.rename(temporaryPath, self.manifestPath)
+    except (IOError, OSError) as error:
+      logging.warning('Could not checkpoint stage %s: %s' % (stage.name, error))
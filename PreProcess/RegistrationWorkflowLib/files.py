@@ -0,0 +1,508 @@
+""" The patient input files: locating, validating, reading and caching them, and writing results
+"""
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import struct
+import time
+import uuid
+import zlib
+from multiprocessing.pool import ThreadPool
+import numpy
+import vtk
+from vtk.util import numpy_support
+from RegistrationWorkflowLib.volumes import arrayFromVolume
+from RegistrationWorkflowLib.tracer import traceSpan
+from RegistrationWorkflowLib.cache import evictLeastRecentlyUsed
+from RegistrationWorkflowLib.images import geometryToLPS, ijkToRASFromImage, imageFromArray
+
+
+inputRoot = '/luscinia/ProstateStudy' # the patient input files are below inputRoot/invivo/Patient<number>
+
+def inputFileSpecs(PatientNumber, modality=None):
+  """ Returns the (name, path below inputRoot, kind) of the input files of a patient, kind being 'volume', 'label' or
+  'model'. modality 'US' or 'MR' gives only those inputs, in the order loadUSInputs/loadMRInputs return them
+  """
+  patientPath = '/invivo/Patient'+PatientNumber
+  specs = [('US', 'inputARFI',          patientPath+'/slicer/ARFI_Norm_HistEq.nii.gz',                                'volume'),
+           ('US', 'inputBmode',         patientPath+'/slicer/Bmode.nii.gz',                                           'volume'),
+           ('US', 'inputCC',            patientPath+'/slicer/ARFI_CC_Mask.nii.gz',                                    'label'),
+           ('US', 'inputUSCaps_Model',  patientPath+'/slicer/us_cap.vtk',                                             'model'),
+           ('US', 'inputUSCG_Model',    patientPath+'/slicer/us_cg.vtk',                                              'model'),
+           ('US', 'inputUSVM_Model',    patientPath+'/slicer/us_urethra.vtk',                                         'model'),
+           ('US', 'inputUSIndex_Model', patientPath+'/slicer/us_lesion1.vtk',                                         'model'),
+           ('MR', 'inputT2',            patientPath+'/MRI_Images/T2/P'+PatientNumber+'_no_PHI.nii.gz',                'volume'),
+           ('MR', 'inputMRCaps_Seg',    patientPath+'/MRI_Images/P'+PatientNumber+'_segmentation_final.nrrd',         'label'),
+           ('MR', 'inputMRZones_Seg',   patientPath+'/MRI_Images/Anatomy/P'+PatientNumber+'_zones_seg.nii.gz',        'label'),
+           ('MR', 'inputMRVM_Seg',      patientPath+'/MRI_Images/Anatomy/P'+PatientNumber+'_urethra_seg.nrrd',        'label'),
+           ('MR', 'inputMRIndex_Seg',   patientPath+'/MRI_Images/Cancer/P'+PatientNumber+'_lesion1_seg.nrrd',         'label')]
+  return [(name, path, kind) for specModality, name, path, kind in specs if modality in (None, specModality)]
+
+niftiDataTypes = {2: 'uint8', 4: 'int16', 8: 'int32', 16: 'float32', 64: 'float64',
+                  256: 'int8', 512: 'uint16', 768: 'uint32', 1024: 'int64', 1280: 'uint64'}
+nrrdDataTypes = {'uchar': 'uint8', 'unsigned char': 'uint8', 'uint8': 'uint8', 'uint8_t': 'uint8',
+                 'signed char': 'int8', 'int8': 'int8', 'int8_t': 'int8',
+                 'short': 'int16', 'short int': 'int16', 'signed short': 'int16', 'signed short int': 'int16', 'int16': 'int16', 'int16_t': 'int16',
+                 'ushort': 'uint16', 'unsigned short': 'uint16', 'unsigned short int': 'uint16', 'uint16': 'uint16', 'uint16_t': 'uint16',
+                 'int': 'int32', 'signed int': 'int32', 'int32': 'int32', 'int32_t': 'int32',
+                 'uint': 'uint32', 'unsigned int': 'uint32', 'uint32': 'uint32', 'uint32_t': 'uint32',
+                 'longlong': 'int64', 'long long': 'int64', 'long long int': 'int64', 'signed long long': 'int64',
+                 'signed long long int': 'int64', 'int64': 'int64', 'int64_t': 'int64',
+                 'ulonglong': 'uint64', 'unsigned long long': 'uint64', 'unsigned long long int': 'uint64', 'uint64': 'uint64', 'uint64_t': 'uint64',
+                 'float': 'float32', 'double': 'float64'}
+
+def readNrrdHeader(path):
+  """ Returns the fields of the header of a NRRD file and the offset of its data in the file
+  """
+  fields = {}
+  with open(path, 'rb') as nrrdFile:
+    if not nrrdFile.readline().startswith(b'NRRD'):
+      raise ValueError('Not a NRRD file: '+path)
+    while True:
+      line = nrrdFile.readline().decode('latin-1').strip()
+      if not line:
+        break # the data starts after the first empty line
+      if line.startswith('#') or ':=' in line:
+        continue # comments and key/value pairs
+      field, value = line.split(':', 1)
+      fields[field.strip()] = value.strip()
+    return fields, nrrdFile.tell()
+
+def readFileHeader(path):
+  """ Reads the dimensions, spacing and voxel type ('dtype', numpy name) of a NIfTI-1/NRRD volume, or the number of
+  points of a legacy .vtk model, from the header of the file only. Raises ValueError for files it cannot parse
+  """
+  if path.endswith('.vtk'):
+    with open(path, 'rb') as vtkFile:
+      lines = [vtkFile.readline().decode('latin-1').strip() for lineNumber in range(10)]
+    if not lines[0].startswith('# vtk DataFile'):
+      raise ValueError('Not a legacy VTK file: '+path)
+    for line in lines[3:]:
+      fields = line.split()
+      if fields and fields[0].upper() == 'POINTS':
+        return {'dataset': lines[3].split()[-1], 'encoding': lines[2], 'numberOfPoints': int(fields[1]), 'dtype': fields[2]}
+    raise ValueError('No POINTS in the header of '+path)
+
+  if path.endswith('.nrrd') or path.endswith('.nhdr'):
+    fields, dataOffset = readNrrdHeader(path)
+    dimensions = [int(size) for size in fields['sizes'].split()]
+    if 'space directions' in fields:
+      spacing = []
+      for direction in fields['space directions'].split():
+        if direction != 'none': # non-spatial (for example vector component) axes
+          spacing.append(math.sqrt(sum(float(value)**2 for value in direction.strip('()').split(','))))
+    else:
+      spacing = [float(spacingValue) for spacingValue in fields.get('spacings', '').split() if spacingValue.lower() != 'nan']
+    header = {'dimensions': dimensions, 'spacing': spacing, 'dtype': nrrdDataTypes.get(fields['type'], fields['type']),
+              'encoding': fields.get('encoding'), 'endian': fields.get('endian', 'little'), 'dataOffset': dataOffset}
+    if 'space directions' in fields and fields.get('space', 'left-posterior-superior') in ('left-posterior-superior', 'LPS'):
+      # Unit axis directions and origin in RAS like the scene
+      directions = [[float(component) for component in axisDirection.strip('()').split(',')]
+                    for axisDirection in fields['space directions'].split() if axisDirection != 'none']
+      origin = [float(component) for component in fields.get('space origin', '(0,0,0)').strip('()').split(',')]
+      header['directions'] = [[sign*component/axisSpacing for sign, component in zip((-1, -1, 1), axisDirection)]
+                              for axisDirection, axisSpacing in zip(directions, spacing)]
+      header['origin'] = [sign*component for sign, component in zip((-1, -1, 1), origin)]
+    return header
+
+  if path.endswith('.nii') or path.endswith('.nii.gz'):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as niftiFile:
+      header = niftiFile.read(348) # only the header is decompressed
+    if len(header) < 348:
+      raise ValueError('Truncated NIfTI header: '+path)
+    for endian in '<>':
+      if struct.unpack(endian+'i', header[:4])[0] == 348:
+        break
+    else:
+      raise ValueError('Not a NIfTI-1 file: '+path)
+    dim = struct.unpack(endian+'8h', header[40:56])
+    dataType = struct.unpack(endian+'h', header[70:72])[0]
+    pixdim = struct.unpack(endian+'8f', header[76:108])
+    spacing = [abs(pixelSize) for pixelSize in pixdim[1:4]]
+
+    # Unit axis directions (RAS, as the columns of the orientation) and origin from the sform or else the qform
+    qformCode, sformCode = struct.unpack(endian+'2h', header[252:256])
+    if sformCode > 0:
+      affine = numpy.array(struct.unpack(endian+'12f', header[280:328])).reshape(3, 4)
+      directions = (affine[:, :3]/numpy.array(spacing)).T
+      origin = affine[:, 3]
+    elif qformCode > 0:
+      b, c, d, x, y, z = struct.unpack(endian+'6f', header[256:280])
+      a = math.sqrt(max(0.0, 1.0-b*b-c*c-d*d))
+      rotation = numpy.array([[a*a+b*b-c*c-d*d, 2*(b*c-a*d), 2*(b*d+a*c)],
+                              [2*(b*c+a*d), a*a+c*c-b*b-d*d, 2*(c*d-a*b)],
+                              [2*(b*d-a*c), 2*(c*d+a*b), a*a+d*d-b*b-c*c]])
+      rotation[:, 2] *= -1 if pixdim[0] < 0 else 1 # qfac
+      directions = rotation.T
+      origin = (x, y, z)
+    else:
+      directions = numpy.eye(3)
+      origin = (0, 0, 0)
+    return {'dimensions': list(dim[1:1+dim[0]]), 'spacing': [abs(pixelSize) for pixelSize in pixdim[1:1+dim[0]]],
+            'dtype': niftiDataTypes.get(dataType, str(dataType)), 'endian': 'little' if endian == '<' else 'big',
+            'dataOffset': int(struct.unpack(endian+'f', header[108:112])[0]),
+            'directions': [[float(component) for component in axisDirection] for axisDirection in directions],
+            'origin': [float(component) for component in origin]}
+
+  raise ValueError('Unknown file type: '+path)
+
+def validationErrors(report):
+  """ The errors of a validateInputs report as one line, for example "inputCC (labels): empty labelmap"
+  """
+  return '; '.join('%s (%s): %s' % (check['input'], check['check'], check['message'])
+                   for check in report['checks'] if check['status'] == 'error')
+
+def readVolumeVoxels(path, header=None):
+  """ Reads the voxels of a NIfTI-1 or NRRD (raw or gzip encoding) volume into a [k,j,i] array without ITK or the scene,
+  for example to check the values of a small labelmap
+  """
+  header = header or readFileHeader(path)
+  dimensions = header['dimensions']
+  if len(dimensions) < 3 or any(size != 1 for size in dimensions[3:]):
+    raise ValueError('Not a 3D volume: '+path)
+  dtype = numpy.dtype(header['dtype']).newbyteorder('<' if header['endian'] == 'little' else '>')
+  if path.endswith('.nrrd'):
+    if header['encoding'] not in ('raw', 'gzip', 'gz'):
+      raise ValueError('Unsupported NRRD encoding %s: %s' % (header['encoding'], path))
+    with open(path, 'rb') as nrrdFile:
+      nrrdFile.seek(header['dataOffset'])
+      data = nrrdFile.read()
+    if header['encoding'] != 'raw':
+      data = zlib.decompress(data, 16+zlib.MAX_WBITS)
+  elif path.endswith('.nii') or path.endswith('.nii.gz'):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as niftiFile:
+      data = niftiFile.read()[header['dataOffset']:]
+  else:
+    raise ValueError('Unknown file type: '+path)
+  voxelCount = dimensions[0]*dimensions[1]*dimensions[2]
+  return numpy.frombuffer(data, dtype=dtype, count=voxelCount).reshape(dimensions[2], dimensions[1], dimensions[0])
+
+def patientsUnder(root=inputRoot):
+  """ Patient numbers of the invivo/Patient<number> directories below root, in numerical order
+  """
+  try:
+    names = os.listdir(os.path.join(root, 'invivo'))
+  except OSError:
+    return []
+  patientNumbers = [name[len('Patient'):] for name in names if name.startswith('Patient') and name[len('Patient'):].isdigit()]
+  return sorted(patientNumbers, key=int)
+
+class CohortIndex(object):
+  """ SQLite index of the input files of the patients and their headers, so that batch runs can pick the patients with
+  complete inputs without loading anything
+  """
+
+  def __init__(self, path):
+    import sqlite3
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    self.connection = sqlite3.connect(path)
+    with self.connection:
+      self.connection.execute('CREATE TABLE IF NOT EXISTS inputs (patient TEXT, name TEXT, path TEXT, kind TEXT, present INTEGER, '
+                              'size INTEGER, mtime REAL, header TEXT, error TEXT, PRIMARY KEY (patient, name))')
+
+  def scan(self, patientNumbers=None, root=inputRoot, numberOfThreads=8):
+    """ Updates the entries of patientNumbers (default: all patients below root) in parallel. Returns the number of
+    headers read
+    """
+    fullScan = patientNumbers is None
+    if fullScan:
+      patientNumbers = patientsUnder(root)
+    previous = {}
+    presentInputs = self.connection.execute('SELECT patient, name, size, mtime, header, error FROM inputs WHERE present')
+    for patient, name, size, mtime, header, error in presentInputs:
+      previous[(patient, name)] = (size, mtime, header, error)
+
+    def scanPatient(patientNumber):
+      rows = []
+      for name, path, kind in inputFileSpecs(patientNumber):
+        try:
+          fileStatus = os.stat(root+path)
+        except OSError:
+          rows.append((patientNumber, name, path, kind, 0, None, None, None, 'missing', False))
+          continue
+        entry = previous.get((patientNumber, name))
+        if entry and entry[0] == fileStatus.st_size and entry[1] == fileStatus.st_mtime:
+          rows.append((patientNumber, name, path, kind, 1, fileStatus.st_size, fileStatus.st_mtime, entry[2], entry[3], False))
+          continue
+        try:
+          header, error = json.dumps(readFileHeader(root+path)), None
+        except (IOError, ValueError, KeyError, struct.error) as readError:
+          header, error = None, str(readError)
+        rows.append((patientNumber, name, path, kind, 1, fileStatus.st_size, fileStatus.st_mtime, header, error, True))
+      return rows
+
+    pool = ThreadPool(max(1, min(len(patientNumbers), numberOfThreads)))
+    try:
+      rows = [row for patientRows in pool.map(scanPatient, patientNumbers) for row in patientRows]
+    finally:
+      pool.close()
+      pool.join()
+    # Entries the scan did not come across (patients no longer below root, inputs no longer expected) are removed
+    scanned = set((row[0], row[1]) for row in rows)
+    scannedPatients = set(patientNumbers)
+    stale = [(patient, name) for patient, name in self.connection.execute('SELECT patient, name FROM inputs')
+             if (patient, name) not in scanned and (fullScan or patient in scannedPatients)]
+    with self.connection:
+      self.connection.executemany('INSERT OR REPLACE INTO inputs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [row[:-1] for row in rows])
+      self.connection.executemany('DELETE FROM inputs WHERE patient = ? AND name = ?', stale)
+    return sum(1 for row in rows if row[-1])
+
+  def patients(self):
+    return sorted((row[0] for row in self.connection.execute('SELECT DISTINCT patient FROM inputs')), key=int)
+
+  def missingInputs(self, patientNumber):
+    """ Returns the (path, reason) of the input files of a patient that are missing or could not be parsed. Patients
+    that were never scanned miss everything
+    """
+    rows = self.connection.execute('SELECT name, path, error FROM inputs WHERE patient = ?', (patientNumber,)).fetchall()
+    if not rows:
+      return [(path, 'not scanned') for name, path, kind in inputFileSpecs(patientNumber)]
+    return [(path, error) for name, path, error in rows if error]
+
+  def completePatients(self):
+    return [patientNumber for patientNumber in self.patients() if not self.missingInputs(patientNumber)]
+
+  def header(self, patientNumber, name):
+    """ Returns the header information of one input file (see readFileHeader) or None
+    """
+    row = self.connection.execute('SELECT header FROM inputs WHERE patient = ? AND name = ?', (patientNumber, name)).fetchone()
+    return json.loads(row[0]) if row and row[0] else None
+
+  def close(self):
+    self.connection.close()
+
+def inputNodeName(path):
+  """ Node name slicer.util.load* gives the file at path: the file name without its extension(s)
+  """
+  name = os.path.basename(path)
+  for extension in ('.nii.gz', '.nii', '.nrrd', '.nhdr', '.vtk'):
+    if name.endswith(extension):
+      return name[:-len(extension)]
+  return os.path.splitext(name)[0]
+
+def readInputFile(path):
+  """ Reads a volume or legacy .vtk model without the scene, so that it can run on a worker thread. Returns the
+  image data and IJK to RAS matrix or the polydata with the read and convert times, or None for a missing file
+  """
+  if not os.path.isfile(path):
+    return None
+  name = inputNodeName(path)
+
+  # The file is read once, by the reader itself
+  with traceSpan('read:'+name) as readSpan:
+    if path.endswith('.vtk'):
+      reader = vtk.vtkPolyDataReader()
+      reader.SetFileName(path)
+      reader.Update()
+      if reader.GetErrorCode():
+        raise IOError('Could not read model '+path)
+    else:
+      import SimpleITK as sitk # ITK readers like slicer.util.loadVolume, but without the scene
+      image = sitk.ReadImage(path)
+
+  with traceSpan('convert:'+name) as convertSpan:
+    if path.endswith('.vtk'):
+      result = {'polyData': reader.GetOutput()}
+    else:
+      voxels = sitk.GetArrayViewFromImage(image) # [k,j,i], copied into the image data below
+      if voxels.ndim != 3:
+        raise IOError('Only single component 3D volumes can be loaded in parallel: '+path)
+      imageData = vtk.vtkImageData()
+      imageData.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+      imageData.AllocateScalars(numpy_support.get_vtk_array_type(voxels.dtype), 1)
+      numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(voxels.shape)[:] = voxels
+
+      # ITK geometry is LPS, the scene is RAS
+      ijkToRAS = vtk.vtkMatrix4x4()
+      for row, values in enumerate(ijkToRASFromImage(image)):
+        for column, value in enumerate(values):
+          ijkToRAS.SetElement(row, column, value)
+      result = {'imageData': imageData, 'ijkToRAS': ijkToRAS}
+
+  result.update({'name': name, 'readTime': readSpan.elapsed, 'convertTime': convertSpan.elapsed})
+  return result
+
+def writeNrrd(path, voxels, ijkToRAS, compressionLevel=6):
+  """ Writes a [k,j,i] voxel array with a 4x4 IJK to RAS matrix (numpy) as a NRRD file in LPS space like Slicer does,
+  gzip compressed with compressionLevel (0 writes raw data)
+  """
+  spacing, directions, origin = geometryToLPS(ijkToRAS)
+  voxels = numpy.ascontiguousarray(voxels, dtype=voxels.dtype.newbyteorder('<'))
+  vector = lambda values: '(%s)' % ','.join(repr(float(value)) for value in values)
+  header = ['NRRD0004',
+            '# Complete NRRD file format specification at:',
+            '# http://teem.sourceforge.net/nrrd/format.html',
+            'type: %s' % {'float32': 'float', 'float64': 'double'}.get(voxels.dtype.name, voxels.dtype.name),
+            'dimension: 3',
+            'space: left-posterior-superior',
+            'sizes: %i %i %i' % (voxels.shape[2], voxels.shape[1], voxels.shape[0]),
+            'space directions: ' + ' '.join(vector(directions[:, axis]*spacing[axis]) for axis in range(3)),
+            'kinds: domain domain domain',
+            'endian: little',
+            'encoding: %s' % ('gzip' if compressionLevel else 'raw'),
+            'space origin: ' + vector(origin)]
+  with open(path, 'wb') as nrrdFile:
+    nrrdFile.write(('\n'.join(header) + '\n\n').encode('ascii'))
+    if compressionLevel:
+      with gzip.GzipFile(fileobj=nrrdFile, mode='wb', compresslevel=compressionLevel) as gzipFile:
+        for plane in voxels: # one slice at a time keeps the extra memory small
+          gzipFile.write(plane.tostring())
+    else:
+      voxels.tofile(nrrdFile)
+
+def writeNifti(path, voxels, ijkToRAS):
+  """ Writes a [k,j,i] voxel array with a 4x4 IJK to RAS matrix (numpy) as a NIfTI file (gzip compressed for .nii.gz)
+  """
+  import SimpleITK as sitk # ITK writes the NIfTI orientation like slicer.util.saveNode
+  sitk.WriteImage(imageFromArray(voxels, ijkToRAS, view=True), path, path.endswith('.gz'))
+
+class DecompressedInputCache(object):
+  """ Local cache of the input volumes as uncompressed NRRD files, evicted least recently used first beyond maxBytes.
+  Loaded volumes are memory mapped copy-on-write
+  """
+
+  def __init__(self, directory, maxBytes=10*1024**3):
+    self.directory = directory
+    self.maxBytes = maxBytes
+    if not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        if not os.path.isdir(directory): # another worker may have created it
+          raise
+
+  def entryPath(self, path):
+    fileStatus = os.stat(path)
+    key = '%s\0%d\0%r' % (os.path.abspath(path), fileStatus.st_size, fileStatus.st_mtime)
+    return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.nrrd')
+
+  def load(self, path):
+    """ Returns the volume of path like readInputFile does, or None if it is not cached
+    """
+    entryPath = self.entryPath(path)
+    if not os.path.exists(entryPath):
+      return None
+    name = inputNodeName(path)
+    try:
+      with traceSpan('map:'+name) as mapSpan:
+        fields, dataOffset = readNrrdHeader(entryPath)
+        sizes = [int(size) for size in fields['sizes'].split()]
+        voxels = numpy.memmap(entryPath, dtype=numpy.dtype(nrrdDataTypes[fields['type']]).newbyteorder('<'), mode='c',
+                              offset=dataOffset, shape=(sizes[2], sizes[1], sizes[0]))
+        imageData = vtk.vtkImageData()
+        imageData.SetDimensions(sizes)
+        imageData.GetPointData().SetScalars(numpy_support.numpy_to_vtk(voxels.reshape(-1), deep=False)) # keeps a reference to the mapping
+
+        # NRRD geometry is LPS, the scene is RAS
+        directions = [[float(component) for component in axisDirection.strip('()').split(',')]
+                      for axisDirection in fields['space directions'].split()]
+        origin = [float(component) for component in fields['space origin'].strip('()').split(',')]
+        ijkToRAS = vtk.vtkMatrix4x4()
+        for row, sign in enumerate((-1, -1, 1)):
+          for column in range(3):
+            ijkToRAS.SetElement(row, column, sign*directions[column][row])
+          ijkToRAS.SetElement(row, 3, sign*origin[row])
+      os.utime(entryPath, None) # most recently used
+    except (IOError, OSError, ValueError, KeyError) as error:
+      logging.warning('Could not load %s from the input cache: %s' % (path, error))
+      return None
+    return {'imageData': imageData, 'ijkToRAS': ijkToRAS, 'name': name, 'readTime': mapSpan.elapsed, 'convertTime': 0.0, 'cached': True}
+
+  def store(self, path, result):
+    """ Stores a volume read by readInputFile. Failures (for example a full disk) are logged and only mean a cache miss
+    """
+    imageData = result['imageData']
+    dimensions = imageData.GetDimensions()
+    voxels = numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(dimensions[2], dimensions[1], dimensions[0])
+    ijkToRAS = numpy.array([[result['ijkToRAS'].GetElement(row, column) for column in range(4)] for row in range(4)])
+    temporaryPath = os.path.join(self.directory, '.tmp-'+uuid.uuid4().hex+'.nrrd')
+    try:
+      writeNrrd(temporaryPath, voxels, ijkToRAS, compressionLevel=0)
+      os.rename(temporaryPath, self.entryPath(path))
+      evictLeastRecentlyUsed(self.directory, self.maxBytes)
+    except (IOError, OSError) as error:
+      logging.warning('Could not add %s to the input cache: %s' % (path, error))
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+
+  def read(self, path):
+    """ readInputFile through the cache: volumes are loaded from the cache, or read and then stored in it
+    """
+    if path.endswith('.vtk') or not os.path.isfile(path):
+      return readInputFile(path)
+    result = self.load(path)
+    if result is None:
+      result = readInputFile(path)
+      self.store(path, result)
+    return result
+
+class WriteBehindSaver(object):
+  """ Saves volumes in a thread pool: save() copies the node on the calling thread and returns. The files are renamed
+  into place once written
+  """
+
+  def __init__(self, numberOfThreads=4, compressionLevel=6):
+    self.compressionLevel = compressionLevel
+    self.pool = ThreadPool(numberOfThreads)
+    self.pending = []
+
+  def save(self, node, path):
+    """ Queues writing volume node to path (.nrrd, .nii or .nii.gz)
+    """
+    if not (path.endswith('.nrrd') or path.endswith('.nii') or path.endswith('.nii.gz')):
+      raise ValueError('Unsupported file type for write-behind saving: '+path)
+    ijkToRAS = vtk.vtkMatrix4x4()
+    node.GetIJKToRASMatrix(ijkToRAS)
+    ijkToRAS = numpy.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+    voxels = numpy.array(arrayFromVolume(node)) # snapshot, the node may change while the file is written
+    self.pending.append((path, self.pool.apply_async(self.write, (path, voxels, ijkToRAS))))
+
+  def write(self, path, voxels, ijkToRAS):
+    start_time = time.time()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      try:
+        os.makedirs(directory)
+      except OSError:
+        if not os.path.isdir(directory): # created by another write in the meantime
+          raise
+    temporaryPath = os.path.join(directory, '.tmp-'+uuid.uuid4().hex+'-'+os.path.basename(path)) # same extension for the writers
+    try:
+      if path.endswith('.nrrd'):
+        writeNrrd(temporaryPath, voxels, ijkToRAS, self.compressionLevel)
+      else:
+        writeNifti(temporaryPath, voxels, ijkToRAS)
+      os.rename(temporaryPath, path)
+    except Exception:
+      if os.path.exists(temporaryPath):
+        os.remove(temporaryPath)
+      raise
+    logging.info('Wrote %s (%0.2f s)' % (path, time.time()-start_time))
+
+  def wait(self):
+    """ Waits for the queued writes, logs the ones that failed and returns their paths
+    """
+    failed = []
+    pending, self.pending = self.pending, []
+    for path, result in pending:
+      try:
+        result.get()
+      except Exception as error:
+        logging.error('Could not write %s: %s' % (path, error))
+        failed.append(path)
+    return failed
+
+  def close(self):
+    """ Waits for the queued writes and stops the threads. Returns the paths of the writes that failed
+    """
+    failed = self.wait()
+    self.pool.close()
+    self.pool.join()
+    return failed
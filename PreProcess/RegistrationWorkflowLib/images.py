@@ -0,0 +1,65 @@
+""" Conversion of volume nodes to and from SimpleITK images
+"""
+import numpy
+import vtk
+from vtk.util import numpy_support
+from RegistrationWorkflowLib.volumes import arrayFromVolume
+
+
+def geometryToLPS(ijkToRAS):
+  """ Splits a 4x4 IJK to RAS matrix (numpy) into the spacing, LPS direction columns and LPS origin that ITK and NRRD use
+  """
+  lpsIJK = numpy.diag([-1, -1, 1]).dot(ijkToRAS[:3, :])
+  spacing = numpy.sqrt((lpsIJK[:, :3]**2).sum(axis=0))
+  return spacing, lpsIJK[:, :3]/spacing, lpsIJK[:, 3]
+
+def ijkToRASFromImage(image):
+  """ Returns the 4x4 IJK to RAS matrix (numpy) of a SimpleITK image, whose geometry is LPS
+  """
+  lpsToRAS = numpy.diag([-1, -1, 1])
+  ijkToRAS = numpy.eye(4)
+  ijkToRAS[:3, :3] = lpsToRAS.dot(numpy.array(image.GetDirection()).reshape(3, 3)*numpy.array(image.GetSpacing()))
+  ijkToRAS[:3, 3] = lpsToRAS.dot(image.GetOrigin())
+  return ijkToRAS
+
+def imageFromArray(voxels, ijkToRAS, view=False):
+  """ Returns a SimpleITK image of a [k,j,i] voxel array with the geometry of a 4x4 IJK to RAS matrix (numpy). With
+  view, the image uses the voxels of the array where SimpleITK supports it, so the array must outlive the image
+  """
+  import SimpleITK as sitk
+  spacing, directions, origin = geometryToLPS(ijkToRAS)
+  if view and hasattr(sitk, 'GetImageViewFromArray'):
+    image = sitk.GetImageViewFromArray(voxels)
+  else:
+    image = sitk.GetImageFromArray(voxels)
+  image.SetSpacing([float(value) for value in spacing])
+  image.SetDirection([float(value) for value in directions.flatten()])
+  image.SetOrigin([float(value) for value in origin])
+  return image
+
+def imageFromVolume(volumeNode, view=False):
+  """ Returns a SimpleITK image of a copy of the voxels of a volume node with its geometry. With view, the image shares
+  the voxels of the node where SimpleITK supports it, for images that are dropped before the node changes
+  """
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  ijkToRAS = numpy.array([[ijkToRAS.GetElement(row, column) for column in range(4)] for row in range(4)])
+  return imageFromArray(arrayFromVolume(volumeNode), ijkToRAS, view=view)
+
+def updateVolumeFromImage(image, volumeNode):
+  """ Makes a copy of a 3D scalar SimpleITK image, voxels and geometry, the content of an existing volume node
+  """
+  import SimpleITK as sitk
+  voxels = sitk.GetArrayViewFromImage(image).reshape(-1)
+  scalars = numpy_support.numpy_to_vtk(voxels, deep=True, array_type=numpy_support.get_vtk_array_type(voxels.dtype))
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(image.GetSize())
+  imageData.GetPointData().SetScalars(scalars)
+
+  ijkToRAS = vtk.vtkMatrix4x4()
+  for row, values in enumerate(ijkToRASFromImage(image)):
+    for column, value in enumerate(values):
+      ijkToRAS.SetElement(row, column, value)
+  volumeNode.SetIJKToRASMatrix(ijkToRAS)
+  volumeNode.SetAndObserveImageData(imageData)
+  return volumeNode
@@ -0,0 +1,116 @@
+""" Memory use of the process and of the nodes in the scene
+"""
+import time
+import slicer
+from RegistrationWorkflowLib.tracer import activeTracer
+
+
+def processMemoryUsage():
+  """ Returns (resident set size, peak resident set size) of this process in bytes. The peak is since the
+  process started or the last resetPeakMemoryUsage(); (None, None) where /proc is not available
+  """
+  usage = {}
+  try:
+    with open('/proc/self/status') as statusFile:
+      for line in statusFile:
+        if line.startswith('VmRSS:') or line.startswith('VmHWM:'):
+          usage[line[:5]] = int(line.split()[1])*1024
+  except IOError:
+    pass
+  return usage.get('VmRSS'), usage.get('VmHWM')
+
+def resetPeakMemoryUsage():
+  """ Resets the peak resident set size reported by processMemoryUsage (Linux only, ignored elsewhere)
+  """
+  try:
+    with open('/proc/self/clear_refs', 'w') as clearRefsFile:
+      clearRefsFile.write('5')
+  except IOError:
+    pass
+
+def nodeMemorySize(node):
+  """ Bytes of voxel or mesh data held by a volume or model node
+  """
+  if node.IsA('vtkMRMLVolumeNode') and node.GetImageData() is not None:
+    return node.GetImageData().GetActualMemorySize()*1024
+  if node.IsA('vtkMRMLModelNode') and node.GetPolyData() is not None:
+    return node.GetPolyData().GetActualMemorySize()*1024
+  return 0
+
+def sceneNodes():
+  """ All nodes of the MRML scene
+  """
+  nodes = slicer.mrmlScene.GetNodes()
+  return [nodes.GetItemAsObject(index) for index in range(nodes.GetNumberOfItems())]
+
+class SceneMemoryMonitor(object):
+  """ Measures the process memory and the voxel and mesh data of the scene around every pipeline stage, and lists
+  the nodes a run leaves behind
+  """
+
+  def __init__(self):
+    self.startNodeIDs = set(node.GetID() for node in sceneNodes())
+    self.startSample = self.sample()
+    self.stageSamples = {} # stage name: sample at its start
+    self.stageReports = []
+
+  def sample(self):
+    """ Current memory usage, also added to the active trace as counters
+    """
+    rss, peakRSS = processMemoryUsage()
+    voxelBytes = meshBytes = 0
+    nodes = sceneNodes()
+    for node in nodes:
+      if node.IsA('vtkMRMLVolumeNode'):
+        voxelBytes += nodeMemorySize(node)
+      elif node.IsA('vtkMRMLModelNode'):
+        meshBytes += nodeMemorySize(node)
+    currentSample = {'time': time.time(), 'rss': rss, 'peakRSS': peakRSS, 'voxelBytes': voxelBytes, 'meshBytes': meshBytes, 'nodes': len(nodes)}
+    tracer = activeTracer()
+    if tracer is not None:
+      tracer.addCounters('Memory (MB)', currentSample['time'], [(name, currentSample[name]/1024.0**2)
+                                for name in ('rss', 'voxelBytes', 'meshBytes') if currentSample[name] is not None])
+      tracer.addCounters('Scene nodes', currentSample['time'], {'nodes': len(nodes)})
+    return currentSample
+
+  def stageStarted(self, stageName):
+    if not self.stageSamples:
+      resetPeakMemoryUsage() # peak of the stages that are running from now on
+    self.stageSamples[stageName] = self.sample()
+
+  def stageFinished(self, stageName):
+    before = self.stageSamples.pop(stageName)
+    after = self.sample()
+    report = {'stage': stageName, 'peakRSS': after['peakRSS']}
+    for name in ('rss', 'voxelBytes', 'meshBytes', 'nodes'):
+      report[name] = after[name]
+      report[name+'Delta'] = after[name]-before[name] if after[name] is not None and before[name] is not None else None
+    self.stageReports.append(report)
+    return report
+
+  def remainingNodes(self):
+    """ (ID, class, name, bytes) of the nodes created since the monitor was created that are still in the scene, largest first
+    """
+    remaining = [(node.GetID(), node.GetClassName(), node.GetName(), nodeMemorySize(node))
+                 for node in sceneNodes() if node.GetID() not in self.startNodeIDs]
+    return sorted(remaining, key=lambda entry: -entry[3])
+
+  def report(self):
+    """ Prints the memory growth of every stage and of the run, and the nodes the run left in the scene
+    """
+    megabytes = lambda value: '%8.1f' % (value/1024.0**2) if value is not None else '     n/a'
+    print('Memory by stage (MB)          RSS  delta   voxels  delta   meshes  delta  peak RSS  nodes delta')
+    for report in self.stageReports:
+      print('%-24s %s %s %s %s %s %s %s %6d %+5d' % (report['stage'], megabytes(report['rss']), megabytes(report['rssDelta']),
+            megabytes(report['voxelBytes']), megabytes(report['voxelBytesDelta']), megabytes(report['meshBytes']),
+            megabytes(report['meshBytesDelta']), megabytes(report['peakRSS']), report['nodes'], report['nodesDelta']))
+    end = self.sample()
+    remaining = self.remainingNodes()
+    print('Run memory growth: RSS %s MB, voxels %s MB, meshes %s MB, %d nodes left in the scene (%s MB of data)' % (
+          megabytes(end['rss']-self.startSample['rss'] if end['rss'] is not None and self.startSample['rss'] is not None else None).strip(),
+          megabytes(end['voxelBytes']-self.startSample['voxelBytes']).strip(), megabytes(end['meshBytes']-self.startSample['meshBytes']).strip(),
+          len(remaining), megabytes(sum(entry[3] for entry in remaining)).strip()))
+    for nodeID, className, name, size in remaining:
+      if size:
+        print('  %s %s (%s) %s MB' % (nodeID, name, className, megabytes(size).strip()))
+    return remaining
@@ -0,0 +1,203 @@
+""" Running the workflow as stages of CLI modules and Python steps
+"""
+import time
+import slicer
+from RegistrationWorkflowLib.tracer import activeTracer, traceSpan
+
+
+_deferredCLILaunches = None # collects CLI modules started while a PipelineScheduler launches a stage
+
+def runCLI(module, parameters, onCompletion=None):
+  """ Runs a CLI module and waits for it to finish. While a PipelineScheduler is launching a stage the module
+  is only started and the scheduler waits for it instead. onCompletion is called after the module has finished
+  """
+  if _deferredCLILaunches is None:
+    with traceSpan('cli:' + module.name):
+      cliNode = slicer.cli.run(module, None, parameters, wait_for_completion=True)
+    if onCompletion:
+      onCompletion()
+  else:
+    cliNode = slicer.cli.run(module, None, parameters, wait_for_completion=False)
+    _deferredCLILaunches.append((cliNode, onCompletion))
+  return cliNode
+
+def deferringCLILaunches():
+  """ Returns True while runCLI only starts modules (a PipelineScheduler is launching a stage)
+  """
+  return _deferredCLILaunches is not None
+
+class PipelineStage(object):
+  """ One step of a PipelineScheduler run: the input products it needs and the output products it makes (a cacheable
+  stage must list every node it changes). finish() returns the nodes of outputs that were None until launch() ran
+  """
+
+  def __init__(self, name, inputs, outputs, launch, finish=None, parameters=None, cacheable=False):
+    self.name = name
+    self.inputs = list(inputs)
+    self.outputs = dict(outputs)
+    self.launch = launch
+    self.finish = finish
+    self.parameters = dict(parameters or {})
+    self.cacheable = cacheable
+
+class PipelineScheduler(object):
+  """ Runs PipelineStages in dependency order, with up to maxConcurrentStages running CLI modules at a time. Stages
+  are loaded from the StageCache or restored from the StageCheckpoint instead of run where possible
+  """
+
+  def __init__(self, maxConcurrentStages=2, pollInterval=0.05, cache=None, checkpoint=None, memoryMonitor=None):
+    self.maxConcurrentStages = max(1, int(maxConcurrentStages))
+    self.pollInterval = pollInterval
+    self.cache = cache
+    self.checkpoint = checkpoint
+    self.memoryMonitor = memoryMonitor
+
+  def validate(self, stages, products):
+    """ Raises ValueError if stage names or outputs are not unique, an input is never produced or the stages form a cycle
+    """
+    producers = {}
+    names = set()
+    for stage in stages:
+      if stage.name in names:
+        raise ValueError('Pipeline stage %s is defined twice' % stage.name)
+      names.add(stage.name)
+      for output in stage.outputs:
+        if output in products or output in producers:
+          raise ValueError('Pipeline product %s is produced more than once' % output)
+        producers[output] = stage.name
+    for stage in stages:
+      for input in stage.inputs:
+        if input not in products and input not in producers:
+          raise ValueError('Pipeline stage %s needs %s but no stage produces it' % (stage.name, input))
+
+    # Topological sort to find cycles
+    available = set(products)
+    remaining = list(stages)
+    while remaining:
+      ready = [stage for stage in remaining if all(input in available for input in stage.inputs)]
+      if not ready:
+        raise ValueError('Pipeline stages form a cycle: ' + ', '.join(stage.name for stage in remaining))
+      for stage in ready:
+        remaining.remove(stage)
+        available.update(stage.outputs)
+
+  def execute(self, stages, products):
+    """ Runs all stages. products maps the names of the already available products to their nodes and
+    receives the outputs of every stage as it finishes
+    """
+    global _deferredCLILaunches
+    self.validate(stages, products)
+
+    pending = list(stages)
+    running = [] # [stage, start time, [(cliNode, onCompletion), ...], cache key, trace lane]
+    failure = None
+    recomputed = set() # products of stages that were not restored from the checkpoint
+
+    while pending or running:
+      progressed = False
+
+      # Launch the stages that have all of their inputs
+      for stage in list(pending):
+        if failure or len(running) >= self.maxConcurrentStages:
+          break
+        if not all(input in products for input in stage.inputs):
+          continue
+        pending.remove(stage)
+        progressed = True
+        start_time = time.time()
+        if self.memoryMonitor:
+          self.memoryMonitor.stageStarted(stage.name)
+        if self.checkpoint and not recomputed.intersection(stage.inputs):
+          restoredOutputs = self.checkpoint.restore(stage)
+          if restoredOutputs is not None:
+            products.update(restoredOutputs)
+            self.traceStage(stage, start_time, 'Pipeline stage restores', source='checkpoint')
+            if self.memoryMonitor:
+              self.memoryMonitor.stageFinished(stage.name)
+            print('Stage %s restored from checkpoint (%0.2f s)' % (stage.name, time.time()-start_time))
+            continue
+        recomputed.update(stage.outputs)
+        cacheKey = None
+        if self.cache and stage.cacheable:
+          cacheKey = self.cache.key(stage, products)
+          cachedOutputs = self.cache.load(cacheKey, stage)
+          if cachedOutputs is not None:
+            products.update(cachedOutputs)
+            self.traceStage(stage, start_time, 'Pipeline stage restores', source='cache')
+            if self.memoryMonitor:
+              self.memoryMonitor.stageFinished(stage.name)
+            print('Stage %s loaded from cache (%0.2f s)' % (stage.name, time.time()-start_time))
+            if self.checkpoint:
+              self.checkpoint.save(stage, products)
+            continue
+        _deferredCLILaunches = []
+        try:
+          stage.launch()
+        except Exception as error:
+          failure = failure or (stage.name, error)
+        finally:
+          launches, _deferredCLILaunches = _deferredCLILaunches, None
+        usedLanes = [entry[4] for entry in running]
+        lane = 'Pipeline stage slot %d' % min(slot for slot in range(1, len(running)+2) if 'Pipeline stage slot %d' % slot not in usedLanes)
+        running.append([stage, start_time, launches, cacheKey, lane])
+
+      # Complete the CLI modules and stages that are done
+      for entry in list(running):
+        stage, start_time, launches, cacheKey, lane = entry
+        for launch in list(launches):
+          cliNode, onCompletion = launch
+          status = cliNode.GetStatus()
+          if status not in (cliNode.Completed, cliNode.CompletedWithErrors, cliNode.Cancelled):
+            continue
+          launches.remove(launch)
+          progressed = True
+          if status != cliNode.Completed:
+            failure = failure or (stage.name, RuntimeError('%s %s' % (cliNode.GetName(), cliNode.GetStatusString())))
+          elif onCompletion:
+            _deferredCLILaunches = launches # callbacks may start further CLI modules for the same stage
+            try:
+              onCompletion()
+            except Exception as error:
+              failure = failure or (stage.name, error)
+            finally:
+              _deferredCLILaunches = None
+        if launches:
+          continue
+        running.remove(entry)
+        progressed = True
+        if self.memoryMonitor:
+          self.memoryMonitor.stageFinished(stage.name)
+        if failure and failure[0] == stage.name:
+          self.traceStage(stage, start_time, lane, error=str(failure[1]))
+          continue
+        try:
+          createdOutputs = stage.finish() if stage.finish else None
+          for output, node in stage.outputs.items():
+            products[output] = (createdOutputs or {}).get(output, node)
+        except Exception as error:
+          failure = failure or (stage.name, error)
+          self.traceStage(stage, start_time, lane, error=str(error))
+          continue
+        self.traceStage(stage, start_time, lane)
+        print('Stage %s done (%0.2f s)' % (stage.name, time.time()-start_time))
+        if cacheKey:
+          self.cache.store(cacheKey, stage, products)
+        if self.checkpoint:
+          self.checkpoint.save(stage, products)
+
+      if failure and not running:
+        break
+      if not progressed:
+        slicer.app.processEvents()
+        time.sleep(self.pollInterval)
+
+    if failure:
+      raise RuntimeError('Pipeline stage %s failed: %s' % failure)
+
+  def traceStage(self, stage, startTime, lane, **args):
+    """ Records the span of a stage, from its launch until its CLI modules are done, in the active trace
+    """
+    tracer = activeTracer()
+    if tracer is not None:
+      args.update(inputs=list(stage.inputs), parameters=stage.parameters)
+      tracer.addSpan('stage:' + stage.name, startTime, time.time()-startTime, args=args, lane=lane)
@@ -0,0 +1,159 @@
+""" Timing spans of the workflow steps, written as Chrome traces
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+
+class Tracer(object):
+  """ Collects timing spans of a run and writes them as a Chrome trace (chrome://tracing, ui.perfetto.dev).
+  metadata (for example the patient) is added to the arguments of every span
+  """
+
+  def __init__(self, **metadata):
+    self.metadata = metadata
+    self.events = []
+    self.laneNames = {}
+    self.lock = threading.Lock()
+    self.startTime = time.time()
+
+  def addSpan(self, name, startTime, wallTime, cpuTime=None, args=None, lane=None):
+    """ Records a span that started at startTime (time.time()) and took wallTime seconds, shown per thread or in lane
+    (for example for stages with CLI modules running in the background)
+    """
+    if lane is not None:
+      lane = self.laneNames.setdefault(lane, len(self.laneNames)+1) # small numbers never collide with thread IDs
+    spanArgs = dict(self.metadata)
+    spanArgs.update(args or {})
+    if cpuTime is not None:
+      spanArgs['cpuTime'] = cpuTime
+    event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': threading.current_thread().ident if lane is None else lane,
+             'ts': (startTime-self.startTime)*1e6, 'dur': wallTime*1e6, 'args': spanArgs}
+    with self.lock:
+      self.events.append(event)
+
+  def addCounters(self, name, sampleTime, values):
+    """ Records counter values (for example memory usage) at sampleTime (time.time())
+    """
+    event = {'name': name, 'ph': 'C', 'pid': os.getpid(), 'tid': 0, 'ts': (sampleTime-self.startTime)*1e6, 'args': dict(values)}
+    with self.lock:
+      self.events.append(event)
+
+  def save(self, path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    with self.lock:
+      laneEvents = [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid, 'args': {'name': lane}}
+                    for lane, tid in self.laneNames.items()]
+      trace = {'traceEvents': laneEvents + self.events, 'displayTimeUnit': 'ms', 'otherData': self.metadata}
+    with open(path, 'w') as traceFile:
+      json.dump(trace, traceFile)
+
+_activeTracer = None # Tracer of the run in progress, spans outside of a run are only printed
+
+def activeTracer():
+  """ Returns the Tracer of the run in progress, None outside of a run
+  """
+  return _activeTracer
+
+class tracing(object):
+  """ Context manager that records the spans of a run and writes them to path (if not None) at the end.
+  Inside of another run (for example PreProcess called from another module) the spans go to the outer trace
+  """
+
+  def __init__(self, path=None, **metadata):
+    self.path = path
+    self.metadata = metadata
+    self.tracer = None
+
+  def __enter__(self):
+    global _activeTracer
+    if _activeTracer is None:
+      self.tracer = _activeTracer = Tracer(**self.metadata)
+    return _activeTracer
+
+  def __exit__(self, excType, excValue, traceback):
+    global _activeTracer
+    if self.tracer is None:
+      return False
+    _activeTracer = None
+    if self.path:
+      try:
+        self.tracer.save(self.path)
+        print('Trace written to ' + self.path)
+      except (IOError, OSError) as error:
+        logging.warning('Could not write trace %s: %s' % (self.path, error))
+    return False
+
+def cpuTime():
+  """ CPU time used by this process and its finished child processes (CLI modules) so far
+  """
+  times = os.times()
+  return times[0] + times[1] + times[2] + times[3]
+
+class traceSpan(object):
+  """ Context manager that times a block and records it as a span of the active trace. With a message, prints
+  'message...' at the start and 'done (... s)' at the end like the processing steps always did
+  """
+
+  def __init__(self, name, message=None, **args):
+    self.name = name
+    self.message = message
+    self.args = args
+    self.elapsed = None
+
+  def __enter__(self):
+    if self.message:
+      print(self.message+'...'),
+    self.startTime = time.time()
+    self.startCPUTime = cpuTime()
+    return self
+
+  def __exit__(self, excType, excValue, traceback):
+    self.elapsed = time.time() - self.startTime
+    if self.message:
+      print('done (%0.2f s)' % self.elapsed if excType is None else 'failed (%0.2f s)' % self.elapsed)
+    if _activeTracer is not None:
+      if excType is not None:
+        self.args['error'] = '%s: %s' % (excType.__name__, excValue)
+      _activeTracer.addSpan(self.name, self.startTime, self.elapsed, cpuTime()-self.startCPUTime, self.args)
+    return False
+
+def traceArguments(function, args, kwargs):
+  """ Span arguments for a call: the IDs of node arguments and the values of simple ones
+  """
+  code = function.__code__
+  names = list(code.co_varnames[:code.co_argcount])
+  values = {}
+  for index, value in enumerate(args):
+    name = names[index] if index < len(names) else '%s[%d]' % (code.co_varnames[code.co_argcount], index-len(names))
+    values[name] = value
+  values.update(kwargs)
+  traceArgs = {}
+  for name, value in values.items():
+    if name == 'self':
+      continue
+    if hasattr(value, 'GetID'):
+      traceArgs[name] = value.GetID()
+    elif isinstance(value, (bool, int, float, str)) or value is None:
+      traceArgs[name] = value
+  return traceArgs
+
+def traced(message=None):
+  """ Decorator that records every call of a (logic) method as a span named Class.method with its node IDs and
+  parameters, see traceSpan
+  """
+  def decorator(function):
+    def tracedFunction(*args, **kwargs):
+      name = function.__name__
+      if args and hasattr(args[0], function.__name__):
+        name = type(args[0]).__name__ + '.' + name
+      with traceSpan(name, message, **traceArguments(function, args, kwargs)):
+        return function(*args, **kwargs)
+    tracedFunction.__name__ = function.__name__
+    tracedFunction.__doc__ = function.__doc__
+    return tracedFunction
+  return decorator
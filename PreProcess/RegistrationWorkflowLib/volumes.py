@@ -0,0 +1,256 @@
+""" Numpy access to volume nodes and the array operations on labels of the registration workflow
+"""
+import math
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy
+import vtk
+from vtk.util import numpy_support
+
+
+def arrayFromVolume(volumeNode):
+  """ Returns a numpy view (indexed [k,j,i]) of the voxels of a volume node. Writing to the view changes the volume directly
+  """
+  imageData = volumeNode.GetImageData()
+  shape = list(imageData.GetDimensions())
+  shape.reverse()
+  return numpy_support.vtk_to_numpy(imageData.GetPointData().GetScalars()).reshape(shape)
+
+def arrayFromVolumeModified(volumeNode):
+  """ Lets the scene know that the voxels of a volume node were changed through arrayFromVolume
+  """
+  imageData = volumeNode.GetImageData()
+  imageData.GetPointData().GetScalars().Modified()
+  imageData.Modified()
+  volumeNode.Modified()
+
+def allocateVolumeLike(referenceVolume, outputVolume, scalarType=None):
+  """ Gives outputVolume a zero filled voxel array with the size and geometry of referenceVolume and returns a view of it
+  """
+  referenceImage = referenceVolume.GetImageData()
+  if scalarType is None:
+    scalarType = referenceImage.GetScalarType()
+  imageData = vtk.vtkImageData()
+  imageData.SetDimensions(referenceImage.GetDimensions())
+  imageData.AllocateScalars(scalarType, 1)
+  imageData.GetPointData().GetScalars().Fill(0)
+
+  ijkToRAS = vtk.vtkMatrix4x4()
+  referenceVolume.GetIJKToRASMatrix(ijkToRAS)
+  outputVolume.SetIJKToRASMatrix(ijkToRAS)
+  outputVolume.SetAndObserveImageData(imageData)
+  return arrayFromVolume(outputVolume)
+
+def sameVolumeGeometry(volumeA, volumeB):
+  """ Returns True if both volumes have image data with the same dimensions and IJK to RAS matrix
+  """
+  if volumeA.GetImageData() is None or volumeB.GetImageData() is None:
+    return False
+  if volumeA.GetImageData().GetDimensions() != volumeB.GetImageData().GetDimensions():
+    return False
+  matrixA = vtk.vtkMatrix4x4()
+  matrixB = vtk.vtkMatrix4x4()
+  volumeA.GetIJKToRASMatrix(matrixA)
+  volumeB.GetIJKToRASMatrix(matrixB)
+  for row in range(4):
+    for column in range(4):
+      if abs(matrixA.GetElement(row, column) - matrixB.GetElement(row, column)) > 1e-6:
+        return False
+  return True
+
+def registrationLabelArray(capsuleVoxels, cgVoxels, vmVoxels, labelValue=1, out=None):
+  """ Builds the PZ+VM registration label in a single pass: voxels inside the capsule but outside the central gland,
+  plus all veramontanum voxels, get labelValue and everything else 0. Inputs are only read
+  """
+  registerMask = capsuleVoxels > 0.5
+  registerMask &= cgVoxels <= 0.5
+  registerMask |= vmVoxels > 0.5
+  if out is None:
+    out = numpy.empty(registerMask.shape, dtype=cgVoxels.dtype)
+  numpy.multiply(registerMask, labelValue, out=out, casting='unsafe')
+  return out
+
+def labelBoundingBox(voxels, labelValue=None, margin=(0, 0, 0)):
+  """ Returns the [k,j,i] slices of the box around the nonzero voxels (or the voxels equal to labelValue), grown by
+  margin (i, j, k) voxels and clipped to the array, or None if there are no such voxels
+  """
+  mask = voxels != 0 if labelValue is None else voxels == labelValue
+  box = []
+  for axis in range(3):
+    otherAxes = tuple(other for other in range(3) if other != axis)
+    indices = numpy.flatnonzero(mask.any(axis=otherAxes))
+    if indices.size == 0:
+      return None
+    axisMargin = margin[2-axis] # margin is given in i, j, k order
+    box.append(slice(max(0, indices[0]-axisMargin), min(voxels.shape[axis], indices[-1]+axisMargin+1)))
+  return tuple(box)
+
+def labelBounds(volumeNode):
+  """ Returns the RAS bounds of the nonzero voxels of a labelmap, including half a voxel around the centers, or None
+  """
+  box = labelBoundingBox(arrayFromVolume(volumeNode))
+  if box is None:
+    return None
+  ijkToRAS = vtk.vtkMatrix4x4()
+  volumeNode.GetIJKToRASMatrix(ijkToRAS)
+  corners = []
+  for k in (box[0].start-0.5, box[0].stop-0.5):
+    for j in (box[1].start-0.5, box[1].stop-0.5):
+      for i in (box[2].start-0.5, box[2].stop-0.5):
+        corners.append(ijkToRAS.MultiplyPoint((i, j, k, 1))[:3])
+  corners = numpy.array(corners)
+  lower, upper = corners.min(axis=0), corners.max(axis=0)
+  return (lower[0], upper[0], lower[1], upper[1], lower[2], upper[2])
+
+def gaussianSmoothArray(voxels, sigmas, numberOfThreads=None):
+  """ Separable Gaussian filter of a [k,j,i] array with sigmas (k, j, i) in voxels, run in slabs by a thread pool.
+  Returns a float32 array
+  """
+  smoothed = numpy.array(voxels, dtype=numpy.float32)
+  numberOfThreads = numberOfThreads or multiprocessing.cpu_count()
+  pool = ThreadPool(numberOfThreads) if numberOfThreads > 1 else None
+  try:
+    for axis in range(3):
+      if sigmas[axis] <= 0:
+        continue
+      radius = int(math.ceil(3*sigmas[axis]))
+      kernel = numpy.exp(-0.5*(numpy.arange(-radius, radius+1)/float(sigmas[axis]))**2)
+      kernel /= kernel.sum()
+      source = numpy.moveaxis(smoothed, axis, 0) # views, so the slabs below are views as well
+      filtered = numpy.empty_like(smoothed)
+      target = numpy.moveaxis(filtered, axis, 0)
+      length = source.shape[0]
+
+      def filterSlab(slab):
+        sourceSlab, targetSlab = source[:, slab], target[:, slab]
+        numpy.multiply(sourceSlab, kernel[radius], out=targetSlab)
+        for offset in range(1, min(radius, length-1)+1):
+          targetSlab[offset:] += kernel[radius-offset]*sourceSlab[:-offset]
+          targetSlab[:-offset] += kernel[radius+offset]*sourceSlab[offset:]
+
+      slabSize = max(1, int(math.ceil(source.shape[1]/float(numberOfThreads))))
+      slabs = [slice(start, start+slabSize) for start in range(0, source.shape[1], slabSize)]
+      if pool and len(slabs) > 1:
+        pool.map(filterSlab, slabs)
+      else:
+        for slab in slabs:
+          filterSlab(slab)
+      smoothed = filtered
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+  return smoothed
+
+def smoothLabelArray(voxels, spacing, sigma, labels=None, numberOfThreads=None):
+  """ Native labelmapsmoothing: blurs each of labels (default: the largest) with a Gaussian of sigma mm and thresholds it
+  at 0.5. spacing is in (i, j, k) order. Returns a new array with only the smoothed labels
+  """
+  if labels is None:
+    labels = [voxels.max()]
+  sigmas = [sigma/abs(spacing[2-axis]) for axis in range(3)] # in voxels, k, j, i order
+  margin = [int(math.ceil(3*sigmas[2-axis])) for axis in range(3)] # i, j, k order
+  smoothed = numpy.zeros_like(voxels)
+  for label in labels:
+    if label == 0:
+      continue
+    box = labelBoundingBox(voxels, label, margin)
+    if box is None:
+      continue
+    labelMask = gaussianSmoothArray(voxels[box] == label, sigmas, numberOfThreads) > 0.5
+    smoothed[box][labelMask] = label
+  return smoothed
+
+def labelHausdorffDistance(voxelsA, voxelsB, spacing):
+  """ Symmetric Hausdorff distance in mm between the nonzero voxels of two labelmaps on the same grid with spacing
+  (i, j, k), or None if either labelmap is empty
+  """
+  import SimpleITK as sitk # only needed for the label comparisons
+  if not voxelsA.any() or not voxelsB.any():
+    return None
+  masks = []
+  for voxels in (voxelsA, voxelsB):
+    mask = sitk.GetImageFromArray((voxels != 0).astype(numpy.uint8))
+    mask.SetSpacing([abs(float(axisSpacing)) for axisSpacing in spacing])
+    masks.append(mask)
+  hausdorff = sitk.HausdorffDistanceImageFilter()
+  hausdorff.Execute(masks[0], masks[1])
+  return hausdorff.GetHausdorffDistance()
+
+def labelAgreement(voxelsA, voxelsB):
+  """ Compares the nonzero voxels of two labelmaps: voxel counts, number of voxels that differ and Dice coefficient
+  """
+  maskA = voxelsA != 0
+  maskB = voxelsB != 0
+  countA = int(maskA.sum())
+  countB = int(maskB.sum())
+  overlap = int((maskA & maskB).sum())
+  return {'voxelsA': countA, 'voxelsB': countB, 'differentVoxels': int((maskA != maskB).sum()),
+          'dice': 2.0*overlap/(countA+countB) if countA+countB else 1.0}
+
+def labelAgreements(bitsA, bitsB, labelCount, voxelVolume=1.0):
+  """ Compares up to 8 mask pairs packed as bits of the uint8 arrays bitsA and bitsB in one histogram. Returns a dict
+  per pair with the labelAgreement values, the Jaccard index and the volume difference (B - A, mm3)
+  """
+  if labelCount > 8:
+    raise ValueError('labelAgreements compares at most 8 label pairs at once')
+  patterns = (bitsA.astype(numpy.uint16) << labelCount) | bitsB
+  histogram = numpy.bincount(patterns.ravel(), minlength=1 << 2*labelCount)
+  patternValues = numpy.arange(histogram.size)[:, numpy.newaxis]
+  bits = numpy.arange(labelCount)
+  masksA = (patternValues >> (bits+labelCount)) & 1
+  masksB = (patternValues >> bits) & 1
+  countsA = histogram.dot(masksA)
+  countsB = histogram.dot(masksB)
+  overlaps = histogram.dot(masksA & masksB)
+
+  agreements = []
+  for countA, countB, overlap in zip(countsA.tolist(), countsB.tolist(), overlaps.tolist()):
+    union = countA+countB-overlap
+    agreements.append({'voxelsA': countA, 'voxelsB': countB, 'differentVoxels': union-overlap,
+                       'dice': 2.0*overlap/(countA+countB) if countA+countB else 1.0,
+                       'jaccard': float(overlap)/union if union else 1.0,
+                       'volumeDifference': (countB-countA)*voxelVolume})
+  return agreements
+
+def resliceArray(voxels, inputVolume, referenceVolume, transformNode=None, linear=False, offset=(0, 0, 0), numberOfThreads=None):
+  """ Resamples a [k,j,i(,component)] array on the grid of inputVolume (from voxel offset) onto referenceVolume through
+  transformNode (reference to input). Returns the resampled array
+  """
+  image = vtk.vtkImageData()
+  image.SetDimensions(voxels.shape[2], voxels.shape[1], voxels.shape[0])
+  image.AllocateScalars(numpy_support.get_vtk_array_type(voxels.dtype), 1 if voxels.ndim == 3 else voxels.shape[3])
+  numpy_support.vtk_to_numpy(image.GetPointData().GetScalars()).reshape(voxels.shape)[:] = voxels
+
+  # Reference voxel index -> RAS -> through the transform -> input voxel index
+  referenceIJKToRAS = vtk.vtkMatrix4x4()
+  referenceVolume.GetIJKToRASMatrix(referenceIJKToRAS)
+  inputRASToIJK = vtk.vtkMatrix4x4()
+  inputVolume.GetRASToIJKMatrix(inputRASToIJK)
+  for row, axis in enumerate((2, 1, 0)):
+    inputRASToIJK.SetElement(row, 3, inputRASToIJK.GetElement(row, 3)-offset[axis])
+  resliceTransform = vtk.vtkGeneralTransform()
+  resliceTransform.Concatenate(inputRASToIJK)
+  if transformNode is not None:
+    transformFromWorld = vtk.vtkGeneralTransform()
+    transformNode.GetTransformFromWorld(transformFromWorld)
+    resliceTransform.Concatenate(transformFromWorld)
+  resliceTransform.Concatenate(referenceIJKToRAS)
+
+  dimensions = referenceVolume.GetImageData().GetDimensions()
+  reslice = vtk.vtkImageReslice()
+  reslice.SetInputData(image)
+  reslice.SetResliceTransform(resliceTransform)
+  reslice.SetOutputOrigin(0, 0, 0)
+  reslice.SetOutputSpacing(1, 1, 1)
+  reslice.SetOutputExtent(0, dimensions[0]-1, 0, dimensions[1]-1, 0, dimensions[2]-1)
+  reslice.SetBackgroundLevel(0)
+  if linear:
+    reslice.SetInterpolationModeToLinear()
+  else:
+    reslice.SetInterpolationModeToNearestNeighbor()
+  if numberOfThreads:
+    reslice.SetNumberOfThreads(numberOfThreads)
+  reslice.Update()
+  shape = (dimensions[2], dimensions[1], dimensions[0]) + voxels.shape[3:]
+  return numpy_support.vtk_to_numpy(reslice.GetOutput().GetPointData().GetScalars()).reshape(shape).copy()